@@ -7,6 +7,10 @@ class ChatRoutes:
         "build": course_builder.build_course,
         "learn": course_teacher.iterate_lesson
     }
+    # token-streaming variants, served over SSE by /api/chat/stream
+    streams = {
+        "learn": course_teacher.stream_lesson
+    }
 
 class ChatMsg(BaseModel):
     purpose: str
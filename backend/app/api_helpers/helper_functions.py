@@ -1,4 +1,18 @@
-import re, json
+import re, json, asyncio, traceback
+
+from langchain_core.prompts import PromptTemplate
+
+from llm_operations.llm_class import LLM
+
+JSON_REPAIR_PROMPT = PromptTemplate.from_template("""
+The following text was meant to be a single JSON object, but it does not parse.
+Return only the corrected JSON object with the same keys and values. Do not add any commentary.
+
+Parser error: {error}
+
+Text:
+{text}
+""")
 
 def _strip_code_fences(s: str) -> str:
     return re.sub(r"^```(?:json)?\s*|\s*```$", "", s.strip(), flags=re.IGNORECASE)
@@ -35,3 +49,35 @@ def coerce_model_json(x):
         return inner
     except Exception:
         raise ValueError("Model did not return valid JSON")
+
+async def repair_model_json(x, error: str = ""):
+    # last resort when coerce_model_json gives up: one pass through the fast
+    # model in JSON mode. Raises ValueError if the result still won't parse
+    if hasattr(x, "content"):
+        x = x.content
+    if isinstance(x, (bytes, bytearray)):
+        x = x.decode("utf-8", errors="replace")
+    chain = JSON_REPAIR_PROMPT | LLM.get_llm(purpose="repair").bind(format="json")
+    fixed = await chain.ainvoke({"text": str(x), "error": error})
+    return coerce_model_json(fixed)
+
+def sse_event(event: str, data) -> str:
+    # one Server-Sent Events frame; data is always JSON so clients can
+    # JSON.parse every frame regardless of event type
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+_background_tasks = set()
+
+def spawn_background(coro):
+    # fire-and-forget task; a reference is held until it finishes (the event
+    # loop only keeps weak ones) and failures are logged, not lost
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+
+    def _done(t):
+        _background_tasks.discard(t)
+        if not t.cancelled() and t.exception() is not None:
+            traceback.print_exception(t.exception())
+
+    task.add_done_callback(_done)
+    return task
@@ -0,0 +1,144 @@
+# In-process metrics, served in Prometheus text format at /metrics.
+#
+# Histograms and counters are recorded as requests run (span() times a
+# block of code into stage_seconds{stage=...}); gauges are read from their
+# source (pools, caches, scheduler) when /metrics is scraped. Values are per
+# worker process, like everything else kept in memory here. No client
+# library or collector is needed: Prometheus scrapes each worker directly.
+
+import time, math, traceback
+from contextlib import contextmanager
+from functools import wraps
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+_registry = []
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names, values, extra=()) -> str:
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+def _number(v) -> str:
+    if isinstance(v, bool):
+        return str(int(v))
+    if v == math.inf:
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+class Counter:
+
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        _registry.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, v in self._values.items():
+            lines.append(f"{self.name}{_labels(self.labelnames, key)} {_number(v)}")
+        return lines
+
+class Histogram:
+
+    def __init__(self, name: str, help: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # label values -> [per-bucket counts, sum, count]
+        self._values = {}
+        _registry.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[0][i] += 1
+                break
+        entry[1] += value
+        entry[2] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                le = (("le", _number(bound)),)
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+        return lines
+
+class Gauge:
+    """
+    Read at scrape time: `read()` returns a number, or a dict mapping label
+    values (a tuple, one per label name) to numbers.
+    """
+
+    def __init__(self, name: str, help: str, read, labelnames=()):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.labelnames = tuple(labelnames)
+        _registry.append(self)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        try:
+            values = self.read()
+        except Exception:
+            traceback.print_exc()
+            return lines
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, v in values.items():
+            if v is None:
+                continue
+            lines.append(f"{self.name}{_labels(self.labelnames, key)} {_number(v)}")
+        return lines
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+STAGE_SECONDS = Histogram(
+    "autodactyl_stage_seconds",
+    "Time spent in each instrumented stage of request handling.",
+    ("stage",),
+)
+
+@contextmanager
+def span(stage: str):
+    # time the enclosed block (sync or async code) as one stage
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage)
+
+def timed(stage: str):
+    # decorator form of span() for coroutine functions
+    def wrap(fn):
+        @wraps(fn)
+        async def inner(*args, **kwargs):
+            with span(stage):
+                return await fn(*args, **kwargs)
+        return inner
+    return wrap
@@ -0,0 +1,48 @@
+# Conditional GET and a shared response cache for read endpoints.
+#
+# A response is named by what it shows (e.g. "sections:12") and versioned
+# by a revision counter from courses/revisions.py. The ETag is derived from
+# both, so a client holding the current version gets a 304 after a single
+# Redis round-trip; anyone else gets the serialised body from Redis, and
+# only the first request after a write runs `build` against Postgres.
+# Writes bump the counter, so stale entries are simply never read again
+# and expire after RESPONSE_CACHE_TTL.
+
+import os, json, hashlib
+
+from fastapi import Request, Response
+
+import courses.revisions as revisions
+from api_helpers.session_helpers import r
+
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "300"))
+
+def _etag(name: str, rev: int) -> str:
+    return f'"{hashlib.sha1(name.encode()).hexdigest()[:12]}-{rev}"'
+
+def _matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return etag in [t.strip().removeprefix("W/") for t in header.split(",")]
+
+async def conditional_json(request: Request, rev_key: str, name: str, build) -> Response:
+    """
+    Serve {"ok": true, "result": await build()} for the resource `name`
+    at the revision stored under `rev_key`, honouring If-None-Match.
+    """
+    rev = await revisions.current(rev_key)
+    etag = _etag(name, rev)
+    # clients may keep the body but must revalidate before using it
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if _matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    key = f"resp:{name}:{rev}"
+    body = await r.get(key)
+    if body is None:
+        body = json.dumps({"ok": True, "result": await build()}, default=str)
+        await r.set(key, body, ex=RESPONSE_CACHE_TTL)
+    return Response(body, media_type="application/json", headers=headers)
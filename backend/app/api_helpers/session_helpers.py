@@ -1,43 +1,122 @@
 from fastapi import Request, HTTPException
 import uuid, bcrypt
 import redis.asyncio as redis
-import os
+import os, asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from api_helpers.cache_helpers import LRUCache
+from api_helpers.metrics import span
 
 SESSION_COOKIE = "sid"
 SESSION_TTL = 60 * 60 * 24
+# sliding expiry is refreshed only once the remaining TTL drops below this,
+# i.e. at most once every SESSION_TTL - SESSION_REFRESH_BELOW seconds
+SESSION_REFRESH_BELOW = int(os.getenv("SESSION_REFRESH_BELOW", str(SESSION_TTL - 300)))
+# sid -> user_id kept in-process for this long; a logout on another worker
+# takes up to this long to be seen here. 0 turns the local cache off, so
+# every lookup asks Redis and logouts are seen everywhere at once
+SESSION_LOCAL_TTL = float(os.getenv("SESSION_LOCAL_TTL", "5"))
 
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 
 r = redis.from_url(REDIS_URL, decode_responses=True)
 
-def verify_password(plain: str, hashed: str) -> bool:
+_sessions = LRUCache(maxsize=int(os.getenv("SESSION_LOCAL_SIZE", "4096")), ttl=SESSION_LOCAL_TTL)
+
+# --- passwords ---
+# bcrypt takes 100ms+ per call by design, so it runs on a small dedicated
+# thread pool (bcrypt releases the GIL) instead of the event loop. At most
+# BCRYPT_WORKERS hashes run at once and BCRYPT_QUEUE_LIMIT more may wait;
+# beyond that callers get PasswordHasherBusy rather than an ever-growing
+# queue. Hashes made with a cost other than BCRYPT_ROUNDS are upgraded on
+# the next successful login (see needs_rehash).
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+BCRYPT_WORKERS = int(os.getenv("BCRYPT_WORKERS", str(min(4, os.cpu_count() or 1))))
+BCRYPT_QUEUE_LIMIT = int(os.getenv("BCRYPT_QUEUE_LIMIT", "32"))
+
+_bcrypt_pool = ThreadPoolExecutor(max_workers=BCRYPT_WORKERS, thread_name_prefix="bcrypt")
+_bcrypt_pending = 0
+
+class PasswordHasherBusy(Exception):
+    def __init__(self, retry_after: int = 1):
+        super().__init__("Too many logins in progress, try again shortly")
+        self.retry_after = retry_after
+
+async def _run_bcrypt(fn, *args):
+    global _bcrypt_pending
+    if _bcrypt_pending >= BCRYPT_WORKERS + BCRYPT_QUEUE_LIMIT:
+        raise PasswordHasherBusy()
+    _bcrypt_pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_bcrypt_pool, fn, *args)
+    finally:
+        _bcrypt_pending -= 1
+
+def _checkpw(plain: str, hashed: str) -> bool:
     return bcrypt.checkpw(plain.encode(), hashed.encode())
 
-def hash_password(pw: str) -> str:
-    salt = bcrypt.gensalt()
+def _hashpw(pw: str) -> str:
+    salt = bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
     hashed = bcrypt.hashpw(pw.encode("utf-8"), salt)
     return hashed.decode()
 
+async def verify_password(plain: str, hashed: str) -> bool:
+    return await _run_bcrypt(_checkpw, plain, hashed)
+
+async def hash_password(pw: str) -> str:
+    return await _run_bcrypt(_hashpw, pw)
+
+def needs_rehash(hashed: str) -> bool:
+    # bcrypt hashes look like $2b$<cost>$<salt+hash>
+    try:
+        return int(hashed.split("$")[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return True
+
+def session_cache_stats() -> dict:
+    return _sessions.stats()
+
+def hasher_stats() -> dict:
+    return {"workers": BCRYPT_WORKERS, "pending": _bcrypt_pending, "queue_limit": BCRYPT_QUEUE_LIMIT}
+
+def shutdown_hasher():
+    _bcrypt_pool.shutdown(wait=False, cancel_futures=True)
+
 # --- sessions ---
 async def create_session(user_id: str) -> str:
     sid = str(uuid.uuid4())
     key = f"session:{sid}"
-    await r.hset(key, mapping={"user_id": user_id})
-    await r.expire(key, SESSION_TTL)
+    # one round-trip, and never a session without an expiry
+    async with r.pipeline(transaction=True) as pipe:
+        pipe.hset(key, mapping={"user_id": user_id})
+        pipe.expire(key, SESSION_TTL)
+        await pipe.execute()
+    _sessions.set(sid, str(user_id))
     return sid
 
 async def destroy_session(sid: str):
+    _sessions.pop(sid)
     await r.delete(f"session:{sid}")
 
 async def get_session_user_id(request: Request) -> str | None:
     sid = request.cookies.get(SESSION_COOKIE)
     if not sid:
         return None
-    user_id = await r.hget(f"session:{sid}", "user_id")
-    if not user_id:
-        return None
-    # optional: sliding expiration
-    await r.expire(f"session:{sid}", SESSION_TTL)
+    user_id = _sessions.get(sid)
+    if user_id is not None:
+        return user_id
+    key = f"session:{sid}"
+    with span("session.lookup"):
+        async with r.pipeline(transaction=False) as pipe:
+            pipe.hget(key, "user_id")
+            pipe.ttl(key)
+            user_id, ttl = await pipe.execute()
+        if not user_id:
+            return None
+        # sliding expiration, throttled: only refresh once the TTL has run down
+        if 0 <= ttl < SESSION_REFRESH_BELOW:
+            await r.expire(key, SESSION_TTL)
+    _sessions.set(sid, user_id)
     return user_id
 
 async def require_user_id(request: Request) -> str:
@@ -1,15 +1,26 @@
-import os
+import os, json, time
 from typing import Optional, Dict, Any, List
 
-import psycopg
-from psycopg import Connection
+from contextlib import asynccontextmanager
+
+from psycopg import AsyncConnection
 from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+
+import courses.revisions as revisions
+from api_helpers.metrics import timed, STAGE_SECONDS
 
 DATABASE_URL = os.environ["DATABASE_URL"]
 
 if not DATABASE_URL:
     raise RuntimeError("DATABASE_URL IS NOT SET")
 
+# connection pool sizing (shared by every module that talks to Postgres)
+POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", "300"))
+POOL_TIMEOUT  = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+
 # status is 0, 1, or 2:
 # - 0 = not started
 # - 1 = started
@@ -57,6 +68,28 @@ CREATE TABLE IF NOT EXISTS lessons (
   UNIQUE(section_id, position)
 );
 
+-- one row per chat turn; appending a turn is a single INSERT
+-- (lessons.messages is the legacy JSON blob, migrated by
+-- migrate_lesson_messages)
+CREATE TABLE IF NOT EXISTS lesson_messages (
+  lesson_id     INTEGER NOT NULL REFERENCES lessons(id) ON DELETE CASCADE,
+  seq           INTEGER NOT NULL,
+  role          TEXT NOT NULL,
+  content       TEXT NOT NULL,
+  PRIMARY KEY(lesson_id, seq)
+);
+
+-- retrieval index for lesson Q&A: body_md paragraphs and past Q&A turns
+-- with their embeddings (see course_teaching/lesson_retrieval.py); turns
+-- are numbered above TURN_CHUNK_BASE, body chunks below it
+CREATE TABLE IF NOT EXISTS lesson_chunks (
+  lesson_id     INTEGER NOT NULL REFERENCES lessons(id) ON DELETE CASCADE,
+  chunk_no      INTEGER NOT NULL,
+  content       TEXT NOT NULL,
+  embedding     REAL[] NOT NULL,
+  PRIMARY KEY(lesson_id, chunk_no)
+);
+
 CREATE TABLE IF NOT EXISTS exercises (
   id            INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
   lesson_id     INTEGER,
@@ -88,49 +121,285 @@ CREATE TABLE IF NOT EXISTS projects (
   UNIQUE(course_id, position)
 );
 
+-- versions from MIGRATIONS that have been applied
+CREATE TABLE IF NOT EXISTS schema_migrations (
+  version     INTEGER PRIMARY KEY,
+  name        TEXT NOT NULL,
+  applied_at  TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
 """
 
-def init_db():
-    """Create DB and schema if not present."""
-    with psycopg.connect(DATABASE_URL) as con:
-        with con.cursor() as cur:
-            cur.execute(PG_SCHEMA)
+# Schema changes after the baseline above, applied once each and in order.
+# Append new entries; never edit or renumber an applied one. A step is
+# either SQL or an async function taking the connection. Everything runs
+# in init_db's transaction, so a failed step leaves nothing half-applied.
+MIGRATIONS = [
+    (1, "lesson rolling context summary", """
+        -- summary of the turns that no longer fit in the Q&A context window;
+        -- context_upto is the last lesson_messages.seq folded into it
+        ALTER TABLE lessons ADD COLUMN IF NOT EXISTS context_summary TEXT;
+        ALTER TABLE lessons ADD COLUMN IF NOT EXISTS context_upto INTEGER NOT NULL DEFAULT 0;
+    """),
+    (2, "course digest", """
+        -- running digest of the course so far, folded from sections.summary;
+        -- digest_upto is the last section position folded into it (always
+        -- a prefix of the course)
+        ALTER TABLE courses ADD COLUMN IF NOT EXISTS digest TEXT;
+        ALTER TABLE courses ADD COLUMN IF NOT EXISTS digest_upto INTEGER NOT NULL DEFAULT 0;
+    """),
+    (3, "quiz listing index", """
+        -- superseded by 5: the INCLUDEd text columns can exceed the btree
+        -- row limit, so inserting a long quiz fails
+        CREATE INDEX IF NOT EXISTS quizzes_section_position_idx
+          ON quizzes(section_id, position) INCLUDE (id, quiz, options, answer, status);
+    """),
+    (4, "foreign key indexes", """
+        -- foreign keys not already led by a UNIQUE constraint; these back
+        -- per-course lesson lookups and the cascades on delete
+        CREATE INDEX IF NOT EXISTS lessons_course_id_idx ON lessons(course_id);
+        CREATE INDEX IF NOT EXISTS projects_section_id_idx ON projects(section_id);
+    """),
+    (5, "plain quiz listing index", """
+        -- /api/list-quizzes reads a section's quizzes in position order; the
+        -- key alone is enough to find them, and it keeps entries a fixed,
+        -- small size whatever the length of the questions
+        DROP INDEX IF EXISTS quizzes_section_position_idx;
+        CREATE INDEX quizzes_section_position_idx ON quizzes(section_id, position);
+    """),
+    (6, "lesson versions", """
+        -- bumped by every lesson UPDATE; a write from a copy loaded at an
+        -- older version is refused (see update_lessons_sql)
+        ALTER TABLE lessons ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 0;
+    """),
+]
+
+# arbitrary key for pg_advisory_xact_lock, so that when several workers
+# start at once only one creates the schema and migrates
+MIGRATION_LOCK_ID = 7_400_001
+
+async def init_db():
+    """Create DB and schema if not present, then apply pending migrations."""
+    async with connection() as con:
+        async with con.transaction():
+            async with con.cursor() as cur:
+                await cur.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_ID,))
+                await cur.execute(PG_SCHEMA)
+            await run_migrations(con)
+            await migrate_lesson_messages(con)
+
+async def run_migrations(con: AsyncConnection):
+    async with con.cursor() as cur:
+        await cur.execute("SELECT version FROM schema_migrations")
+        applied = {row["version"] for row in await cur.fetchall()}
+        for version, name, step in MIGRATIONS:
+            if version in applied:
+                continue
+            if isinstance(step, str):
+                await cur.execute(step)
+            else:
+                await step(con)
+            await cur.execute(
+                "INSERT INTO schema_migrations(version, name) VALUES (%s, %s)",
+                (version, name),
+            )
+            print(f"applied migration {version}: {name}")
+
+class DBPool:
+    __pool = None
+
+    @staticmethod
+    async def get_pool() -> AsyncConnectionPool:
+        if DBPool.__pool is None:
+            pool = AsyncConnectionPool(
+                DATABASE_URL,
+                min_size=POOL_MIN_SIZE,
+                max_size=POOL_MAX_SIZE,
+                max_idle=POOL_MAX_IDLE,
+                timeout=POOL_TIMEOUT,
+                kwargs={"row_factory": dict_row},
+                # health check: connections are tested before being handed out
+                check=AsyncConnectionPool.check_connection,
+                name="autodactyl",
+                open=False,
+            )
+            await pool.open()
+            DBPool.__pool = pool
+        return DBPool.__pool
+
+    @staticmethod
+    async def close_pool():
+        if DBPool.__pool is not None:
+            await DBPool.__pool.close()
+            DBPool.__pool = None
+
+    @staticmethod
+    def stats() -> Dict[str, int]:
+        if DBPool.__pool is None:
+            return {}
+        return DBPool.__pool.get_stats()
+
+async def open_pool():
+    await DBPool.get_pool()
+
+async def close_pool():
+    await DBPool.close_pool()
+
+@asynccontextmanager
+async def connection():
+    """
+    Borrow a connection from the shared pool:
 
-def open_db():
-    return psycopg.connect(DATABASE_URL, row_factory=dict_row)
+        async with db.connection() as con:
+            ...
 
-def create_course(con: Connection, user_id: int, title: str, slug: Optional[str] = None, description: Optional[str] = None) -> int:
-    with con.cursor() as cur:
-        cur.execute(
+    The connection goes back to the pool when the block exits
+    (committed on success, rolled back on error).
+    """
+    pool = await DBPool.get_pool()
+    start = time.perf_counter()
+    async with pool.connection() as con:
+        # time spent waiting for a free connection
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage="db.acquire")
+        yield con
+
+def pool_stats() -> Dict[str, int]:
+    return DBPool.stats()
+
+async def section_course_id(con: AsyncConnection, section_id: int) -> Optional[int]:
+    # course of a section, from Redis when known (the mapping never changes)
+    course_id = await revisions.parent_course("section", section_id)
+    if course_id is None:
+        async with con.cursor() as cur:
+            await cur.execute("SELECT course_id FROM sections WHERE id = %s", (section_id,))
+            row = await cur.fetchone()
+        if row is None:
+            return None
+        course_id = row["course_id"]
+        await revisions.remember_parents("section", course_id, [section_id])
+    return course_id
+
+async def lesson_course_id(con: AsyncConnection, lesson_id: int) -> Optional[int]:
+    # course of a lesson, from Redis when known (the mapping never changes)
+    course_id = await revisions.parent_course("lesson", lesson_id)
+    if course_id is None:
+        async with con.cursor() as cur:
+            await cur.execute("SELECT course_id FROM lessons WHERE id = %s", (lesson_id,))
+            row = await cur.fetchone()
+        if row is None:
+            return None
+        course_id = row["course_id"]
+        await revisions.remember_parents("lesson", course_id, [lesson_id])
+    return course_id
+
+async def course_owner_id(con: AsyncConnection, course_id: int) -> Optional[int]:
+    async with con.cursor() as cur:
+        await cur.execute("SELECT user_id FROM courses WHERE id = %s", (course_id,))
+        row = await cur.fetchone()
+    return row["user_id"] if row is not None else None
+
+async def create_course(con: AsyncConnection, user_id: int, title: str, slug: Optional[str] = None, description: Optional[str] = None) -> int:
+    async with con.cursor() as cur:
+        await cur.execute(
             "INSERT INTO courses(user_id, title, slug, description, status) VALUES (%s, %s, %s, %s, 0) RETURNING id",
             (user_id, title, slug, description),
         )
-        new_id = cur.fetchone()["id"]
-    con.commit()
+        new_id = (await cur.fetchone())["id"]
+    await con.commit()
+    await revisions.bump_user(user_id)
     return new_id
 
-def create_section(con: Connection, course_id: int, title: str, position: int) -> int:
-    with con.cursor() as cur:
-        cur.execute(
+async def create_section(con: AsyncConnection, course_id: int, title: str, position: int) -> int:
+    async with con.cursor() as cur:
+        await cur.execute(
             "INSERT INTO sections(course_id, title, position, status) VALUES (%s, %s, %s, 0) RETURNING id",
             (course_id, title, position),
         )
-        new_id = cur.fetchone()["id"]
-    con.commit()
+        new_id = (await cur.fetchone())["id"]
+    await con.commit()
+    await revisions.bump_courses(course_id)
     return new_id
 
-def create_lesson(con: Connection, course_id: int, section_id: int, title: str, description: str, position: int, body_md: Optional[str] = None):
-    with con.cursor() as cur:
-        cur.execute(
+async def create_lesson(con: AsyncConnection, course_id: int, section_id: int, title: str, description: str, position: int, body_md: Optional[str] = None):
+    async with con.cursor() as cur:
+        await cur.execute(
             "INSERT INTO lessons(course_id, section_id, title, description, body_md, position, status)"
             " VALUES (%s, %s, %s, %s, %s, %s, 0)",
             (course_id, section_id, title, description, body_md, position),
         )
-    con.commit()
+    await con.commit()
+    await revisions.bump_courses(course_id)
+
+async def unique_slug(con: AsyncConnection, base_slug: str) -> str:
+    # one lookup for the base slug and all of its "-N" variants, then pick
+    # the first free suffix (-2, -3, ...) in Python
+    async with con.cursor() as cur:
+        await cur.execute(
+            "SELECT slug FROM courses WHERE slug = %s OR slug LIKE %s",
+            (base_slug, f"{base_slug}-%"),
+        )
+        taken = {r["slug"] for r in await cur.fetchall()}
+
+    s = base_slug
+    n = 1
+    while s in taken:
+        n += 1
+        s = f"{base_slug}-{n}"
+    return s
+
+@timed("db.create_course_tree")
+async def create_course_tree(con: AsyncConnection, user_id: int, title: str, base_slug: str, description: Optional[str], sections: List[Dict[str, Any]]) -> int:
+    """
+    Write a course with all of its sections and lessons in one transaction.
+    Sections and lessons are inserted with executemany (pipelined), so the
+    cost no longer scales with one round-trip and one commit per row, and a
+    failure leaves nothing behind.
 
-def get_all_courses(con: Connection, user_id: int) -> List[Dict[str, Any]]:
-    with con.cursor() as cur:
-        cur.execute(
+    `sections` is the normalized shape produced by _validate_draft.
+    Returns the new course_id.
+    """
+    async with con.transaction():
+        slug = await unique_slug(con, base_slug)
+        async with con.cursor() as cur:
+            await cur.execute(
+                "INSERT INTO courses(user_id, title, slug, description, status) VALUES (%s, %s, %s, %s, 0) RETURNING id",
+                (user_id, title, slug, description),
+            )
+            course_id = (await cur.fetchone())["id"]
+
+            # executemany with no rows leaves no result to fetch, so an
+            # empty course skips the batches entirely
+            section_ids = []
+            if sections:
+                await cur.executemany(
+                    "INSERT INTO sections(course_id, title, position, status) VALUES (%s, %s, %s, 0) RETURNING id",
+                    [(course_id, sec["title"], int(sec["position"])) for sec in sections],
+                    returning=True,
+                )
+                while True:
+                    section_ids.append((await cur.fetchone())["id"])
+                    if not cur.nextset():
+                        break
+
+            lessons = [
+                (course_id, section_id, l["title"], l["description"], int(l["position"]))
+                for section_id, sec in zip(section_ids, sections)
+                for l in sec["lessons"]
+            ]
+            if lessons:
+                await cur.executemany(
+                    "INSERT INTO lessons(course_id, section_id, title, description, position, status)"
+                    " VALUES (%s, %s, %s, %s, %s, 0)",
+                    lessons,
+                )
+    await revisions.bump_user(user_id)
+    await revisions.remember_parents("section", course_id, section_ids)
+    return course_id
+
+@timed("db.get_all_courses")
+async def get_all_courses(con: AsyncConnection, user_id: int) -> List[Dict[str, Any]]:
+    async with con.cursor() as cur:
+        await cur.execute(
             """
             SELECT
                 c.id            AS id,
@@ -147,13 +416,14 @@ def get_all_courses(con: Connection, user_id: int) -> List[Dict[str, Any]]:
             """,
             (user_id,)
         )
-        rows = cur.fetchall()
+        rows = await cur.fetchall()
 
     return rows
 
-def get_sections(con: Connection, course_id: int):
-    with con.cursor() as cur:
-        cur.execute(
+@timed("db.get_sections")
+async def get_sections(con: AsyncConnection, course_id: int):
+    async with con.cursor() as cur:
+        await cur.execute(
             """
             SELECT
                 s.id        AS id,
@@ -169,19 +439,29 @@ def get_sections(con: Connection, course_id: int):
             """,
             (course_id,),
         )
-        rows = cur.fetchall()
+        rows = await cur.fetchall()
     return rows
 
-def get_lessons(con: Connection, section_id: int):
-    with con.cursor() as cur:
-        cur.execute(
+@timed("db.get_lessons")
+async def get_lessons(con: AsyncConnection, section_id: int):
+    async with con.cursor() as cur:
+        await cur.execute(
             """
             SELECT
                 l.id                       AS id,
                 l.title                    AS title,
                 l.description              AS description,
                 l.body_md                  AS body_md,
-                l.messages                 AS messages,
+                COALESCE(
+                    (SELECT json_agg(json_build_object(
+                                'id',      m.lesson_id,
+                                'seq',     m.seq,
+                                'role',    m.role,
+                                'content', m.content)
+                            ORDER BY m.seq)
+                        FROM lesson_messages m
+                        WHERE m.lesson_id = l.id),
+                    '[]'::json)            AS messages,
                 l.status                   AS status
             FROM lessons AS l
             WHERE l.section_id = %s
@@ -189,12 +469,94 @@ def get_lessons(con: Connection, section_id: int):
             """,
             (section_id,),
         )
-        rows = cur.fetchall()
+        rows = await cur.fetchall()
     return rows
 
-def get_single_lesson(con: Connection, lesson_id: int):
-    with con.cursor() as cur:
-        cur.execute(
+# optional (heavy) fields for get_course_tree; everything else (ids,
+# titles, positions, status, counts) is always included
+TREE_FIELDS = {"description", "summary", "body_md", "digest", "exercises"}
+
+@timed("db.get_course_tree")
+async def get_course_tree(con: AsyncConnection, course_id: int, fields: set = frozenset()) -> Optional[Dict[str, Any]]:
+    """
+    The whole course (sections, lessons, counts) as one JSON document built
+    by a single query. `fields` is a subset of TREE_FIELDS; only those heavy
+    columns are included. Returns None if the course doesn't exist.
+    """
+    unknown = set(fields) - TREE_FIELDS
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+
+    # projections are assembled from fixed fragments only, never from input
+    course_extra = ""
+    if "description" in fields:
+        course_extra += ", 'description', c.description"
+    if "digest" in fields:
+        course_extra += ", 'digest', c.digest"
+    section_extra = ", 'summary', s.summary" if "summary" in fields else ""
+    lesson_extra = ""
+    if "description" in fields:
+        lesson_extra += ", 'description', l.description"
+    if "summary" in fields:
+        lesson_extra += ", 'summary', l.summary"
+    if "body_md" in fields:
+        lesson_extra += ", 'body_md', l.body_md"
+    if "exercises" in fields:
+        lesson_extra += """, 'exercises', COALESCE(
+                                (SELECT json_agg(json_build_object('id', e.id, 'title', e.title) ORDER BY e.id)
+                                    FROM exercises e
+                                    WHERE e.lesson_id = l.id),
+                                '[]'::json)"""
+
+    async with con.cursor() as cur:
+        await cur.execute(
+            f"""
+            SELECT json_build_object(
+                'id',            c.id,
+                'title',         c.title,
+                'status',        c.status,
+                'section_count', (SELECT COUNT(*) FROM sections s WHERE s.course_id = c.id),
+                'lesson_count',  (SELECT COUNT(*) FROM lessons l WHERE l.course_id = c.id)
+                {course_extra},
+                'sections', COALESCE((
+                    SELECT json_agg(json_build_object(
+                        'id',           s.id,
+                        'title',        s.title,
+                        'position',     s.position,
+                        'status',       s.status,
+                        'lesson_count', (SELECT COUNT(*) FROM lessons l WHERE l.section_id = s.id),
+                        'quiz_count',   (SELECT COUNT(*) FROM quizzes q WHERE q.section_id = s.id)
+                        {section_extra},
+                        'lessons', COALESCE((
+                            SELECT json_agg(json_build_object(
+                                'id',             l.id,
+                                'title',          l.title,
+                                'position',       l.position,
+                                'status',         l.status,
+                                'has_body',       COALESCE(l.body_md, '') <> '',
+                                'exercise_count', (SELECT COUNT(*) FROM exercises e WHERE e.lesson_id = l.id)
+                                {lesson_extra}
+                            ) ORDER BY l.position)
+                            FROM lessons l
+                            WHERE l.section_id = s.id
+                        ), '[]'::json)
+                    ) ORDER BY s.position)
+                    FROM sections s
+                    WHERE s.course_id = c.id
+                ), '[]'::json)
+            ) AS tree
+            FROM courses AS c
+            WHERE c.id = %s
+            """,
+            (course_id,),
+        )
+        row = await cur.fetchone()
+    return row["tree"] if row else None
+
+@timed("db.get_single_lesson")
+async def get_single_lesson(con: AsyncConnection, lesson_id: int):
+    async with con.cursor() as cur:
+        await cur.execute(
             """
             SELECT
                 l.id            AS id,
@@ -203,43 +565,312 @@ def get_single_lesson(con: Connection, lesson_id: int):
                 l.title         AS title,
                 l.description   AS description,
                 l.body_md       AS body_md,
-                l.messages      AS messages,
                 l.summary       AS summary,
+                l.context_summary AS context_summary,
+                l.context_upto  AS context_upto,
                 l.position      AS position,
-                l.status        AS status
+                l.status        AS status,
+                l.version       AS version
             FROM lessons AS l
             WHERE l.id = %s
             """,
             (lesson_id,),
         )
-        lesson = cur.fetchone()
+        lesson = await cur.fetchone()
     return lesson 
 
-def update_lesson_sql(con: Connection, l: dict):
-    with con.cursor() as cur:
-        cur.execute(
+UPDATE_LESSON_SQL = """
+    UPDATE lessons
+    SET
+        title       = %s,
+        description = %s,
+        body_md     = %s,
+        summary     = %s,
+        context_summary = %s,
+        context_upto    = %s,
+        status      = %s,
+        version     = version + 1
+    WHERE id = %s AND version = %s
+    RETURNING version
+"""
+
+def _lesson_update_params(l: dict) -> tuple:
+    return (
+        l["title"], l["description"], l["body_md"],
+        l["summary"], l.get("context_summary"), l.get("context_upto", 0),
+        l["status"], l["id"], l.get("version", 0),
+    )
+
+@timed("db.update_lesson_sql")
+async def update_lesson_sql(con: AsyncConnection, l: dict) -> bool:
+    # False (and nothing written) if the row has changed since `l` was
+    # loaded; on success l["version"] is moved to the new version
+    async with con.cursor() as cur:
+        await cur.execute(UPDATE_LESSON_SQL, _lesson_update_params(l))
+        row = await cur.fetchone()
+    await con.commit()
+    if row is None:
+        return False
+    l["version"] = row["version"]
+    await revisions.bump_courses(l.get("course_id"))
+    return True
+
+@timed("db.update_lessons_sql")
+async def update_lessons_sql(con: AsyncConnection, lessons: List[dict]) -> List[int]:
+    """
+    Batched form of update_lesson_sql, used by write-behind flushing.
+    Returns the ids of lessons that were not written because the row had
+    changed since they were loaded.
+    """
+    async with con.cursor() as cur:
+        await cur.executemany(UPDATE_LESSON_SQL, [_lesson_update_params(l) for l in lessons], returning=True)
+        rows = []
+        while True:
+            rows.append(await cur.fetchone())
+            if not cur.nextset():
+                break
+    await con.commit()
+    stale = []
+    for l, row in zip(lessons, rows):
+        if row is None:
+            stale.append(l["id"])
+        else:
+            l["version"] = row["version"]
+    await revisions.bump_courses(*[l.get("course_id") for l, row in zip(lessons, rows) if row is not None])
+    return stale
+
+@timed("db.add_lesson_message")
+async def add_lesson_message(con: AsyncConnection, lid: int, role: str, content: str) -> int:
+    # seq is allocated from the (lesson_id, seq) primary key index, so
+    # appending never touches the rest of the transcript. Locking the
+    # lesson row first serialises concurrent appends to one lesson (two
+    # requests, or two workers), which would otherwise both read the same
+    # MAX(seq) and collide on the primary key
+    async with con.cursor() as cur:
+        await cur.execute("SELECT id FROM lessons WHERE id = %s FOR UPDATE", (lid,))
+        await cur.execute(
             """
-            UPDATE lessons
-            SET
-                title       = %s,
-                description = %s,
-                body_md     = %s,
-                messages    = %s,
-                summary     = %s,
-                status      = %s
-            WHERE id = %s
+            INSERT INTO lesson_messages(lesson_id, seq, role, content)
+            SELECT %(lid)s, COALESCE(MAX(m.seq), 0) + 1, %(role)s, %(content)s
+            FROM lesson_messages AS m
+            WHERE m.lesson_id = %(lid)s
+            RETURNING seq
             """,
-            (
-                l["title"], l["description"], l["body_md"],
-                l["messages"], l["summary"], l["status"], l["id"],
-            ),
+            {"lid": lid, "role": role, "content": content},
         )
-    con.commit()
+        seq = (await cur.fetchone())["seq"]
+    await con.commit()
+    # transcripts are part of the get_lessons response
+    await revisions.bump_courses(await lesson_course_id(con, lid))
+    return seq
+
+@timed("db.get_lesson_messages")
+async def get_lesson_messages(con: AsyncConnection, lid: int, tail: Optional[int] = None) -> List[Dict[str, Any]]:
+    # whole transcript in order, or only its last `tail` turns
+    async with con.cursor() as cur:
+        if tail is None:
+            await cur.execute(
+                """
+                SELECT
+                    m.lesson_id AS id,
+                    m.seq       AS seq,
+                    m.role      AS role,
+                    m.content   AS content
+                FROM lesson_messages AS m
+                WHERE m.lesson_id = %s
+                ORDER BY m.seq
+                """,
+                (lid,),
+            )
+        else:
+            await cur.execute(
+                """
+                SELECT id, seq, role, content
+                FROM (
+                    SELECT
+                        m.lesson_id AS id,
+                        m.seq       AS seq,
+                        m.role      AS role,
+                        m.content   AS content
+                    FROM lesson_messages AS m
+                    WHERE m.lesson_id = %s
+                    ORDER BY m.seq DESC
+                    LIMIT %s
+                ) AS t
+                ORDER BY seq
+                """,
+                (lid, tail),
+            )
+        rows = await cur.fetchall()
+    return rows
+
+async def get_lesson_messages_between(con: AsyncConnection, lid: int, after_seq: int, before_seq: int) -> List[Dict[str, Any]]:
+    # turns with after_seq < seq < before_seq, in order
+    async with con.cursor() as cur:
+        await cur.execute(
+            """
+            SELECT
+                m.lesson_id AS id,
+                m.seq       AS seq,
+                m.role      AS role,
+                m.content   AS content
+            FROM lesson_messages AS m
+            WHERE m.lesson_id = %s
+              AND m.seq > %s
+              AND m.seq < %s
+            ORDER BY m.seq
+            """,
+            (lid, after_seq, before_seq),
+        )
+        rows = await cur.fetchall()
+    return rows
 
-def get_course_info(con: Connection, course_id: int):
+# chunk numbers above this are Q&A turns, so re-chunking the body can
+# replace its own chunks without touching them, and turns still sort after
+# the body
+TURN_CHUNK_BASE = 1_000_000
+
+async def replace_lesson_chunks(con: AsyncConnection, lid: int, chunks: List[str], embeddings: List[List[float]]):
+    async with con.transaction():
+        async with con.cursor() as cur:
+            await cur.execute(
+                "DELETE FROM lesson_chunks WHERE lesson_id = %s AND chunk_no <= %s",
+                (lid, TURN_CHUNK_BASE),
+            )
+            await cur.executemany(
+                "INSERT INTO lesson_chunks(lesson_id, chunk_no, content, embedding) VALUES (%s, %s, %s, %s)",
+                [(lid, n, c, e) for n, (c, e) in enumerate(zip(chunks, embeddings), start=1)],
+            )
+
+async def add_lesson_chunk(con: AsyncConnection, lid: int, content: str, embedding: List[float]) -> int:
+    # a Q&A turn; the lesson row lock serialises concurrent turns as in
+    # add_lesson_message
+    async with con.cursor() as cur:
+        await cur.execute("SELECT id FROM lessons WHERE id = %s FOR UPDATE", (lid,))
+        await cur.execute(
+            """
+            INSERT INTO lesson_chunks(lesson_id, chunk_no, content, embedding)
+            SELECT %(lid)s, GREATEST(MAX(c.chunk_no), %(base)s) + 1, %(content)s, %(embedding)s
+            FROM lesson_chunks AS c
+            WHERE c.lesson_id = %(lid)s
+            RETURNING chunk_no
+            """,
+            {"lid": lid, "base": TURN_CHUNK_BASE, "content": content, "embedding": embedding},
+        )
+        chunk_no = (await cur.fetchone())["chunk_no"]
+    await con.commit()
+    return chunk_no
+
+@timed("db.get_lesson_chunks")
+async def get_lesson_chunks(con: AsyncConnection, lid: int) -> List[Dict[str, Any]]:
+    async with con.cursor() as cur:
+        await cur.execute(
+            """
+            SELECT
+                c.chunk_no  AS chunk_no,
+                c.content   AS content,
+                c.embedding AS embedding
+            FROM lesson_chunks AS c
+            WHERE c.lesson_id = %s
+            ORDER BY c.chunk_no
+            """,
+            (lid,),
+        )
+        rows = await cur.fetchall()
+    return rows
+
+async def migrate_lesson_messages(con: AsyncConnection):
+    # move legacy lessons.messages JSON blobs into lesson_messages rows;
+    # blobs are cleared once copied, so this is a no-op after the first run
+    async with con.cursor() as cur:
+        await cur.execute(
+            "SELECT id, messages FROM lessons WHERE messages IS NOT NULL"
+        )
+        legacy = await cur.fetchall()
+        if not legacy:
+            return
+
+        rows = []
+        for l in legacy:
+            try:
+                messages = json.loads(l["messages"])
+            except Exception:
+                messages = []
+            for seq, m in enumerate(messages, start=1):
+                rows.append((l["id"], seq, m.get("role", "application"), m.get("content") or ""))
+
+        await cur.executemany(
+            "INSERT INTO lesson_messages(lesson_id, seq, role, content) VALUES (%s, %s, %s, %s)"
+            " ON CONFLICT DO NOTHING",
+            rows,
+        )
+        await cur.execute(
+            "UPDATE lessons SET messages = NULL WHERE id = ANY(%s)",
+            ([l["id"] for l in legacy],),
+        )
+
+async def get_next_lesson_ids(con: AsyncConnection, lid: int, n: int) -> List[int]:
+    # ids of the next n not-yet-generated lessons after `lid`, in course
+    # order (section position, then lesson position)
+    async with con.cursor() as cur:
+        await cur.execute(
+            """
+            WITH cur AS (
+                SELECT
+                    l.course_id AS course_id,
+                    s.position  AS sec_pos,
+                    l.position  AS les_pos
+                FROM lessons l
+                JOIN sections s ON s.id = l.section_id
+                WHERE l.id = %s
+            )
+            SELECT l.id AS id
+            FROM lessons l
+            JOIN sections s ON s.id = l.section_id
+            JOIN cur ON l.course_id = cur.course_id
+            WHERE (s.position, l.position) > (cur.sec_pos, cur.les_pos)
+              AND l.status = 0
+              AND l.body_md IS NULL
+            ORDER BY s.position, l.position
+            LIMIT %s
+            """,
+            (lid, n),
+        )
+        rows = await cur.fetchall()
+    return [r["id"] for r in rows]
+
+async def get_first_lesson_ids(con: AsyncConnection, course_id: int, n: int) -> List[int]:
+    async with con.cursor() as cur:
+        await cur.execute(
+            """
+            SELECT l.id AS id
+            FROM lessons l
+            JOIN sections s ON s.id = l.section_id
+            WHERE l.course_id = %s
+              AND l.status = 0
+              AND l.body_md IS NULL
+            ORDER BY s.position, l.position
+            LIMIT %s
+            """,
+            (course_id, n),
+        )
+        rows = await cur.fetchall()
+    return [r["id"] for r in rows]
+
+async def get_course_lesson_ids(con: AsyncConnection, course_id: int) -> List[int]:
+    async with con.cursor() as cur:
+        await cur.execute(
+            "SELECT l.id AS id FROM lessons l WHERE l.course_id = %s",
+            (course_id,),
+        )
+        rows = await cur.fetchall()
+    return [r["id"] for r in rows]
+
+@timed("db.get_course_info")
+async def get_course_info(con: AsyncConnection, course_id: int):
     print("made it into get_course_info")
-    with con.cursor() as cur:
-        cur.execute(
+    async with con.cursor() as cur:
+        await cur.execute(
             """
             SELECT
                 c.title         AS title,
@@ -249,111 +880,178 @@ def get_course_info(con: Connection, course_id: int):
             """,
             (course_id,),
         )
-        course = cur.fetchone()
+        course = await cur.fetchone()
     return course["title"], course["description"]
 
-def get_summaries(con: Connection, c_id: int, s_id: int, l_pos: int):
+# caps on what get_summaries returns, so lesson prompts stay bounded
+# however long the course is
+SUMMARY_SECTIONS_MAX = int(os.getenv("SUMMARY_SECTIONS_MAX", "4"))
+SUMMARY_LESSONS_MAX = int(os.getenv("SUMMARY_LESSONS_MAX", "8"))
+
+@timed("db.get_summaries")
+async def get_summaries(con: AsyncConnection, c_id: int, s_id: int, l_pos: int):
 # if lesson's position = 1 and its section's position = 1,
 # this is the start of the course
 #
-# if lesson's position = 1 and its section's position > 1,
-# pull summaries from previous section(s)
-#
-# if lesson's position > 1 and its section's position = 1,
-# pull summaries from previous lessons in the section
+# earlier sections are covered by the course digest plus the summaries of
+# any sections finished since it was last folded (or, if the digest can't
+# be used, the last SUMMARY_SECTIONS_MAX section summaries)
 #
-# if lesson's position > 1 and its section's position > 1,
-# pull summaries from previous lessons in the section and previous sections
-    print("made it into get_summaries")
-    with con.cursor() as cur:
-        # first check if there are prior sections or lessons
-        cur.execute(
+# earlier lessons in the same section are covered by their own summaries
+# (the last SUMMARY_LESSONS_MAX of them)
+    async with con.cursor() as cur:
+        await cur.execute(
             """
-            SELECT position AS sec_pos
-            FROM sections
-            WHERE id = %s
+            SELECT
+                s.position      AS sec_pos,
+                c.digest        AS digest,
+                c.digest_upto   AS digest_upto
+            FROM sections AS s
+            JOIN courses AS c ON c.id = s.course_id
+            WHERE s.id = %s
             """,
             (s_id,),
         )
-        row = cur.fetchone()
+        row = await cur.fetchone()
         if row is None:
             return ""
         sec_pos = row["sec_pos"]
         if sec_pos == 1 and l_pos == 1:
             return ""
 
-        cur.execute(
+        pieces: list[str] = []
+        # the digest only ever covers a prefix of the course, so it is
+        # usable whenever that prefix ends before this section
+        if row["digest"] and 0 < row["digest_upto"] < sec_pos:
+            pieces.append(row["digest"])
+            after = row["digest_upto"]
+        else:
+            after = 0
+
+        await cur.execute(
             """
-            WITH cur AS (
-                SELECT 
-                    id       AS section_id, 
-                    course_id, 
-                    position AS sec_pos
-                FROM sections
-                WHERE id = %(sid)s
-            ),
-            prev_sections AS (
-                SELECT 
-                    s.id       AS section_id, 
-                    s.position AS sec_pos
-                FROM sections s
-                JOIN cur ON s.course_id = cur.course_id
-                WHERE s.position < cur.sec_pos
-            ),
-            stream AS (
-                SELECT
-                    s.position  AS sec_pos,
-                    0           AS kind_rank,
-                    NULL        AS lesson_pos,
-                    s.summary   AS text
-                FROM sections s
-                JOIN prev_sections ps ON ps.section_id = s.id
-            
-                UNION ALL
+            SELECT summary FROM (
+                SELECT s.position, s.summary
+                FROM sections AS s
+                WHERE s.course_id = %(cid)s
+                  AND s.position > %(after)s
+                  AND s.position < %(spos)s
+                  AND s.summary IS NOT NULL
+                ORDER BY s.position DESC
+                LIMIT %(nsec)s
+            ) AS prev
+            ORDER BY position
+            """,
+            {"cid": c_id, "after": after, "spos": sec_pos, "nsec": SUMMARY_SECTIONS_MAX},
+        )
+        pieces += [r["summary"] for r in await cur.fetchall()]
 
-                SELECT
-                    cur.sec_pos AS sec_pos,
-                    1           AS kind_rank,
-                    l.position  AS lesson_pos,
-                    l.summary   AS text
-                FROM lessons l
-                JOIN cur ON l.section_id = cur.section_id
-                WHERE l.position < %(lpos)s
-            )
-            SELECT sec_pos, kind_rank, lesson_pos, text
-            FROM stream
-            ORDER BY sec_pos ASC, kind_rank ASC, lesson_pos ASC
+        await cur.execute(
+            """
+            SELECT summary FROM (
+                SELECT l.position, l.summary
+                FROM lessons AS l
+                WHERE l.section_id = %(sid)s
+                  AND l.position < %(lpos)s
+                  AND l.summary IS NOT NULL
+                ORDER BY l.position DESC
+                LIMIT %(nles)s
+            ) AS prev
+            ORDER BY position
+            """,
+            {"sid": s_id, "lpos": l_pos, "nles": SUMMARY_LESSONS_MAX},
+        )
+        pieces += [r["summary"] for r in await cur.fetchall()]
+
+    return "\n\n".join([t.strip() for t in pieces if t and t.strip()])
+
+async def set_section_summary(con: AsyncConnection, section_id: int, summary: str) -> bool:
+    # first writer wins; marks the section finished
+    async with con.cursor() as cur:
+        await cur.execute(
+            """
+            UPDATE sections
+            SET summary = %s, status = 2
+            WHERE id = %s AND summary IS NULL
+            RETURNING course_id
+            """,
+            (summary, section_id),
+        )
+        row = await cur.fetchone()
+    await con.commit()
+    if row is not None:
+        await revisions.bump_courses(row["course_id"])
+    return row is not None
+
+async def get_course_digest(con: AsyncConnection, course_id: int):
+    async with con.cursor() as cur:
+        await cur.execute(
+            "SELECT digest, digest_upto FROM courses WHERE id = %s",
+            (course_id,),
+        )
+        row = await cur.fetchone()
+    return row["digest"], row["digest_upto"]
+
+async def get_section_summaries_after(con: AsyncConnection, course_id: int, position: int) -> List[Dict[str, Any]]:
+    async with con.cursor() as cur:
+        await cur.execute(
+            """
+            SELECT
+                s.position  AS position,
+                s.title     AS title,
+                s.summary   AS summary
+            FROM sections AS s
+            WHERE s.course_id = %s AND s.position > %s
+            ORDER BY s.position
             """,
-            {"sid": s_id, "lpos": l_pos},
+            (course_id, position),
         )
-        rows = cur.fetchall()
-    
-    pieces: list[str] = []
-    for r in rows:
-        txt = r["text"]
-        if txt:
-            t = txt.strip()
-            if t:
-                pieces.append(t)
+        rows = await cur.fetchall()
+    return rows
 
-    return "\n\n".join(pieces)
+async def update_course_digest(con: AsyncConnection, course_id: int, digest: str, upto: int, prev_upto: int) -> bool:
+    # compare-and-set on digest_upto, so a concurrent fold can't be lost
+    async with con.cursor() as cur:
+        await cur.execute(
+            """
+            UPDATE courses
+            SET digest = %s, digest_upto = %s
+            WHERE id = %s AND digest_upto = %s
+            RETURNING id
+            """,
+            (digest, upto, course_id, prev_upto),
+        )
+        updated = await cur.fetchone() is not None
+    await con.commit()
+    if updated:
+        await revisions.bump_courses(course_id)
+    return updated
 
-def get_future_lessons(con: Connection, c_id: int, s_id: int, l_pos: int):
+async def get_future_lessons(con: AsyncConnection, c_id: int, s_id: int, l_pos: int):
 # pull all titles from lessons after l_pos to the end of the section
     pass
 
-def create_user(con: Connection, username: str, password: str):
-    with con.cursor() as cur:
-        cur.execute(
+async def create_user(con: AsyncConnection, username: str, password: str):
+    async with con.cursor() as cur:
+        await cur.execute(
             "INSERT INTO users(username, password_hash) VALUES (%s, %s) RETURNING id",
             (username, password),
         )
-        new_id = cur.fetchone()["id"]
-    con.commit()
+        new_id = (await cur.fetchone())["id"]
+    await con.commit()
+
+async def update_password_hash(con: AsyncConnection, user_id: int, password_hash: str):
+    async with con.cursor() as cur:
+        await cur.execute(
+            "UPDATE users SET password_hash = %s WHERE id = %s",
+            (password_hash, user_id),
+        )
+    await con.commit()
 
-def get_user_by_username(con: Connection, username: str):
-    with con.cursor() as cur:
-        cur.execute(
+@timed("db.get_user_by_username")
+async def get_user_by_username(con: AsyncConnection, username: str):
+    async with con.cursor() as cur:
+        await cur.execute(
             """
             SELECT
                 u.id            AS id,
@@ -364,12 +1062,12 @@ def get_user_by_username(con: Connection, username: str):
             """,
             (username,),
         )
-        user = cur.fetchone()
+        user = await cur.fetchone()
     return user
 
-def get_user_by_id(con: Connection, uid: int):
-    with con.cursor() as cur:
-        cur.execute(
+async def get_user_by_id(con: AsyncConnection, uid: int):
+    async with con.cursor() as cur:
+        await cur.execute(
             """
             SELECT
                 u.id            AS id,
@@ -382,35 +1080,63 @@ def get_user_by_id(con: Connection, uid: int):
             """,
             (uid,),
         )
-        user = cur.fetchone()
+        user = await cur.fetchone()
     return user
 
-def push_exercise_to_sql(con: Connection, lid: int, title: str, exercise: str, solution: str):
-    with con.cursor() as cur:
-        cur.execute(
-            "INSERT INTO exercises(lesson_id, title, exercise, solution) VALUES (%s, %s, %s, %s, %s)",
+async def push_exercise_to_sql(con: AsyncConnection, lid: int, title: str, exercise: str, solution: str):
+    async with con.cursor() as cur:
+        await cur.execute(
+            "INSERT INTO exercises(lesson_id, title, exercise, solution) VALUES (%s, %s, %s, %s)",
             (lid, title, exercise, solution),
         )
-    con.commit()
+    await con.commit()
+    await revisions.bump_courses(await lesson_course_id(con, lid))
 
-def get_exercise(con: Connection, eid: int) -> Dict[str, Any]:
-    with con.cursor() as cur:
-        cur.execute("""
+@timed("db.create_exercises")
+async def create_exercises(con: AsyncConnection, lid: int, exercises: List[Dict[str, Any]]) -> List[int]:
+    """
+    Insert a batch of exercises for one lesson in one transaction
+    (executemany, pipelined). Each item has title, exercise and solution.
+    Returns the new ids in input order.
+    """
+    if not exercises:
+        return []
+    ids = []
+    async with con.transaction():
+        async with con.cursor() as cur:
+            await cur.executemany(
+                "INSERT INTO exercises(lesson_id, title, exercise, solution) VALUES (%s, %s, %s, %s) RETURNING id",
+                [(lid, e["title"], e["exercise"], e["solution"]) for e in exercises],
+                returning=True,
+            )
+            while True:
+                ids.append((await cur.fetchone())["id"])
+                if not cur.nextset():
+                    break
+    await revisions.bump_courses(await lesson_course_id(con, lid))
+    return ids
+
+async def get_exercise(con: AsyncConnection, eid: int) -> Dict[str, Any]:
+    async with con.cursor() as cur:
+        await cur.execute("""
             SELECT
+                e.id            as id,
+                e.title         as title,
                 e.exercise      as exercise,
-                e.solution      as solution,
+                e.solution      as solution
             FROM exercises AS e
             WHERE
                 e.id = %s
             """,
             (eid,),
         )
-        exercise = cur.fetchone()
+        exercise = await cur.fetchone()
     return exercise
 
-def get_all_exercises(con: Connection, lid: int) -> List[Dict[str, Any]]:
-    with con.cursor() as cur:
-        cur.execute("""
+@timed("db.get_all_exercises")
+async def get_all_exercises(con: AsyncConnection, lid: int) -> List[Dict[str, Any]]:
+    async with con.cursor() as cur:
+        await cur.execute("""
             SELECT
                 e.id    as id,
                 e.title as title
@@ -420,5 +1146,100 @@ def get_all_exercises(con: Connection, lid: int) -> List[Dict[str, Any]]:
             """,
             (lid,),
         )
-        rows = cur.fetchall()
+        rows = await cur.fetchall()
+    return rows
+
+async def get_section(con: AsyncConnection, section_id: int):
+    async with con.cursor() as cur:
+        await cur.execute(
+            """
+            SELECT
+                s.id        AS id,
+                s.course_id AS course_id,
+                s.title     AS title,
+                s.summary   AS summary,
+                s.position  AS position,
+                s.status    AS status
+            FROM sections AS s
+            WHERE s.id = %s
+            """,
+            (section_id,),
+        )
+        section = await cur.fetchone()
+    return section
+
+async def get_section_lessons(con: AsyncConnection, section_id: int) -> List[Dict[str, Any]]:
+    async with con.cursor() as cur:
+        await cur.execute(
+            """
+            SELECT
+                l.id        AS id,
+                l.course_id AS course_id,
+                l.title     AS title,
+                l.summary   AS summary,
+                l.status    AS status
+            FROM lessons AS l
+            WHERE l.section_id = %s
+            ORDER BY l.position
+            """,
+            (section_id,),
+        )
+        rows = await cur.fetchall()
+    return rows
+
+@timed("db.create_quizzes")
+async def create_quizzes(con: AsyncConnection, course_id: int, section_id: int, questions: List[Dict[str, Any]]) -> List[int]:
+    """
+    Insert all questions for a section in one transaction (executemany,
+    pipelined). Positions are course-wide, so the course row is locked
+    while the next positions are taken. Does nothing if the section
+    already has questions. Returns the new ids in input order.
+    """
+    ids = []
+    async with con.transaction():
+        async with con.cursor() as cur:
+            await cur.execute("SELECT id FROM courses WHERE id = %s FOR UPDATE", (course_id,))
+            await cur.execute("SELECT 1 FROM quizzes WHERE section_id = %s LIMIT 1", (section_id,))
+            if not questions or await cur.fetchone() is not None:
+                return ids
+            await cur.execute(
+                "SELECT COALESCE(MAX(position), 0) AS last FROM quizzes WHERE course_id = %s",
+                (course_id,),
+            )
+            last = (await cur.fetchone())["last"]
+            await cur.executemany(
+                "INSERT INTO quizzes(course_id, section_id, quiz, options, answer, position, status)"
+                " VALUES (%s, %s, %s, %s, %s, %s, 0) RETURNING id",
+                [
+                    (course_id, section_id, q["quiz"], json.dumps(q["options"]), q["answer"], last + n)
+                    for n, q in enumerate(questions, start=1)
+                ],
+                returning=True,
+            )
+            while True:
+                ids.append((await cur.fetchone())["id"])
+                if not cur.nextset():
+                    break
+    await revisions.bump_courses(course_id)
+    return ids
+
+@timed("db.get_quizzes")
+async def get_quizzes(con: AsyncConnection, section_id: int) -> List[Dict[str, Any]]:
+    async with con.cursor() as cur:
+        await cur.execute(
+            """
+            SELECT
+                q.id            AS id,
+                q.quiz          AS quiz,
+                q.options::json AS options,
+                q.answer        AS answer,
+                q.position      AS position,
+                q.status        AS status
+            FROM quizzes AS q
+            WHERE q.section_id = %s
+            ORDER BY q.position
+            """,
+            (section_id,),
+        )
+        rows = await cur.fetchall()
     return rows
@@ -0,0 +1,69 @@
+# Revision counters for cached read responses.
+#
+# Every course has a counter in Redis, bumped by the write paths in
+# courses/database.py after they commit; each user has one for their course
+# list. Read endpoints derive ETags and response-cache keys from these
+# counters (see api_helpers/response_cache.py), so answering a repeat
+# request costs a Redis round-trip, not a query.
+#
+# Counters start from the current time in milliseconds, not from 0, so a
+# Redis restart can't bring back a revision a client already holds.
+#
+# Section -> course and lesson -> course mappings never change, so they are
+# kept in Redis too; endpoints keyed by section or lesson then find their
+# course's counter without asking Postgres.
+
+import time, traceback
+
+from api_helpers.session_helpers import r
+
+# mappings are immutable; the TTL only bounds memory for abandoned courses
+PARENT_TTL = 60 * 60 * 24 * 30
+
+def course_key(course_id) -> str:
+    return f"rev:course:{course_id}"
+
+def user_key(user_id) -> str:
+    return f"rev:user:{user_id}"
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
+
+async def current(key: str) -> int:
+    pipe = r.pipeline(transaction=False)
+    pipe.set(key, _now_ms(), nx=True)
+    pipe.get(key)
+    _, rev = await pipe.execute()
+    return int(rev)
+
+async def _bump(keys):
+    # called after the write has committed; a failure here leaves caches
+    # stale only until their TTL, so it is logged rather than raised
+    try:
+        pipe = r.pipeline(transaction=False)
+        for key in keys:
+            pipe.set(key, _now_ms(), nx=True)
+            pipe.incr(key)
+        await pipe.execute()
+    except Exception:
+        traceback.print_exc()
+
+async def bump_courses(*course_ids):
+    ids = {c for c in course_ids if c is not None}
+    if ids:
+        await _bump([course_key(c) for c in ids])
+
+async def bump_user(user_id):
+    if user_id is not None:
+        await _bump([user_key(user_id)])
+
+async def parent_course(kind: str, child_id: int):
+    # kind is "section" or "lesson"; None if not known yet
+    course_id = await r.get(f"parent:{kind}:{child_id}")
+    return int(course_id) if course_id is not None else None
+
+async def remember_parents(kind: str, course_id: int, child_ids):
+    pipe = r.pipeline(transaction=False)
+    for child_id in child_ids:
+        pipe.set(f"parent:{kind}:{child_id}", course_id, ex=PARENT_TTL)
+    await pipe.execute()
@@ -2,45 +2,146 @@ from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.runnables.history import RunnableWithMessageHistory
 from langchain_core.output_parsers import BaseOutputParser
 from langchain_core.chat_history import BaseChatMessageHistory
-from langchain_core.chat_history import InMemoryChatMessageHistory
+from langchain_core.messages import BaseMessage, message_to_dict, messages_from_dict
 
-import json
+import os, json
 from textwrap import dedent
+from typing import Sequence
 
-from psycopg import Connection
+from psycopg import AsyncConnection
+from redis import Redis
 
 from llm_operations.llm_class import LLM
 from llm_operations.course_building.build_utilities import _slugify, _validate_draft
+from api_helpers.session_helpers import r, REDIS_URL
+from api_helpers.cache_helpers import LRUCache
 import courses.database as db 
+import llm_operations.course_teaching.pregeneration as pregeneration
+from api_helpers.helper_functions import spawn_background
+
+# build sessions live in Redis so they are per-user, expire on their own and
+# are visible to every uvicorn worker
+BUILD_SESSION_TTL = int(os.getenv("BUILD_SESSION_TTL", str(60 * 60 * 6)))
+BUILD_HISTORY_MAX = int(os.getenv("BUILD_HISTORY_MAX", "20"))
+# in-process front cache for the chat history of hot sessions; it assumes a
+# session keeps hitting the same worker, so set BUILD_CACHE_TTL=0 to disable
+# it without affinity. Drafts are always read from Redis, since approving
+# one must see the latest version whichever worker wrote it
+BUILD_CACHE_SIZE = int(os.getenv("BUILD_CACHE_SIZE", "256"))
+BUILD_CACHE_TTL = float(os.getenv("BUILD_CACHE_TTL", "30"))
+
+def _history_key(session_id: str) -> str:
+    return f"build:history:{session_id}"
+
+def _draft_key(session_id: str) -> str:
+    return f"build:draft:{session_id}"
+
+_sync_r = None
+
+def _sync_redis() -> Redis:
+    # blocking client for the sync history interface, which LangChain only
+    # uses outside the event loop
+    global _sync_r
+    if _sync_r is None:
+        _sync_r = Redis.from_url(REDIS_URL, decode_responses=True)
+    return _sync_r
+
+def _encode(messages: Sequence[BaseMessage]) -> list[str]:
+    return [json.dumps(message_to_dict(m)) for m in messages]
+
+def _decode(raw: list[str]) -> list[BaseMessage]:
+    return messages_from_dict([json.loads(m) for m in raw])
+
+class RedisBuildHistory(BaseChatMessageHistory):
+    """
+    Chat history for one course-build session, stored as a capped Redis list.
+    RunnableWithMessageHistory uses the async methods under ainvoke; the
+    sync ones (messages, add_messages, clear) go straight to Redis through
+    a blocking client and bypass the front cache.
+    """
+
+    def __init__(self, session_id: str):
+        self.key = _history_key(session_id)
+
+    @property
+    def messages(self) -> list[BaseMessage]:
+        return _decode(_sync_redis().lrange(self.key, 0, -1))
+
+    async def aget_messages(self) -> list[BaseMessage]:
+        cached = CourseBuildSession._cache.get(self.key)
+        if cached is not None:
+            return list(cached)
+        messages = _decode(await r.lrange(self.key, 0, -1))
+        CourseBuildSession._cache.set(self.key, messages)
+        return list(messages)
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        pipe = _sync_redis().pipeline(transaction=True)
+        pipe.rpush(self.key, *_encode(messages))
+        pipe.ltrim(self.key, -BUILD_HISTORY_MAX, -1)
+        pipe.expire(self.key, BUILD_SESSION_TTL)
+        pipe.execute()
+        CourseBuildSession._cache.pop(self.key)
+
+    async def aadd_messages(self, messages: Sequence[BaseMessage]) -> None:
+        pipe = r.pipeline(transaction=True)
+        pipe.rpush(self.key, *_encode(messages))
+        pipe.ltrim(self.key, -BUILD_HISTORY_MAX, -1)
+        pipe.expire(self.key, BUILD_SESSION_TTL)
+        await pipe.execute()
+
+        cached = CourseBuildSession._cache.get(self.key)
+        if cached is not None:
+            CourseBuildSession._cache.set(self.key, (cached + list(messages))[-BUILD_HISTORY_MAX:])
+
+    def clear(self) -> None:
+        CourseBuildSession._cache.pop(self.key)
+        _sync_redis().delete(self.key)
+
+    async def aclear(self) -> None:
+        CourseBuildSession._cache.pop(self.key)
+        await r.delete(self.key)
 
 class CourseBuildSession:
-    _session = {}
-    _draft = {}
+    _cache = LRUCache(maxsize=BUILD_CACHE_SIZE, ttl=BUILD_CACHE_TTL)
 
     @staticmethod
     def get_history(session_id: str):
-        return CourseBuildSession._session.setdefault(session_id, InMemoryChatMessageHistory())
+        return RedisBuildHistory(session_id)
     
     @staticmethod
-    def set_draft(draft: dict):
-        CourseBuildSession._draft = draft
+    async def set_draft(session_id: str, draft: dict):
+        await r.set(_draft_key(session_id), json.dumps(draft), ex=BUILD_SESSION_TTL)
         print(f"{draft}")
 
     @staticmethod
-    def get_draft():
-        return CourseBuildSession._draft
+    async def get_draft(session_id: str):
+        raw = await r.get(_draft_key(session_id))
+        return json.loads(raw) if raw else {}
+
+    @staticmethod
+    async def take_draft(session_id: str):
+        # get and delete in one step, so of two concurrent approvals (on
+        # any workers) only one gets the draft
+        raw = await r.getdel(_draft_key(session_id))
+        return json.loads(raw) if raw else {}
 
     @staticmethod
-    def reset_draft():
-        CourseBuildSession._draft = {}
+    async def restore_draft(session_id: str, draft: dict):
+        # put a taken draft back, unless a newer one has been set meanwhile
+        await r.set(_draft_key(session_id), json.dumps(draft), ex=BUILD_SESSION_TTL, nx=True)
+
+    @staticmethod
+    async def reset_draft(session_id: str):
+        await r.delete(_draft_key(session_id))
 
 # export
-def set_draft(draft: dict):
-    CourseBuildSession.set_draft(draft)
+async def set_draft(session_id: str, draft: dict):
+    await CourseBuildSession.set_draft(session_id, draft)
 
 # export
-def get_draft():
-    return CourseBuildSession.get_draft()
+async def get_draft(session_id: str):
+    return await CourseBuildSession.get_draft(session_id)
 
 class JsonOutputParser(BaseOutputParser):
     def parse(self, text: str):
@@ -82,7 +183,7 @@ COURSE_PROMPT = ChatPromptTemplate.from_messages([
     ("human", "{input}")
 ])
 
-def build_course(message: str, session_id: str="buildcourse"):
+async def build_course(message: str, session_id: str="buildcourse"):
     model = LLM.get_llm().bind(
             format="json", 
             options={
@@ -101,61 +202,39 @@ def build_course(message: str, session_id: str="buildcourse"):
 
     cfg = {"configurable": {"session_id": session_id}}
 
-    return chain_with_memory.invoke({"input": message}, cfg)
+    return await chain_with_memory.ainvoke({"input": message}, cfg)
 
-def approve_course(con: Connection, session_id: str, user_id: int) -> int:
+async def approve_course(con: AsyncConnection, session_id: str, user_id: int) -> int:
     """
     Pull the last AI draft for `session_id`, parse/validate it, and write to Postres.
     Returns the new course_id.
     """
-    # 1) get the approved draft
+    # 1) take the approved draft; the key is deleted as it is read, so a
+    # repeated or concurrent approval finds nothing to approve
     cbs = CourseBuildSession
-    draft = cbs.get_draft()
-
-    # 2) validate & normalize
-    title, description, sections = _validate_draft(draft)
-    slug = _slugify(title)
-
-    # 3) upsert-ish slug guard (optional): ensure unique slugs by suffixing -2, -3, ...
-    def _ensure_unique_slug(con: Connection, base_slug: str) -> str:
-        s = base_slug
-        n = 1
-        while True:
-            with con.cursor() as cur:
-                row = cur.execute("SELECT 1 FROM courses WHERE slug = %s LIMIT 1", (s,)).fetchone()
-                if not row:
-                    return s
-            n += 1
-            s = f"{base_slug}-{n}"
-
-    # 4) write to DB: transactionally
+    draft = await cbs.take_draft(session_id)
+
     try:
-        unique_slug = _ensure_unique_slug(con, slug)
-        course_id = db.create_course(
-            con, user_id=user_id, title=title, slug=unique_slug, description=description
+        # 2) validate & normalize
+        title, description, sections = _validate_draft(draft)
+        slug = _slugify(title)
+
+        # 3) write to DB in a single transaction; the slug is made unique
+        # (suffixed -2, -3, ...) inside the same transaction
+        course_id = await db.create_course_tree(
+            con,
+            user_id=user_id,
+            title=title,
+            base_slug=slug,
+            description=description,
+            sections=sections,
         )
-
-        # iterate the *normalized* sections
-        for sec in sections:
-            section_id = db.create_section(
-                con,
-                course_id=course_id,
-                title=sec["title"].strip(),
-                position=int(sec["position"]),
-            )
-
-            # nest lessons under their section
-            for l in sec["lessons"]:
-                db.create_lesson(
-                    con,
-                    course_id=course_id,
-                    section_id=section_id,
-                    title=l["title"].strip(),
-                    description=l["description"],
-                    position=int(l["position"]),
-                )
-
-        cbs.reset_draft()
-        return course_id
-    finally:
-        print("Added course to database")
+    except Exception:
+        # nothing was written, so the draft can still be fixed and approved
+        if draft:
+            await cbs.restore_draft(session_id, draft)
+        raise
+    print("Added course to database")
+    # get the opening lessons ready before the learner opens them
+    spawn_background(pregeneration.enqueue_course(course_id))
+    return course_id
@@ -27,28 +27,36 @@ ROUTER_PROMPT = ChatPromptTemplate.from_messages([
     ("human", "{input}")
 ])
 
-def route_course_message(message: str, session_id: str="buildcourse"):
-    routes = {
-            "build": RunnableLambda(lambda x: build_course(
+async def route_course_message(message: str, session_id: str="buildcourse"):
+    # the routes are coroutines, so they are wrapped in async functions
+    # (a lambda would hand RouterRunnable an un-awaited coroutine)
+    async def _build(x):
+        return await build_course(
                 message=x["message"],
                 session_id=x["session_id"],
-                )),
-            "approve": RunnableLambda(lambda x: approve_course(
+                )
+
+    async def _approve(x):
+        return await approve_course(
                 session_id=x["session_id"]
-                ))
+                )
+
+    routes = {
+            "build": RunnableLambda(_build),
+            "approve": RunnableLambda(_approve)
     }
 
     router = RouterRunnable(runnables=routes)
-    llm = LLM.get_llm()
+    llm = LLM.get_llm(purpose="route")
 
     router_chain = ROUTER_PROMPT | llm
 
-    route_key = router_chain.invoke({"input": message})
+    route_key = await router_chain.ainvoke({"input": message})
 
     formatted_key = route_key.content.replace(" ", "")
     print(f"Route key = {formatted_key}")
     
-    result = router.invoke({
+    result = await router.ainvoke({
         "key": formatted_key, 
         "input": {
             "message": message,
@@ -15,38 +15,192 @@
 # - if body_md does not have content, simply display messages, with no option
 #   to continue
 
-import os, json
-import psycopg
+import os, time, asyncio, traceback
 
 import courses.database as db
 import llm_operations.course_teaching.lesson_helpers as hlpr
+import llm_operations.course_teaching.lesson_retrieval as retrieval
+from api_helpers.cache_helpers import LRUCache
+from api_helpers.helper_functions import spawn_background
+from api_helpers.metrics import span, timed
+from llm_operations.single_flight import single_flight
+from llm_operations.scheduler import priority_override, BULK
+from api_helpers.session_helpers import r
+import llm_operations.course_teaching.pregeneration as pregeneration
+import llm_operations.course_teaching.section_rollup as rollup
+import llm_operations.quiz_design.quiz_designer as quiz_designer
 
-DB_PATH = os.environ["DATABASE_URL"]
+# how many of the most recent turns are kept with a lesson in memory; the
+# full transcript stays in lesson_messages
+MESSAGE_TAIL = int(os.getenv("LESSON_MESSAGE_TAIL", "50"))
+
+# lesson state cache and write-behind settings
+LESSON_CACHE_SIZE = int(os.getenv("LESSON_CACHE_SIZE", "512"))
+LESSON_CACHE_TTL = float(os.getenv("LESSON_CACHE_TTL", "900"))
+LESSON_FLUSH_INTERVAL = float(os.getenv("LESSON_FLUSH_INTERVAL", "2"))
+# how long the cross-worker "this lesson has been started" marker lives
+START_CLAIM_TTL = int(os.getenv("LESSON_START_CLAIM_TTL", "600"))
+
+class StaleLesson(Exception):
+    def __init__(self, lesson_id: int):
+        super().__init__("This lesson was changed in another session, please retry")
+        self.lesson_id = lesson_id
 
 class LessonSession:
-    _session = {}
+    """
+    In-process state of lessons in progress, written back to Postgres by
+    a periodic flush.
+
+    Every caller in this worker shares one dict per lesson (concurrent
+    loads are coalesced), and the dict is the source of truth until it is
+    flushed. Deployments with several workers should route a lesson's
+    requests to one worker (sticky routing by lesson id); without it, the
+    version check in db.update_lessons_sql refuses the write of a copy
+    that another worker has already overwritten, and that copy is dropped
+    so the next turn reloads the current row.
+
+    Flushes and write-throughs take turns (one lock), so a write-through
+    always sends the version a concurrent flush has just moved the row to.
+    """
+    # lessons in progress, bounded by size and age
+    _cache = LRUCache(maxsize=LESSON_CACHE_SIZE, ttl=LESSON_CACHE_TTL)
+    # lessons changed since the last flush; a dirty lesson is never lost to
+    # eviction because it is held here until it has been written
+    _dirty = {}
+    # the batch a flush is writing, until it commits; like _dirty it keeps
+    # these lessons reachable if the cache evicts them meanwhile
+    _inflight = {}
+    # lesson_id -> task loading it from Postgres
+    _loading = {}
+    # serialises flush and push_to_sql (created on first use, in the loop)
+    _write_lock = None
+    _flusher = None
+    _flush_stats = {"flushes": 0, "rows": 0, "errors": 0, "stale": 0, "seconds_total": 0.0, "seconds_max": 0.0}
 
     @staticmethod
-    def get_lesson(lesson_id: int):
-        lesson = LessonSession._session.get(lesson_id)
+    async def get_lesson(lesson_id: int):
+        lesson = LessonSession._cache.get(lesson_id)
+        if lesson is None:
+            lesson = LessonSession._dirty.get(lesson_id) or LessonSession._inflight.get(lesson_id)
         if lesson is not None:
             return lesson
-        else:
-            con = db.open_db()
-            LessonSession._session[lesson_id] = db.get_single_lesson(con, lesson_id)
-            return LessonSession._session[lesson_id]
+        # one load per lesson, however many requests miss at once
+        task = LessonSession._loading.get(lesson_id)
+        if task is None:
+            task = asyncio.create_task(LessonSession._load(lesson_id))
+            LessonSession._loading[lesson_id] = task
+            task.add_done_callback(lambda _: LessonSession._loading.pop(lesson_id, None))
+        return await asyncio.shield(task)
+
+    @staticmethod
+    async def _load(lesson_id: int):
+        with span("lesson.load"):
+            async with db.connection() as con:
+                lesson = await db.get_single_lesson(con, lesson_id)
+                if lesson is None:
+                    return None
+                lesson["messages"] = await db.get_lesson_messages(con, lesson_id, tail=MESSAGE_TAIL)
+        LessonSession._cache.set(lesson_id, lesson)
+        return lesson
+
+    @staticmethod
+    async def update_lesson(lesson_id: int, lesson):
+        # write-behind: the row is written by the next flush, so repeated
+        # turns on the same lesson coalesce into one UPDATE
+        LessonSession._cache.set(lesson_id, lesson)
+        LessonSession._dirty[lesson_id] = lesson
+
+    @staticmethod
+    def _lock() -> asyncio.Lock:
+        if LessonSession._write_lock is None:
+            LessonSession._write_lock = asyncio.Lock()
+        return LessonSession._write_lock
+
+    @staticmethod
+    @timed("lesson.write_through")
+    async def push_to_sql(lesson):
+        # write-through, for transitions that must be durable right away
+        async with LessonSession._lock():
+            LessonSession._dirty.pop(lesson["id"], None)
+            LessonSession._cache.set(lesson["id"], lesson)
+            async with db.connection() as con:
+                written = await db.update_lesson_sql(con, lesson)
+        if not written:
+            LessonSession._flush_stats["stale"] += 1
+            LessonSession.invalidate(lesson["id"])
+            raise StaleLesson(lesson["id"])
+
+    @staticmethod
+    def invalidate(lesson_id: int):
+        LessonSession._cache.pop(lesson_id)
+
+    @staticmethod
+    async def flush():
+        async with LessonSession._lock():
+            await LessonSession._flush()
 
     @staticmethod
-    def update_lesson(lesson_id: int, lesson):
-        LessonSession._session[lesson_id] = lesson
-        LessonSession.push_to_sql(lesson)
+    async def _flush():
+        if not LessonSession._dirty:
+            return
+        LessonSession._inflight = LessonSession._dirty
+        LessonSession._dirty = {}
+        batch = list(LessonSession._inflight.values())
+        stats = LessonSession._flush_stats
+        start = time.perf_counter()
+        try:
+            with span("lesson.flush"):
+                async with db.connection() as con:
+                    stale = await db.update_lessons_sql(con, batch)
+        except Exception:
+            stats["errors"] += 1
+            # put the batch back unless a newer version is already waiting
+            for l in batch:
+                LessonSession._dirty.setdefault(l["id"], l)
+            raise
+        finally:
+            LessonSession._inflight = {}
+        for lid in stale:
+            # another worker wrote this lesson after we loaded it; its row
+            # wins and our copy is dropped
+            print(f"lesson {lid} was changed by another worker; dropping stale copy")
+            stats["stale"] += 1
+            LessonSession._dirty.pop(lid, None)
+            LessonSession.invalidate(lid)
+        elapsed = time.perf_counter() - start
+        stats["flushes"] += 1
+        stats["rows"] += len(batch)
+        stats["seconds_total"] += elapsed
+        stats["seconds_max"] = max(stats["seconds_max"], elapsed)
 
     @staticmethod
-    def push_to_sql(lesson):
-        con = db.open_db()
-        db.update_lesson_sql(con, lesson)
-        con.commit()
-        LessonSession._session = {}
+    async def _flush_loop():
+        while True:
+            await asyncio.sleep(LESSON_FLUSH_INTERVAL)
+            try:
+                await LessonSession.flush()
+            except Exception:
+                traceback.print_exc()
+
+    @staticmethod
+    def start():
+        if LessonSession._flusher is None:
+            LessonSession._flusher = asyncio.create_task(LessonSession._flush_loop())
+
+    @staticmethod
+    async def stop():
+        if LessonSession._flusher is not None:
+            LessonSession._flusher.cancel()
+            LessonSession._flusher = None
+        await LessonSession.flush()
+
+    @staticmethod
+    def stats() -> dict:
+        return {
+            **LessonSession._cache.stats(),
+            "dirty": len(LessonSession._dirty),
+            **LessonSession._flush_stats,
+        }
 
 def iterate_body_md(body_md: str):
     parts = body_md.split("\n\n", 1)
@@ -54,55 +208,344 @@ def iterate_body_md(body_md: str):
     rest = parts[1] if len(parts) > 1 else ""
     return first_paragraph, rest
 
-def add_message(lesson, lid, new_message, role):
-    raw = lesson["messages"]
+async def add_message(lesson, lid, new_message, role):
+    async with db.connection() as con:
+        seq = await db.add_lesson_message(con, lid, role, new_message)
+
+    lesson["messages"].append(hlpr.format_as_ChatMsg(lid, role, new_message, seq))
+    del lesson["messages"][:-MESSAGE_TAIL]
+
+async def get_transcript(lid: int) -> str:
+    # the whole conversation, for summaries (the lesson itself only
+    # carries the tail)
+    async with db.connection() as con:
+        messages = await db.get_lesson_messages(con, lid)
+    return hlpr.format_turns(messages)
+ 
+async def build_answer_context(lesson, lid) -> str:
+    # keep the context for ANSWER_PROMPT within CONTEXT_TOKEN_BUDGET: the
+    # most recent turns go in verbatim and everything older lives in the
+    # lesson's rolling context_summary. When the verbatim turns outgrow
+    # their share of the budget, the oldest are folded into the summary
+    # until they fill about half of it, so folding happens once every few
+    # questions, not on every one
+    summary = lesson.get("context_summary") or ""
+    upto = lesson.get("context_upto") or 0
+    budget = max(hlpr.CONTEXT_TOKEN_BUDGET - hlpr.estimate_tokens(summary), hlpr.CONTEXT_TOKEN_BUDGET // 2)
+
+    unfolded = [m for m in lesson["messages"] if m["seq"] > upto]
+    # turns older than the in-memory tail that were never folded
+    missing = bool(unfolded) and unfolded[0]["seq"] > upto + 1
+    size = sum(hlpr.estimate_tokens(m["content"]) for m in unfolded)
+
+    if unfolded and (missing or size > budget):
+        keep, kept = [], 0
+        for m in reversed(unfolded):
+            t = hlpr.estimate_tokens(m["content"])
+            if keep and kept + t > budget // 2:
+                break
+            keep.insert(0, m)
+            kept += t
+        first_kept = keep[0]["seq"]
+        if first_kept > upto + 1:
+            async with db.connection() as con:
+                older = await db.get_lesson_messages_between(con, lid, upto, first_kept)
+            summary = await hlpr.fold_context_summary(summary, older)
+            lesson["context_summary"] = summary
+            lesson["context_upto"] = first_kept - 1
+        unfolded = keep
+
+    recent = ".\n\n".join([m["content"] for m in unfolded])
+    if summary:
+        return f"Notes on the conversation so far:\n{summary}\n\nMost recent messages:\n{recent}"
+    return recent
+
+async def build_reference(lid, question) -> str:
+    # top-k lesson chunks for the question; answering still works (just
+    # ungrounded) if the embedding backend is unavailable
     try:
-        messages = json.loads(raw)
+        return "\n\n".join(await retrieval.retrieve(lid, question))
     except Exception:
-        messages = []
+        traceback.print_exc()
+        return ""
 
-    messages.append(hlpr.format_as_ChatMsg(lid, role, new_message));
-    lesson["messages"] = json.dumps(messages)
- 
-def iterate_lesson(message: str, session_id: str):
+def _generation_key(lid) -> str:
+    return f"lesson:{lid}:generate"
+
+async def _claim_start(ls, lesson, lid) -> bool:
+    # exactly one request records the start of a lesson, however many
+    # (double-click, second tab, other worker) asked for it. The in-process
+    # check and set happen before any await; the Redis marker covers other
+    # workers, whose copy of the lesson may be stale
+    if lesson["status"] != 0:
+        return False
+    lesson["status"] = 1
+    if not await r.set(f"lesson:{lid}:started", 1, nx=True, ex=START_CLAIM_TTL):
+        # started elsewhere; drop our stale copy so the next turn reloads it
+        lesson["status"] = 0
+        ls.invalidate(lid)
+        return False
+    return True
+
+def _follower_response(body_md):
+    # answer a duplicate "Start" with the same opening paragraph, without
+    # appending it to the transcript a second time
+    first_paragraph, rest = iterate_body_md(body_md)
+    return {"response": first_paragraph, "status": 1, "body_md": rest}
+
+def _current_response(lesson):
+    # "Start" on a lesson that is already under way: repeat the latest
+    # lesson message instead of generating anything
+    last = next((m["content"] for m in reversed(lesson["messages"]) if m["role"] == "application"), "")
+    return {"response": last, "status": lesson["status"], "body_md": lesson["body_md"]}
+
+def _paragraph_ready(body_md: str) -> bool:
+    # a whole paragraph is buffered and something already follows it, so
+    # the remaining body_md never looks finished ("") while the model is
+    # still writing
+    cut = body_md.find("\n\n")
+    return cut != -1 and body_md[cut + 2:].strip() != ""
+
+class BodyStream:
+    """
+    A lesson body being generated in the background. Tokens are appended to
+    lesson["body_md"] as the model emits them, so "Start" can return the
+    first paragraph as soon as it is complete and "Continue" only ever
+    waits for the next one.
+
+    Requests that find a stream running use `stream.lesson`, the dict it
+    writes into, rather than their own copy of the lesson: a copy loaded
+    after the stream opened never sees its tokens.
+    """
+    _streams = {}
+
+    def __init__(self, lesson):
+        self.lesson = lesson
+        self.text = ""  # everything generated so far
+        self.done = False
+        self.error = None
+        self._cond = asyncio.Condition()
+
+    @staticmethod
+    def get(lid: int):
+        return BodyStream._streams.get(lid)
+
+    @staticmethod
+    def open(lesson, lid: int):
+        stream = BodyStream._streams.get(lid)
+        if stream is None:
+            stream = BodyStream(lesson)
+            BodyStream._streams[lid] = stream
+            lesson["body_md"] = ""
+            spawn_background(stream._run(lesson, lid))
+        return stream
+
+    async def _notify(self):
+        async with self._cond:
+            self._cond.notify_all()
+
+    async def _run(self, lesson, lid: int):
+        async def generate():
+            async for token in hlpr.stream_generate_lesson(lesson):
+                self.text += token
+                lesson["body_md"] += token
+                await self._notify()
+                if "\n" in token and lesson["status"] == 1:
+                    # keep the stored body roughly in step (write-behind)
+                    await LessonSession.update_lesson(lid, lesson)
+            return self.text
+
+        try:
+            body_md, _ = await single_flight(_generation_key(lid), generate)
+            if not self.text:
+                # generated by someone else (pre-generation or another worker)
+                self.text = body_md
+                lesson["body_md"] = body_md
+        except Exception as e:
+            self.error = e
+            if lesson["status"] == 0:
+                lesson["body_md"] = None
+            raise
+        finally:
+            self.done = True
+            BodyStream._streams.pop(lid, None)
+            await self._notify()
+            await LessonSession.update_lesson(lid, lesson)
+        spawn_background(retrieval.index_lesson_body(lid, self.text))
+
+    async def wait_for(self, predicate):
+        # wait until predicate() holds or generation has ended
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.done or predicate())
+        if self.error is not None:
+            raise self.error
+
+def _pregenerated(lesson, lid) -> bool:
+    return lesson["status"] == 0 and bool(lesson["body_md"]) and BodyStream.get(lid) is None
+
+async def pregenerate_lesson(lid: int):
+    # pre-generation worker handler (see pregeneration.py): store body_md
+    # for a lesson nobody has started yet
+    lesson = await LessonSession.get_lesson(lid)
+    if lesson is None or lesson["status"] != 0 or lesson["body_md"] or BodyStream.get(lid):
+        return
+    print(f"pre-generating lesson {lid}")
+    # speculative work yields to every learner-facing call
+    priority_override.set(BULK)
+    # same key as BodyStream, so a "Start" meanwhile joins this generation
+    body_md, _ = await single_flight(_generation_key(lid), lambda: hlpr.generate_lesson(lesson))
+    if lesson["status"] == 0 and not lesson["body_md"] and BodyStream.get(lid) is None:
+        lesson["body_md"] = body_md
+        await LessonSession.update_lesson(lid, lesson)
+
+def lesson_finished(lesson, lid):
+    # follow-up work once a finished lesson is in Postgres: pre-generate
+    # what comes next, and if this was the section's last unfinished lesson,
+    # write the section's quiz and roll its summary up into the course digest
+    spawn_background(pregeneration.enqueue_after(lid))
+    spawn_background(quiz_designer.generate_section_quiz(lesson["section_id"]))
+    spawn_background(rollup.rollup_section(lesson["section_id"], lesson["course_id"]))
+
+async def iterate_lesson(message: str, session_id: str):
     # convert session_id to int for SQL
     lid = int(session_id)
     # get lesson from LessonSessions (pulls lesson from SQL if not stored)
     ls = LessonSession
 
-    lesson = ls.get_lesson(lid)
+    lesson = await ls.get_lesson(lid)
 
     return_message = ""
     
     if message == "Finish":
         # the user has clicked "Finish"
-        summary = hlpr.summarize_lesson(lesson["messages"])
+        summary = await hlpr.summarize_lesson(await get_transcript(lid))
         lesson["summary"] = summary
-        add_message(lesson, lid, summary, "application") 
+        await add_message(lesson, lid, summary, "application") 
         lesson["status"] = 2
-        ls.push_to_sql(lesson)
+        await ls.push_to_sql(lesson)
+        lesson_finished(lesson, lid)
         return {"response": summary}
     elif message == "Start":
         # the user is starting a lesson for the first time
         # (status set to 0 if lesson has not been started)
-        print("generating lesson")
-        lesson["body_md"] = hlpr.generate_lesson(lesson)
-        lesson["status"] = 1 # status 1 means lesson has started
+        stream = BodyStream.get(lid)
+        if lesson["status"] != 0 and stream is None:
+            return _current_response(lesson)
+        if stream is None and not _pregenerated(lesson, lid):
+            print("generating lesson")
+            stream = BodyStream.open(lesson, lid)
+        if stream is not None:
+            # only the first paragraph is needed now; the rest keeps
+            # streaming into body_md
+            lesson = stream.lesson
+            await stream.wait_for(lambda: _paragraph_ready(stream.text))
+            opening = stream.text
+        else:
+            opening = lesson["body_md"]
+            spawn_background(retrieval.index_lesson_body(lid, opening))
+        # status 1 means lesson has started
+        if not await _claim_start(ls, lesson, lid):
+            return _follower_response(opening)
         return_message, lesson["body_md"] = iterate_body_md(lesson["body_md"])
     elif message == "Continue":
         # the user is continuing a lesson, so the next part of body_md
-        # needs to be added to lesson["messages"]
+        # needs to be added to lesson["messages"]; if it is still being
+        # generated, wait for the next paragraph only
+        stream = BodyStream.get(lid)
+        if stream is not None:
+            lesson = stream.lesson
+            await stream.wait_for(lambda: _paragraph_ready(lesson["body_md"]))
         return_message, lesson["body_md"] = iterate_body_md(lesson["body_md"])
     else:
         # if none of the former options are the case, then the user has
         # asked a question; answer_lesson_question will append the user's
         # message and the assistant's response to lesson["messages"]
-        messages = json.loads(lesson["messages"])
-        return_message = hlpr.answer_lesson_question(message, ".\n\n".join([m["content"] for m in messages]))
-        add_message(lesson, lid, message, "user") 
+        context = await build_answer_context(lesson, lid)
+        reference = await build_reference(lid, message)
+        return_message = await hlpr.answer_lesson_question(message, context, reference)
+        await add_message(lesson, lid, message, "user") 
+        spawn_background(retrieval.index_turn(lid, message, return_message))
     # update the lesson
-    add_message(lesson, lid, return_message, "application") 
-    ls.update_lesson(lid, lesson)
+    await add_message(lesson, lid, return_message, "application") 
+    await ls.update_lesson(lid, lesson)
     
     response = {"response": return_message, "status": lesson["status"], "body_md": lesson["body_md"]}
     return response
+
+async def stream_lesson(message: str, session_id: str):
+    # streaming counterpart of iterate_lesson: yields ("token", text) as the
+    # model emits them, then a single ("done", response) once the lesson has
+    # been persisted
+    lid = int(session_id)
+    ls = LessonSession
+
+    lesson = await ls.get_lesson(lid)
+
+    return_message = ""
+
+    if message == "Finish":
+        summary = ""
+        async for token in hlpr.stream_summarize_lesson(await get_transcript(lid)):
+            summary += token
+            yield "token", token
+        lesson["summary"] = summary
+        await add_message(lesson, lid, summary, "application")
+        lesson["status"] = 2
+        await ls.push_to_sql(lesson)
+        lesson_finished(lesson, lid)
+        yield "done", {"response": summary}
+        return
+    elif message == "Start":
+        stream = BodyStream.get(lid)
+        if lesson["status"] != 0 and stream is None:
+            response = _current_response(lesson)
+            yield "token", response["response"]
+            yield "done", response
+            return
+        if stream is None and not _pregenerated(lesson, lid):
+            print("generating lesson")
+            stream = BodyStream.open(lesson, lid)
+        if stream is not None:
+            # only the first paragraph is shown to the learner, so tokens
+            # are forwarded until the first paragraph break; the rest of the
+            # body keeps streaming into body_md in the background
+            lesson = stream.lesson
+            sent = 0
+            while True:
+                await stream.wait_for(lambda: len(stream.text) > sent)
+                cut = stream.text.find("\n\n")
+                end = cut if cut != -1 else len(stream.text)
+                if end > sent:
+                    yield "token", stream.text[sent:end]
+                    sent = end
+                if cut != -1 or stream.done:
+                    break
+            await stream.wait_for(lambda: _paragraph_ready(stream.text))
+            opening = stream.text
+        else:
+            opening = lesson["body_md"]
+            spawn_background(retrieval.index_lesson_body(lid, opening))
+            yield "token", iterate_body_md(opening)[0]
+        if not await _claim_start(ls, lesson, lid):
+            yield "done", _follower_response(opening)
+            return
+        return_message, lesson["body_md"] = iterate_body_md(lesson["body_md"])
+    elif message == "Continue":
+        stream = BodyStream.get(lid)
+        if stream is not None:
+            lesson = stream.lesson
+            await stream.wait_for(lambda: _paragraph_ready(lesson["body_md"]))
+        return_message, lesson["body_md"] = iterate_body_md(lesson["body_md"])
+        yield "token", return_message
+    else:
+        context = await build_answer_context(lesson, lid)
+        reference = await build_reference(lid, message)
+        async for token in hlpr.stream_answer_lesson_question(message, context, reference):
+            return_message += token
+            yield "token", token
+        await add_message(lesson, lid, message, "user")
+        spawn_background(retrieval.index_turn(lid, message, return_message))
+    await add_message(lesson, lid, return_message, "application")
+    await ls.update_lesson(lid, lesson)
+
+    yield "done", {"response": return_message, "status": lesson["status"], "body_md": lesson["body_md"]}
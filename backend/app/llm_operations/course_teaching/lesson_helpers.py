@@ -3,10 +3,13 @@ from langchain_core.prompts import PromptTemplate
 from llm_operations.llm_class import LLM
 
 import os
-import psycopg
 
 import courses.database as db
-DB_PATH = os.environ["DATABASE_URL"]
+from api_helpers.metrics import timed
+
+# token budget for the {context} of ANSWER_PROMPT (rolling summary plus
+# the most recent turns verbatim)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("LESSON_CONTEXT_TOKENS", "2048"))
 
 LESSON_PROMPT = PromptTemplate.from_template("""
 You are writing a lesson script.
@@ -23,36 +26,49 @@ Previous lesson/section summaries: {summaries}
 Future lessons: {future_lessons}
 """)
 
-def generate_lesson(l: dict):
-    con = db.open_db()
-    c_title, c_description = db.get_course_info(con, l["course_id"])
-    summaries = db.get_summaries(con, 
-                                  l["course_id"],
-                                  l["section_id"], 
-                                  l["position"])
-    future_lessons = db.get_future_lessons(con, 
-                                            l["course_id"],
-                                            l["section_id"], 
-                                            l["position"])
-
-    description = l["description"]
-    title = l["title"]
-    llm = LLM.get_llm()
-    chain = LESSON_PROMPT | llm
-    result = chain.invoke({
+@timed("lesson.prompt_inputs")
+async def _lesson_inputs(l: dict) -> dict:
+    async with db.connection() as con:
+        c_title, c_description = await db.get_course_info(con, l["course_id"])
+        summaries = await db.get_summaries(con, 
+                                      l["course_id"],
+                                      l["section_id"], 
+                                      l["position"])
+        future_lessons = await db.get_future_lessons(con, 
+                                                l["course_id"],
+                                                l["section_id"], 
+                                                l["position"])
+
+    return {
         "c_description": c_description,
         "c_title": c_title,
         "future_lessons": future_lessons,
-        "l_description": description,
-        "l_title": title,
+        "l_description": l["description"],
+        "l_title": l["title"],
         "summaries": summaries
-    })
+    }
+
+async def generate_lesson(l: dict):
+    llm = LLM.get_llm(purpose="lesson")
+    chain = LESSON_PROMPT | llm
+    result = await chain.ainvoke(await _lesson_inputs(l))
 
     return result.content
 
+async def stream_generate_lesson(l: dict):
+    # same as generate_lesson, but yields tokens as the model emits them
+    llm = LLM.get_llm(purpose="lesson")
+    chain = LESSON_PROMPT | llm
+    async for chunk in chain.astream(await _lesson_inputs(l)):
+        yield chunk.content
+
 ANSWER_PROMPT = PromptTemplate.from_template("""
 You are a teacher named Assistant answering a question by a student named User.
 Reply to exactly what User asks, being informative, thorough, and kind.
+Ground your answer in the relevant parts of the lesson:
+
+{reference}
+
 Consider User's question from the context of your conversation: 
 
 {context}
@@ -60,16 +76,27 @@ Consider User's question from the context of your conversation:
 Student's question: {question}
 """)
 
-def answer_lesson_question(question: str, prev_messages: str):
+async def answer_lesson_question(question: str, prev_messages: str, reference: str = ""):
     llm = LLM.get_llm()
     chain = ANSWER_PROMPT | llm
-    result = chain.invoke({
+    result = await chain.ainvoke({
         "question": question,
-        "context": prev_messages
+        "context": prev_messages,
+        "reference": reference or "(none)"
     })
 
     return result.content
 
+async def stream_answer_lesson_question(question: str, prev_messages: str, reference: str = ""):
+    llm = LLM.get_llm()
+    chain = ANSWER_PROMPT | llm
+    async for chunk in chain.astream({
+        "question": question,
+        "context": prev_messages,
+        "reference": reference or "(none)"
+    }):
+        yield chunk.content
+
 SUMMARY_PROMPT = PromptTemplate.from_template("""
 You are summarizing a lesson that you have just delivered, as well as the discussion that you and your student had about it. Don't just repeat what was said, but provide a concise summary of it. Constrain the length of the summary to one paragraph.
 
@@ -77,16 +104,71 @@ Lesson and discussion:
 {messages}
 """)
 
-def summarize_lesson(messages: str):
+async def summarize_lesson(messages: str):
     llm = LLM.get_llm()
     chain = SUMMARY_PROMPT | llm
-    result = chain.invoke({
+    result = await chain.ainvoke({
         "messages": messages,
     })
 
     return result.content
 
-def format_as_ChatMsg(mid: int, role: str, content: str):
+async def stream_summarize_lesson(messages: str):
+    llm = LLM.get_llm()
+    chain = SUMMARY_PROMPT | llm
+    async for chunk in chain.astream({
+        "messages": messages,
+    }):
+        yield chunk.content
+
+CONTEXT_SUMMARY_PROMPT = PromptTemplate.from_template("""
+You are keeping running notes on a lesson you are teaching, so that you can answer the student's later questions without rereading the whole conversation.
+
+Update the notes with the new part of the conversation below. Keep every concept taught and every question the student asked, but be concise; the notes must stay under 250 words. Return only the updated notes.
+
+Current notes:
+{summary}
+
+New part of the conversation:
+{messages}
+""")
+
+def estimate_tokens(text: str) -> int:
+    # rough count (about four characters per token for English text); close
+    # enough for budgeting without pulling in a tokenizer
+    return len(text) // 4 + 1
+
+def format_turns(messages: list) -> str:
+    return "\n\n".join([f"{m['role']}: {m['content']}" for m in messages])
+
+async def fold_context_summary(summary: str, messages: list) -> str:
+    # fold older turns into the rolling summary, in slices that fit the
+    # budget so a long backlog never produces an oversized prompt
+    llm = LLM.get_llm()
+    chain = CONTEXT_SUMMARY_PROMPT | llm
+
+    batch, size = [], 0
+    batches = []
+    for m in messages:
+        t = estimate_tokens(m["content"])
+        if batch and size + t > CONTEXT_TOKEN_BUDGET:
+            batches.append(batch)
+            batch, size = [], 0
+        batch.append(m)
+        size += t
+    if batch:
+        batches.append(batch)
+
+    for b in batches:
+        result = await chain.ainvoke({
+            "summary": summary or "(none yet)",
+            "messages": format_turns(b),
+        })
+        summary = result.content.strip()
+    return summary
+
+def format_as_ChatMsg(mid: int, role: str, content: str, seq: int = None):
     return {"id": mid,
+            "seq": seq,
             "role": role,
             "content": content}
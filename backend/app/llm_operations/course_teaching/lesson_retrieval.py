@@ -0,0 +1,88 @@
+# Retrieval index for lesson Q&A.
+#
+# When a lesson body is generated it is split into paragraph-sized chunks and
+# embedded once; every answered question is added as one more chunk. At
+# question time only the top-k chunks most similar to the question are put
+# in the prompt, so prompt size doesn't depend on how long the lesson is.
+#
+# Vectors live in lesson_chunks (REAL[]). A lesson only has a few dozen
+# chunks, so scoring is a plain cosine over the lesson's rows and needs no
+# vector extension in Postgres.
+
+import os, math
+
+import courses.database as db
+from llm_operations.llm_class import LLM
+from api_helpers.cache_helpers import LRUCache
+from api_helpers.metrics import timed
+from llm_operations.course_teaching.lesson_helpers import estimate_tokens
+
+RETRIEVAL_TOP_K = int(os.getenv("LESSON_RETRIEVAL_TOP_K", "4"))
+CHUNK_TOKENS = int(os.getenv("LESSON_CHUNK_TOKENS", "300"))
+
+# lesson_id -> [{"chunk_no", "content", "embedding"}], so follow-up questions
+# don't reload the vectors
+_index = LRUCache(maxsize=int(os.getenv("LESSON_INDEX_CACHE_SIZE", "256")))
+
+def chunk_body(body_md: str) -> list[str]:
+    # paragraphs, with short neighbours merged up to CHUNK_TOKENS
+    chunks, cur = [], ""
+    for p in body_md.split("\n\n"):
+        p = p.strip()
+        if not p:
+            continue
+        if cur and estimate_tokens(cur) + estimate_tokens(p) > CHUNK_TOKENS:
+            chunks.append(cur)
+            cur = p
+        else:
+            cur = f"{cur}\n\n{p}" if cur else p
+    if cur:
+        chunks.append(cur)
+    return chunks
+
+async def index_lesson_body(lid: int, body_md: str):
+    chunks = chunk_body(body_md)
+    if not chunks:
+        return
+    embeddings = await LLM.get_embeddings().aembed_documents(chunks)
+    async with db.connection() as con:
+        await db.replace_lesson_chunks(con, lid, chunks, embeddings)
+    cached = _index.get(lid)
+    if cached is None:
+        # nothing to update; the next retrieve loads body and turns together
+        return
+    turns = [c for c in cached if c["chunk_no"] > db.TURN_CHUNK_BASE]
+    _index.set(lid, [
+        {"chunk_no": n, "content": c, "embedding": e}
+        for n, (c, e) in enumerate(zip(chunks, embeddings), start=1)
+    ] + turns)
+
+async def index_turn(lid: int, question: str, answer: str):
+    content = f"Question: {question}\nAnswer: {answer}"
+    embedding = (await LLM.get_embeddings().aembed_documents([content]))[0]
+    async with db.connection() as con:
+        chunk_no = await db.add_lesson_chunk(con, lid, content, embedding)
+    chunks = _index.get(lid)
+    if chunks is not None:
+        chunks.append({"chunk_no": chunk_no, "content": content, "embedding": embedding})
+
+def _cosine(a, b) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    na = math.sqrt(sum(x * x for x in a))
+    nb = math.sqrt(sum(y * y for y in b))
+    return dot / (na * nb) if na and nb else 0.0
+
+@timed("retrieval.retrieve")
+async def retrieve(lid: int, query: str, k: int = RETRIEVAL_TOP_K) -> list[str]:
+    chunks = _index.get(lid)
+    if chunks is None:
+        async with db.connection() as con:
+            chunks = await db.get_lesson_chunks(con, lid)
+        _index.set(lid, chunks)
+    if not chunks:
+        return []
+
+    qv = await LLM.get_embeddings().aembed_query(query)
+    ranked = sorted(chunks, key=lambda c: _cosine(qv, c["embedding"]), reverse=True)[:k]
+    # present the hits in lesson order, which reads better than score order
+    return [c["content"] for c in sorted(ranked, key=lambda c: c["chunk_no"])]
@@ -0,0 +1,171 @@
+# Background pre-generation of lesson bodies.
+#
+# When a lesson is finished (or a course approved) the next PREGEN_AHEAD
+# lessons in course order are pushed onto a Redis queue. Worker tasks in
+# every backend process pop lesson ids and generate their body_md ahead of
+# time, so "Start" on those lessons doesn't have to wait for the model.
+#
+# PREGEN_GLOBAL_LIMIT caps how many pre-generations run at once across all
+# workers, so speculative work can't crowd learners off the model host.
+# The slots are a Redis sorted set of holders scored by lease deadline:
+# holders renew their own lease while they run, and a slot whose holder
+# died is reclaimed once its deadline passes. Queued or running lessons
+# can be cancelled.
+
+import os, time, uuid, asyncio, traceback
+
+import courses.database as db
+from api_helpers.session_helpers import r
+
+PREGEN_AHEAD = int(os.getenv("PREGEN_AHEAD", "2"))
+PREGEN_WORKERS = int(os.getenv("PREGEN_WORKERS", "1"))
+PREGEN_GLOBAL_LIMIT = int(os.getenv("PREGEN_GLOBAL_LIMIT", "1"))
+# how long a slot outlives its holder if the worker dies, and how long
+# cancel markers last
+PREGEN_LEASE = int(os.getenv("PREGEN_LEASE", "600"))
+
+QUEUE_KEY = "pregen:queue"
+QUEUED_KEY = "pregen:queued"
+# sorted set: holder token -> lease deadline
+SLOTS_KEY = "pregen:slot_leases"
+
+# drop lapsed holders, then take a slot if one is free
+_ACQUIRE_LUA = """
+redis.call("zremrangebyscore", KEYS[1], "-inf", ARGV[1])
+if redis.call("zcard", KEYS[1]) < tonumber(ARGV[2]) then
+    redis.call("zadd", KEYS[1], ARGV[3], ARGV[4])
+    return 1
+end
+return 0
+"""
+
+def _cancel_key(lid: int) -> str:
+    return f"pregen:cancel:{lid}"
+
+class Pregenerator:
+    _workers = []
+    _running = {}   # lesson_id -> task, for cancellation
+    _cancelled = set()  # lesson ids whose task was cancelled on request
+    _handler = None
+
+    @staticmethod
+    def start(handler):
+        # handler(lesson_id) does the actual generation and storing
+        Pregenerator._handler = handler
+        if not Pregenerator._workers:
+            Pregenerator._workers = [
+                asyncio.create_task(Pregenerator._work()) for _ in range(PREGEN_WORKERS)
+            ]
+
+    @staticmethod
+    async def stop():
+        for w in Pregenerator._workers:
+            w.cancel()
+        Pregenerator._workers = []
+
+    @staticmethod
+    async def _acquire_slot() -> str:
+        # returns the holder token, for renewing and releasing the slot
+        token = str(uuid.uuid4())
+        while True:
+            now = time.time()
+            if await r.eval(_ACQUIRE_LUA, 1, SLOTS_KEY, now, PREGEN_GLOBAL_LIMIT, now + PREGEN_LEASE, token):
+                return token
+            await asyncio.sleep(1)
+
+    @staticmethod
+    async def _renew_slot(token: str):
+        # xx: never re-add a slot that has already lapsed and been reclaimed
+        await r.zadd(SLOTS_KEY, {token: time.time() + PREGEN_LEASE}, xx=True)
+
+    @staticmethod
+    async def _release_slot(token: str):
+        await r.zrem(SLOTS_KEY, token)
+
+    @staticmethod
+    def _cancel_task(lid: int, task: asyncio.Task):
+        Pregenerator._cancelled.add(lid)
+        task.cancel()
+
+    @staticmethod
+    async def _watch(lid: int, task: asyncio.Task, token: str):
+        # cancel on request, and keep the slot's lease alive meanwhile
+        while not task.done():
+            if await r.exists(_cancel_key(lid)):
+                Pregenerator._cancel_task(lid, task)
+                return
+            await Pregenerator._renew_slot(token)
+            await asyncio.sleep(1)
+
+    @staticmethod
+    async def _run(lid: int):
+        if await r.exists(_cancel_key(lid)):
+            return
+        token = await Pregenerator._acquire_slot()
+        try:
+            task = asyncio.create_task(Pregenerator._handler(lid))
+            Pregenerator._running[lid] = task
+            watcher = asyncio.create_task(Pregenerator._watch(lid, task, token))
+            try:
+                await task
+            except asyncio.CancelledError:
+                # only a cancel request is handled here; the worker itself
+                # being cancelled (shutdown) must propagate
+                if lid not in Pregenerator._cancelled:
+                    raise
+                print(f"pre-generation of lesson {lid} cancelled")
+            finally:
+                watcher.cancel()
+                Pregenerator._running.pop(lid, None)
+                Pregenerator._cancelled.discard(lid)
+        finally:
+            await Pregenerator._release_slot(token)
+
+    @staticmethod
+    async def _work():
+        while True:
+            try:
+                item = await r.brpop(QUEUE_KEY, timeout=5)
+                if item is None:
+                    continue
+                lid = int(item[1])
+                await r.srem(QUEUED_KEY, lid)
+                await Pregenerator._run(lid)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                traceback.print_exc()
+                await asyncio.sleep(1)
+
+async def enqueue(lesson_ids):
+    for lid in lesson_ids:
+        # the set keeps a lesson from being queued twice
+        if await r.sadd(QUEUED_KEY, lid):
+            await r.delete(_cancel_key(lid))
+            await r.lpush(QUEUE_KEY, lid)
+
+async def enqueue_after(lid: int, n: int = PREGEN_AHEAD):
+    # the n lessons that follow `lid` in course order
+    async with db.connection() as con:
+        ids = await db.get_next_lesson_ids(con, lid, n)
+    await enqueue(ids)
+
+async def enqueue_course(course_id: int, n: int = PREGEN_AHEAD):
+    # the first n lessons of a newly approved course
+    async with db.connection() as con:
+        ids = await db.get_first_lesson_ids(con, course_id, n)
+    await enqueue(ids)
+
+async def cancel(lesson_ids):
+    for lid in lesson_ids:
+        await r.set(_cancel_key(lid), 1, ex=PREGEN_LEASE)
+        await r.lrem(QUEUE_KEY, 0, lid)
+        await r.srem(QUEUED_KEY, lid)
+        task = Pregenerator._running.get(lid)
+        if task is not None:
+            Pregenerator._cancel_task(lid, task)
+
+async def cancel_course(course_id: int):
+    async with db.connection() as con:
+        ids = await db.get_course_lesson_ids(con, course_id)
+    await cancel(ids)
@@ -0,0 +1,105 @@
+# Section and course summaries.
+#
+# When the last unfinished lesson of a section finishes, its lesson
+# summaries are condensed into sections.summary. Finished sections are
+# then folded, in course order, into the running courses.digest, so
+# db.get_summaries can describe everything before a lesson with the digest
+# plus at most a few recent summaries. That keeps the lesson prompt the
+# same size on lesson 3 and on lesson 300.
+
+import os
+
+from langchain_core.prompts import PromptTemplate
+
+import courses.database as db
+
+from llm_operations.llm_class import LLM
+from api_helpers.session_helpers import r
+
+# how long a claim lasts if its worker dies mid-summary
+ROLLUP_CLAIM_TTL = int(os.getenv("ROLLUP_CLAIM_TTL", "600"))
+
+SECTION_SUMMARY_PROMPT = PromptTemplate.from_template("""
+You are summarizing a section of a course called {course} that your student has just finished. The section is called {section}.
+
+Here are summaries of its lessons, in order:
+{summaries}
+
+Write one concise paragraph covering the concepts the section taught, so that later lessons can build on them. Return only the paragraph.
+""")
+
+COURSE_DIGEST_PROMPT = PromptTemplate.from_template("""
+You are keeping a running digest of everything a student has learned so far in a course called {course}.
+
+Update the digest with the section below. Keep every important concept, but be concise; the digest must stay under 300 words. Return only the updated digest.
+
+Current digest:
+{digest}
+
+Newly finished section ({section}):
+{summary}
+""")
+
+async def summarize_section(section_id: int) -> bool:
+    """
+    Write sections.summary once all of the section's lessons are finished.
+    Returns True if this call wrote it.
+    """
+    async with db.connection() as con:
+        section = await db.get_section(con, section_id)
+        if section is None or section["summary"]:
+            return False
+        lessons = await db.get_section_lessons(con, section_id)
+        if not lessons or any(l["status"] != 2 for l in lessons):
+            return False
+        course, _ = await db.get_course_info(con, section["course_id"])
+
+    claim = f"rollup:section:{section_id}:claimed"
+    if not await r.set(claim, 1, nx=True, ex=ROLLUP_CLAIM_TTL):
+        return False
+    try:
+        chain = SECTION_SUMMARY_PROMPT | LLM.get_llm(purpose="rollup")
+        summary = (await chain.ainvoke({
+            "course":    course,
+            "section":   section["title"],
+            "summaries": "\n\n".join([f"{l['title']}:\n{l['summary'] or ''}" for l in lessons]),
+        })).content.strip()
+
+        async with db.connection() as con:
+            return await db.set_section_summary(con, section_id, summary)
+    finally:
+        await r.delete(claim)
+
+async def fold_course_digest(course_id: int):
+    # fold summarized sections into the digest in course order, stopping at
+    # the first section that isn't summarized yet
+    claim = f"rollup:course:{course_id}:digest"
+    if not await r.set(claim, 1, nx=True, ex=ROLLUP_CLAIM_TTL):
+        return
+    try:
+        async with db.connection() as con:
+            course, _ = await db.get_course_info(con, course_id)
+            digest, upto = await db.get_course_digest(con, course_id)
+            sections = await db.get_section_summaries_after(con, course_id, upto)
+
+        chain = COURSE_DIGEST_PROMPT | LLM.get_llm(purpose="rollup")
+        for s in sections:
+            if s["position"] != upto + 1 or not s["summary"]:
+                break
+            new_digest = (await chain.ainvoke({
+                "course":  course,
+                "digest":  digest or "(nothing yet)",
+                "section": s["title"],
+                "summary": s["summary"],
+            })).content.strip()
+            async with db.connection() as con:
+                if not await db.update_course_digest(con, course_id, new_digest, s["position"], upto):
+                    return
+            digest, upto = new_digest, s["position"]
+    finally:
+        await r.delete(claim)
+
+async def rollup_section(section_id: int, course_id: int):
+    # background hook for a finished lesson
+    if await summarize_section(section_id):
+        await fold_course_digest(course_id)
@@ -1,6 +1,5 @@
 from typing import Any, Dict, List
-import os
-import psycopg
+import os, asyncio
 
 from langchain_core.prompts import PromptTemplate
 
@@ -8,6 +7,9 @@ import courses.database as db
 
 from llm_operations.llm_class import LLM
 
+# upper bound on exercises generated per request
+EXERCISE_BATCH_MAX = int(os.getenv("EXERCISE_BATCH_MAX", "5"))
+
 EXERCISE_PROMPT = PromptTemplate.from_template("""
 You are a teacher of a course called {course}. A student is asking you to give them an exercise based on information you have just taught in your lesson.
 
@@ -15,6 +17,8 @@ You will create an exercise for the student that is relevant to the course and c
 
 An exercise should not be able to be answered with merely "Yes" or "No". It should describe an action to accomplish or a problem to be solved. For example, an exercise may ask a student to write a function or solve a word problem.
 
+{variation}
+
 Create an exercise for the following lesson:
 {lesson}
 """)
@@ -38,68 +42,69 @@ Here is the exercise:
 {exercise}
 """)
 
-DB_PATH = os.environ["DATABASE_URL"]
-
-class Exercise:
-    _exercise = ""
-    _title    = ""
-    _solution = ""
-    _lid = None
-    
-    @staticmethod
-    def save_exercise():
-        with psycopg.connect("DB_PATH") as con:
-            if Exercise._lid is not None:
-                db.push_exercise_to_sql(con, Exercise._lid, Exercise._title, Exercise._exercise, Exercise._solution);
-
-    @staticmethod
-    def hold_exercise(ex: str, sol: str, tit: str, lid: int):
-        Exercise._exercise = ex
-        Exercise._title    = tit
-        Exercise._solution = sol
-        Exercise._lid      = lid
-
-    @staticmethod
-    def reset():
-        Exercise._exercise = ""
-        Exercise._tit      = ""
-        Exercise._solution = ""
-        Exercise._lid      = None
-
-def create_exercise(lid: int) -> Str:
-    with psycopg.connect(DB_PATH) as con:
-        lesson = db.get_single_lesson(con, lid)
-        lesson = lesson["title"]
-        cid = lesson["course_id"]
-        course, _ = db.get_course_info(con, cid)
-        messages = "\n\n".join(lesson["messages"])
-    
-    model = LLM.get_llm()
-
-    chain = EXERCISE_PROMPT | model
-
-    exercise = chain.invoke({
+async def load_exercise_context(lid: int) -> Dict[str, Any]:
+    # everything the prompts need, read once and shared by a whole batch
+    async with db.connection() as con:
+        lesson = await db.get_single_lesson(con, lid)
+        if lesson is None:
+            raise ValueError(f"Lesson {lid} not found")
+        course, _ = await db.get_course_info(con, lesson["course_id"])
+        messages = "\n\n".join([m["content"] for m in await db.get_lesson_messages(con, lid)])
+    return {
         "course":       course,
-        "lesson_title": lesson,
+        "lesson_title": lesson["title"],
         "lesson":       messages,
-    }).content
-    
-    chain = EXERCISE_TITLE_PROMPT | model
-    title = chain.invoke({
-        "course":   course,
-        "exercise": exercise,
-    }).content
-
-    chain = EXERCISE_SOLUTION_PROMPT | model
-    solution = chain.invoke({
-        "course":   course,
-        "lesson":   lesson,
+    }
+
+def _variation(n: int, count: int) -> str:
+    # the model runs at temperature 0, so exercises in a batch differ only
+    # if their prompts do
+    if count == 1:
+        return ""
+    return f"This is exercise {n} of a set of {count}. Each exercise in the set should practise a different part of the lesson."
+
+async def design_exercise(ctx: Dict[str, Any], n: int = 1, count: int = 1) -> Dict[str, str]:
+    # title and solution both depend only on the exercise, so they run
+    # concurrently once it exists
+    chain = EXERCISE_PROMPT | LLM.get_llm(purpose="exercise")
+    exercise = (await chain.ainvoke({
+        "course":    ctx["course"],
+        "lesson":    ctx["lesson"],
+        "variation": _variation(n, count),
+    })).content
+
+    title_chain = EXERCISE_TITLE_PROMPT | LLM.get_llm(purpose="title")
+    solution_chain = EXERCISE_SOLUTION_PROMPT | LLM.get_llm(purpose="exercise")
+    title, solution = await asyncio.gather(
+        title_chain.ainvoke({
+            "course":   ctx["course"],
+            "exercise": exercise,
+        }),
+        solution_chain.ainvoke({
+            "course":   ctx["course"],
+            "lesson":   ctx["lesson_title"],
+            "exercise": exercise,
+        }),
+    )
+
+    return {
+        "title":    title.content.strip(),
         "exercise": exercise,
-    }).content
-    
-    Exercise.hold_exercise(exercise, title, solution, lid);
-    return exercise
-
-def commit_exercise():
-    Exercise.save_exercise();
-    Exercise.reset();
+        "solution": solution.content,
+    }
+
+async def create_exercises(lid: int, count: int = 1) -> List[Dict[str, Any]]:
+    """
+    Generate `count` exercises for a lesson concurrently and store them
+    with one bulk insert. Returns the stored exercises with their ids.
+    """
+    count = max(1, min(count, EXERCISE_BATCH_MAX))
+    ctx = await load_exercise_context(lid)
+
+    exercises = await asyncio.gather(*[
+        design_exercise(ctx, n, count) for n in range(1, count + 1)
+    ])
+
+    async with db.connection() as con:
+        ids = await db.create_exercises(con, lid, exercises)
+    return [{"id": eid, **e} for eid, e in zip(ids, exercises)]
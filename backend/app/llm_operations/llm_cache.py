@@ -0,0 +1,114 @@
+# Persistent response cache for deterministic (temperature=0) LLM calls.
+#
+# Entries are content-addressed on LangChain's llm_string (model, options and
+# bound kwargs such as format/num_ctx) plus the rendered prompt, and stored
+# as one file each under LLM_CACHE_DIR, so every worker on the host shares
+# them and they survive restarts. LLM_CACHE_DIR defaults to llm_cache/
+# under APP_DATA_DIR (/app/data in the container, a named volume in
+# docker-compose.yml); point it at persistent storage, or the cache is
+# lost with the container. Total size is capped at
+# LLM_CACHE_MAX_BYTES; the least recently used entries are evicted first
+# (lookups refresh a file's mtime).
+
+import os, hashlib, threading
+from typing import Any, Optional, Sequence
+
+from langchain_core.caches import BaseCache
+from langchain_core.load import dumps, loads
+from langchain_core.outputs import Generation
+
+# defaults to data/ next to main.py, i.e. /app/data in the container
+APP_DATA_DIR = os.getenv("APP_DATA_DIR", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data"))
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", os.path.join(APP_DATA_DIR, "llm_cache"))
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+class FileLLMCache(BaseCache):
+
+    def __init__(self, directory: str = LLM_CACHE_DIR, max_bytes: int = LLM_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, prompt: str, llm_string: str) -> str:
+        key = hashlib.sha256(f"{llm_string}\0{prompt}".encode()).hexdigest()
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[Sequence[Generation]]:
+        path = self._path(prompt, llm_string)
+        try:
+            with open(path, encoding="utf-8") as f:
+                generations = loads(f.read())
+            os.utime(path)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return generations
+
+    def update(self, prompt: str, llm_string: str, return_val: Sequence[Generation]) -> None:
+        path = self._path(prompt, llm_string)
+        data = dumps(list(return_val))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write-then-rename so readers never see a partial entry
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(data)
+        # an overwritten entry only adds the difference to the total
+        try:
+            replaced = os.stat(path).st_size
+        except FileNotFoundError:
+            replaced = 0
+        os.replace(tmp, path)
+
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan_size()
+            else:
+                self._size += len(data.encode()) - replaced
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".json"):
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    yield path, st.st_size, st.st_mtime
+
+    def _scan_size(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        # drop least recently used entries until 90% of the cap is free
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+        target = int(self.max_bytes * 0.9)
+        for path, size, _ in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        self._size = total
+
+    def clear(self, **kwargs: Any) -> None:
+        with self._lock:
+            for path, _, _ in list(self._entries()):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._size = 0
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "bytes": self._size, "max_bytes": self.max_bytes}
@@ -1,15 +1,150 @@
-from langchain_ollama import ChatOllama
-import os
+from langchain_core.embeddings import Embeddings
+from langchain_ollama import ChatOllama, OllamaEmbeddings
+import os, re, math, json, hashlib
+
+from llm_operations.llm_cache import FileLLMCache
+from llm_operations.llm_pool import BackendPool, BalancedModel, MODEL_URLS
+from llm_operations.scheduler import ScheduledModel, PURPOSE_PRIORITY, INTERACTIVE
+
+# purposes whose calls go through the persistent response cache (opt-in;
+# only deterministic calls belong here). Streamed and invoked calls share
+# entries, so a lesson pre-generated with ainvoke is replayed by "Start"
+LLM_CACHE_PURPOSES = {p.strip() for p in os.getenv("LLM_CACHE_PURPOSES", "lesson,route").split(",") if p.strip()}
+
+# model tiers: "quality" writes lessons, answers and courses; "fast" is a
+# small model for one-word classifications, short titles and JSON repair.
+# keep_alive keeps both resident in Ollama between calls
+MODEL_TIERS = {
+    "quality": {
+        "model":      os.getenv("QUALITY_MODEL", "qwen2:7b-instruct"),
+        "num_ctx":    int(os.getenv("QUALITY_NUM_CTX", "8192")),
+        "keep_alive": os.getenv("QUALITY_KEEP_ALIVE", "30m"),
+    },
+    "fast": {
+        "model":      os.getenv("FAST_MODEL", "qwen2:1.5b-instruct"),
+        "num_ctx":    int(os.getenv("FAST_NUM_CTX", "2048")),
+        "keep_alive": os.getenv("FAST_KEEP_ALIVE", "30m"),
+    },
+}
+DEFAULT_TIER = "quality"
+
+# purposes that default to a tier other than DEFAULT_TIER
+PURPOSE_TIER = {"route": "fast", "title": "fast", "repair": "fast"}
+
+# per-request timeout against an Ollama host; a stuck host then counts as
+# failed and the call moves to another backend
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "300"))
+
+# "stub" selects HashEmbeddings (deterministic, no model host needed)
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "nomic-embed-text")
+
+class HashEmbeddings(Embeddings):
+    """
+    Deterministic local stand-in for an embedding model: hashed bag of
+    words, L2-normalised. Good enough for tests and offline development.
+    """
+
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+
+    def _embed(self, text: str) -> list[float]:
+        vec = [0.0] * self.dim
+        for tok in re.findall(r"\w+", text.lower()):
+            h = hashlib.sha1(tok.encode()).digest()
+            idx = int.from_bytes(h[:4], "little") % self.dim
+            vec[idx] += 1.0 if h[4] & 1 else -1.0
+        norm = math.sqrt(sum(v * v for v in vec)) or 1.0
+        return [v / norm for v in vec]
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self._embed(t) for t in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._embed(text)
+
+class PooledChatOllama(ChatOllama):
+    """
+    ChatOllama whose cache key names the model and its options but not the
+    host, so every backend in the pool shares the same cached responses.
+    """
+
+    def _get_llm_string(self, stop=None, **kwargs) -> str:
+        return json.dumps({
+            "model":       self.model,
+            "temperature": self.temperature,
+            "num_ctx":     self.num_ctx,
+            "format":      self.format,
+            "stop":        stop or self.stop,
+            **kwargs,
+        }, sort_keys=True, default=str)
 
 class LLM:
-    __llm = None
+    __pool = None
+    __models = {}
+    __cache = None
+    __embeddings = None
+
+    @staticmethod
+    def get_pool() -> BackendPool:
+        if LLM.__pool == None:
+            LLM.__pool = BackendPool(MODEL_URLS)
+        return LLM.__pool
+
+    @staticmethod
+    def set_backends(urls: list[str]):
+        # point the pool at a different set of hosts (e.g. stand-ins in
+        # tests); models are rebuilt against the new pool on next use
+        LLM.__pool = BackendPool([u.rstrip("/") for u in urls])
+        LLM.__models = {}
+
+    @staticmethod
+    def _build_llm(tier: str, cache=None):
+        settings = MODEL_TIERS[tier]
+        return BalancedModel(LLM.get_pool(), lambda url: PooledChatOllama(
+            model=settings["model"],
+            num_ctx=settings["num_ctx"],
+            keep_alive=settings["keep_alive"],
+            base_url=url,
+            temperature=0,
+            cache=cache,
+            client_kwargs={"timeout": LLM_TIMEOUT},
+        ))
+
+    @staticmethod
+    def get_llm(purpose: str = None, tier: str = None):
+        # every call goes through the scheduler, at the priority of its
+        # purpose; purposes listed in LLM_CACHE_PURPOSES get a model that
+        # answers repeated prompts from the persistent response cache.
+        # The tier comes from the purpose unless a chain asks for one
+        tier = tier or PURPOSE_TIER.get(purpose, DEFAULT_TIER)
+        if tier not in MODEL_TIERS:
+            raise ValueError(f"Unknown model tier '{tier}'")
+        priority = PURPOSE_PRIORITY.get(purpose, INTERACTIVE)
+        cached = purpose in LLM_CACHE_PURPOSES
+        key = (tier, cached)
+        if key not in LLM.__models:
+            LLM.__models[key] = LLM._build_llm(tier, cache=LLM.get_cache() if cached else None)
+        return ScheduledModel(LLM.__models[key], priority, purpose)
+
+    @staticmethod
+    def get_cache() -> FileLLMCache:
+        if LLM.__cache == None:
+            LLM.__cache = FileLLMCache()
+        return LLM.__cache
+
+    @staticmethod
+    def get_embeddings() -> Embeddings:
+        if LLM.__embeddings == None:
+            if EMBEDDING_MODEL == "stub":
+                LLM.__embeddings = HashEmbeddings()
+            else:
+                LLM.__embeddings = OllamaEmbeddings(
+                    model=EMBEDDING_MODEL,
+                    base_url=MODEL_URLS[0],
+                )
+        return LLM.__embeddings
 
     @staticmethod
-    def get_llm():
-        if LLM.__llm == None:
-            LLM.__llm = ChatOllama(
-                model='qwen2:7b-instruct',
-                base_url=os.getenv("MODEL_URL", "http://ollama:11434"),
-                temperature=0
-            )
-        return LLM.__llm
+    def set_embeddings(embeddings: Embeddings):
+        # swap the embedding backend (e.g. HashEmbeddings in tests)
+        LLM.__embeddings = embeddings
@@ -0,0 +1,202 @@
+# Load balancing across several Ollama hosts.
+#
+# MODEL_URLS (comma-separated; falls back to MODEL_URL) lists the hosts.
+# Each call goes to the healthy backend with the fewest requests in flight.
+# A backend that refuses connections or times out is ejected for
+# LLM_EJECT_SECONDS and the call is retried on another one (generations
+# have no side effects, so a retry is always safe; a stream is only retried
+# if nothing has been yielded yet). A background loop probes every backend
+# and re-admits ejected ones as soon as they answer again.
+
+import os, time, asyncio, traceback
+
+import httpx
+from langchain_core.caches import BaseCache
+from langchain_core.load import dumps
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration
+from langchain_core.runnables import Runnable
+
+MODEL_URLS = [
+    u.strip().rstrip("/")
+    for u in os.getenv("MODEL_URLS", os.getenv("MODEL_URL", "http://ollama:11434")).split(",")
+    if u.strip()
+]
+LLM_EJECT_SECONDS = float(os.getenv("LLM_EJECT_SECONDS", "30"))
+LLM_RETRIES = int(os.getenv("LLM_RETRIES", "2"))
+LLM_HEALTH_INTERVAL = float(os.getenv("LLM_HEALTH_INTERVAL", "10"))
+
+# failures that mean "this host is unreachable or stuck", as opposed to a
+# bad request that would fail on every host
+BACKEND_ERRORS = (
+    httpx.ConnectError,
+    httpx.TimeoutException,
+    httpx.RemoteProtocolError,
+    ConnectionError,
+    asyncio.TimeoutError,
+)
+
+class Backend:
+
+    def __init__(self, url: str):
+        self.url = url
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.ejected_until = 0.0
+
+    @property
+    def healthy(self) -> bool:
+        return self.ejected_until <= time.monotonic()
+
+class BackendPool:
+
+    def __init__(self, urls: list[str] = MODEL_URLS):
+        self.backends = [Backend(u) for u in urls]
+        self._health = None
+
+    def pick(self, exclude=()):
+        candidates = [b for b in self.backends if b not in exclude]
+        healthy = [b for b in candidates if b.healthy]
+        # if everything is ejected, still try someone rather than fail outright
+        pool = healthy or candidates
+        if not pool:
+            return None
+        return min(pool, key=lambda b: (b.outstanding, b.requests))
+
+    def eject(self, backend: Backend):
+        backend.failures += 1
+        backend.ejected_until = time.monotonic() + LLM_EJECT_SECONDS
+        print(f"LLM backend {backend.url} ejected for {LLM_EJECT_SECONDS}s")
+
+    async def probe(self, backend: Backend):
+        try:
+            async with httpx.AsyncClient(timeout=5) as client:
+                res = await client.get(f"{backend.url}/api/tags")
+                res.raise_for_status()
+            backend.ejected_until = 0.0
+        except Exception:
+            if backend.healthy:
+                self.eject(backend)
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(LLM_HEALTH_INTERVAL)
+            try:
+                await asyncio.gather(*[self.probe(b) for b in self.backends])
+            except Exception:
+                traceback.print_exc()
+
+    def start(self):
+        if self._health is None:
+            self._health = asyncio.create_task(self._health_loop())
+
+    async def stop(self):
+        if self._health is not None:
+            self._health.cancel()
+            self._health = None
+
+    def stats(self) -> list[dict]:
+        return [
+            {
+                "url": b.url,
+                "healthy": b.healthy,
+                "outstanding": b.outstanding,
+                "requests": b.requests,
+                "failures": b.failures,
+            }
+            for b in self.backends
+        ]
+
+class BalancedModel(Runnable):
+    """
+    One chat model per backend behind a single Runnable; `build(url)`
+    creates the model for a backend. Composes like a plain chat model.
+    """
+
+    def __init__(self, pool: BackendPool, build):
+        self.pool = pool
+        self.models = {b.url: build(b.url) for b in pool.backends}
+
+    def _attempts(self) -> int:
+        return min(LLM_RETRIES + 1, len(self.pool.backends))
+
+    def invoke(self, input, config=None, **kwargs):
+        backend = self.pool.pick()
+        return self.models[backend.url].invoke(input, config, **kwargs)
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        tried = []
+        last = None
+        for _ in range(self._attempts()):
+            backend = self.pool.pick(exclude=tried)
+            if backend is None:
+                break
+            tried.append(backend)
+            backend.outstanding += 1
+            backend.requests += 1
+            try:
+                return await self.models[backend.url].ainvoke(input, config, **kwargs)
+            except BACKEND_ERRORS as e:
+                self.pool.eject(backend)
+                last = e
+            finally:
+                backend.outstanding -= 1
+        raise last
+
+    def _cache_key(self, input, kwargs):
+        # the (prompt, llm_string) pair a chat model's ainvoke looks up in
+        # its cache; None if the models are not cached. Every backend's
+        # model has the same llm_string (see PooledChatOllama)
+        model = next(iter(self.models.values()))
+        if not isinstance(model.cache, BaseCache):
+            return None
+        options = {k: v for k, v in kwargs.items() if k != "stop"}
+        messages = model._convert_input(input).to_messages()
+        return model.cache, dumps(messages), model._get_llm_string(stop=kwargs.get("stop"), **options)
+
+    async def astream(self, input, config=None, **kwargs):
+        # chat models only consult their cache on invoke, so streams of a
+        # cached model are answered from, and stored under, the same entry
+        # ainvoke uses; a hit is replayed as a single chunk
+        key = self._cache_key(input, kwargs)
+        if key is None:
+            async for chunk in self._astream(input, config, **kwargs):
+                yield chunk
+            return
+        cache, prompt, llm_string = key
+        hit = await cache.alookup(prompt, llm_string)
+        if hit:
+            yield AIMessageChunk(content=hit[0].text)
+            return
+        text = ""
+        async for chunk in self._astream(input, config, **kwargs):
+            text += chunk.content
+            yield chunk
+        # only a stream that ran to the end is stored
+        await cache.aupdate(prompt, llm_string, [ChatGeneration(message=AIMessage(content=text))])
+
+    async def _astream(self, input, config=None, **kwargs):
+        tried = []
+        last = None
+        for _ in range(self._attempts()):
+            backend = self.pool.pick(exclude=tried)
+            if backend is None:
+                break
+            tried.append(backend)
+            backend.outstanding += 1
+            backend.requests += 1
+            started = False
+            try:
+                async for chunk in self.models[backend.url].astream(input, config, **kwargs):
+                    started = True
+                    yield chunk
+                return
+            except BACKEND_ERRORS as e:
+                self.pool.eject(backend)
+                if started:
+                    raise
+                last = e
+            finally:
+                backend.outstanding -= 1
+        raise last
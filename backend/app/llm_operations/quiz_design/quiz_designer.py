@@ -0,0 +1,110 @@
+# Section quizzes.
+#
+# Once every lesson in a section is finished, the whole section's quiz is
+# written from the stored lesson summaries in one JSON-mode model call
+# (a few concurrent calls for long sections, QUIZ_BATCH_LESSONS lessons
+# each) and stored with a single bulk insert. A Redis claim makes sure only
+# one request per section does the work, however many finish at once.
+
+from typing import Any, Dict, List
+import os, asyncio
+
+from langchain_core.prompts import PromptTemplate
+
+import courses.database as db
+
+from llm_operations.llm_class import LLM
+from api_helpers.helper_functions import coerce_model_json, repair_model_json
+from api_helpers.session_helpers import r
+
+QUIZ_QUESTIONS_PER_LESSON = int(os.getenv("QUIZ_QUESTIONS_PER_LESSON", "2"))
+QUIZ_BATCH_LESSONS = int(os.getenv("QUIZ_BATCH_LESSONS", "6"))
+# how long a claim on a section lasts if its worker dies mid-generation
+QUIZ_CLAIM_TTL = int(os.getenv("QUIZ_CLAIM_TTL", "600"))
+
+# more options than this means the model ignored the prompt
+MAX_OPTIONS = 6
+
+QUIZ_PROMPT = PromptTemplate.from_template("""
+You are a teacher of a course called {course}. Your student has just finished a section of the course, and you are writing a multiple-choice quiz on it.
+
+Here are summaries of the lessons in the section:
+{summaries}
+
+Write exactly {count} questions covering these lessons. Each question must have four options, exactly one of which is correct, and must be answerable from the summaries alone.
+
+Return only a JSON object of this form:
+{{"questions": [{{"question": "...", "options": ["...", "...", "...", "..."], "answer": 0}}]}}
+where "answer" is the index of the correct option (starting at 0).
+""")
+
+def _format_summaries(lessons: List[Dict[str, Any]]) -> str:
+    return "\n\n".join([f"{l['title']}:\n{l['summary']}" for l in lessons])
+
+def _normalize_questions(obj) -> List[Dict[str, Any]]:
+    # keep only well-formed questions; one bad item shouldn't sink the batch
+    items = obj.get("questions", []) if isinstance(obj, dict) else obj
+    questions = []
+    for q in items if isinstance(items, list) else []:
+        if not isinstance(q, dict):
+            continue
+        text = str(q.get("question") or "").strip()
+        options = [str(o).strip() for o in q.get("options") or []][:MAX_OPTIONS]
+        try:
+            answer = int(q.get("answer"))
+        except (TypeError, ValueError):
+            continue
+        if not text or len(options) < 2 or not 0 <= answer < len(options):
+            continue
+        questions.append({
+            "quiz":    text,
+            "options": options,
+            "answer":  answer,
+        })
+    return questions
+
+async def _write_questions(course: str, lessons: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    chain = QUIZ_PROMPT | LLM.get_llm(purpose="quiz").bind(format="json")
+    raw = await chain.ainvoke({
+        "course":    course,
+        "summaries": _format_summaries(lessons),
+        "count":     QUIZ_QUESTIONS_PER_LESSON * len(lessons),
+    })
+    try:
+        obj = coerce_model_json(raw)
+    except ValueError as e:
+        obj = await repair_model_json(raw, str(e))
+    return _normalize_questions(obj)
+
+async def generate_section_quiz(section_id: int) -> List[int]:
+    """
+    Write and store the quiz for a section if all of its lessons are
+    finished and it has none yet. Returns the new quiz ids ([] if there
+    was nothing to do).
+    """
+    async with db.connection() as con:
+        lessons = await db.get_section_lessons(con, section_id)
+        if not lessons or any(l["status"] != 2 for l in lessons):
+            return []
+        if await db.get_quizzes(con, section_id):
+            return []
+        course_id = lessons[0]["course_id"]
+        course, _ = await db.get_course_info(con, course_id)
+
+    claim = f"quiz:section:{section_id}:claimed"
+    if not await r.set(claim, 1, nx=True, ex=QUIZ_CLAIM_TTL):
+        return []
+    try:
+        batches = [lessons[i:i + QUIZ_BATCH_LESSONS] for i in range(0, len(lessons), QUIZ_BATCH_LESSONS)]
+        results = await asyncio.gather(*[_write_questions(course, b) for b in batches])
+        questions = [q for batch in results for q in batch]
+        if not questions:
+            await r.delete(claim)
+            return []
+
+        async with db.connection() as con:
+            return await db.create_quizzes(con, course_id, section_id, questions)
+    except Exception:
+        # let the next finished lesson (or a retry) try again
+        await r.delete(claim)
+        raise
@@ -0,0 +1,282 @@
+# Admission control in front of the model host.
+#
+# Every LLM call made through LLM.get_llm() waits for one of
+# LLM_MAX_CONCURRENCY slots. Waiting calls are queued by priority class
+# (interactive calls such as routing, titles and Q&A answers before lesson
+# generation, and both before speculative background work) and, within a
+# class, round-robin across users so one user's burst can't starve others.
+# A call holds its slot until it completes, which for a lesson stream is the
+# whole generation, so LLM_INTERACTIVE_RESERVE slots are kept for
+# interactive calls: generation and background work never take the last
+# ones, and a question is answered while lessons stream.
+# When LLM_MAX_QUEUE calls are already waiting, new ones are refused with
+# SchedulerFull, which the API turns into 429 + Retry-After.
+#
+# Limits are per backend process.
+
+import os, time, asyncio, contextvars
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+from langchain_core.runnables import Runnable
+
+from api_helpers.metrics import Histogram, Counter
+
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "2"))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "64"))
+LLM_INTERACTIVE_RESERVE = int(os.getenv("LLM_INTERACTIVE_RESERVE", "1"))
+LLM_RETRY_AFTER = int(os.getenv("LLM_RETRY_AFTER", "5"))
+
+# priority classes, lowest value served first
+INTERACTIVE = 0
+GENERATION = 1
+BULK = 2
+
+PRIORITY_NAMES = {INTERACTIVE: "interactive", GENERATION: "generation", BULK: "bulk"}
+
+# purpose (as passed to LLM.get_llm) -> priority class; anything not listed
+# is interactive
+PURPOSE_PRIORITY = {
+    "lesson": GENERATION,
+    "exercise": GENERATION,
+    "quiz": BULK,
+    "rollup": BULK,
+}
+
+# set per request (user) or per background job (priority override)
+current_user = contextvars.ContextVar("llm_user", default=None)
+priority_override = contextvars.ContextVar("llm_priority", default=None)
+
+WAIT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+LLM_QUEUE_WAIT = Histogram(
+    "autodactyl_llm_queue_wait_seconds",
+    "Time LLM calls waited for a scheduler slot.",
+    ("priority",),
+)
+LLM_SECONDS = Histogram(
+    "autodactyl_llm_call_seconds",
+    "Duration of LLM calls once admitted (full completion or stream).",
+    ("purpose", "mode"),
+)
+LLM_FIRST_TOKEN = Histogram(
+    "autodactyl_llm_first_token_seconds",
+    "Time from admission to the first streamed chunk.",
+    ("purpose",),
+)
+LLM_PREFILL = Histogram(
+    "autodactyl_llm_prefill_seconds",
+    "Ollama prompt evaluation time (prompt_eval_duration).",
+    ("purpose",),
+)
+LLM_DECODE = Histogram(
+    "autodactyl_llm_decode_seconds",
+    "Ollama generation time (eval_duration).",
+    ("purpose",),
+)
+LLM_LOAD = Histogram(
+    "autodactyl_llm_load_seconds",
+    "Ollama model load time (load_duration).",
+    ("purpose",),
+)
+LLM_TOKENS = Counter(
+    "autodactyl_llm_tokens_total",
+    "Tokens processed by Ollama: prompt (prompt_eval_count) and completion (eval_count).",
+    ("purpose", "kind"),
+)
+
+def record_ollama_stats(purpose: str, metadata: dict):
+    # Ollama reports durations in nanoseconds; calls answered from the
+    # response cache carry the stats of the original generation
+    if not metadata or metadata.get("eval_count") is None:
+        return
+    LLM_TOKENS.inc(metadata.get("prompt_eval_count") or 0, purpose=purpose, kind="prompt")
+    LLM_TOKENS.inc(metadata.get("eval_count") or 0, purpose=purpose, kind="completion")
+    for hist, field in ((LLM_PREFILL, "prompt_eval_duration"), (LLM_DECODE, "eval_duration"), (LLM_LOAD, "load_duration")):
+        if metadata.get(field) is not None:
+            hist.observe(metadata[field] / 1e9, purpose=purpose)
+
+class SchedulerFull(Exception):
+    def __init__(self, retry_after: int = LLM_RETRY_AFTER):
+        super().__init__("The model is busy, please retry shortly")
+        self.retry_after = retry_after
+
+class LLMScheduler:
+
+    def __init__(self, max_concurrency: int = LLM_MAX_CONCURRENCY, max_queue: int = LLM_MAX_QUEUE,
+                 interactive_reserve: int = LLM_INTERACTIVE_RESERVE):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        # at least one slot stays open to the other classes
+        self.interactive_reserve = max(0, min(interactive_reserve, max_concurrency - 1))
+        self._active = 0
+        # slots held by generation and background calls
+        self._active_background = 0
+        self._waiting = 0
+        # priority -> OrderedDict(user -> deque of futures)
+        self._queues = {p: OrderedDict() for p in PRIORITY_NAMES}
+        self._stats = {
+            "admitted": 0,
+            "rejected": 0,
+            "wait_seconds_sum": 0.0,
+            "wait_seconds_max": 0.0,
+            "wait_buckets": [0] * len(WAIT_BUCKETS),
+        }
+
+    def _can_admit(self, priority: int) -> bool:
+        if self._active >= self.max_concurrency:
+            return False
+        return priority == INTERACTIVE or self._active_background < self.max_concurrency - self.interactive_reserve
+
+    def _take(self, priority: int):
+        self._active += 1
+        if priority != INTERACTIVE:
+            self._active_background += 1
+
+    def is_full(self) -> bool:
+        return self._active >= self.max_concurrency and self._waiting >= self.max_queue
+
+    def _record_wait(self, seconds: float, priority: int):
+        LLM_QUEUE_WAIT.observe(seconds, priority=PRIORITY_NAMES[priority])
+        st = self._stats
+        st["admitted"] += 1
+        st["wait_seconds_sum"] += seconds
+        st["wait_seconds_max"] = max(st["wait_seconds_max"], seconds)
+        for i, bound in enumerate(WAIT_BUCKETS):
+            if seconds <= bound:
+                st["wait_buckets"][i] += 1
+
+    async def acquire(self, priority: int, user):
+        start = time.perf_counter()
+        # calls of this class or a higher one that are already waiting go
+        # first; lower classes may be waiting only for the reserve
+        ahead = any(self._queues[p] for p in self._queues if p <= priority)
+        if self._can_admit(priority) and not ahead:
+            self._take(priority)
+            self._record_wait(0.0, priority)
+            return
+        if self._waiting >= self.max_queue:
+            self._stats["rejected"] += 1
+            raise SchedulerFull()
+
+        fut = asyncio.get_running_loop().create_future()
+        self._queues[priority].setdefault(user, deque()).append(fut)
+        self._waiting += 1
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # the slot was granted just as we were cancelled
+                self.release(priority)
+            else:
+                self._discard(priority, user, fut)
+            raise
+        self._record_wait(time.perf_counter() - start, priority)
+
+    def _discard(self, priority: int, user, fut):
+        users = self._queues[priority]
+        q = users.get(user)
+        if q is not None and fut in q:
+            q.remove(fut)
+            self._waiting -= 1
+            if not q:
+                del users[user]
+
+    def release(self, priority: int = INTERACTIVE):
+        self._active -= 1
+        if priority != INTERACTIVE:
+            self._active_background -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        while self._active < self.max_concurrency and self._waiting:
+            # highest class with waiters that may take a slot now
+            for p in sorted(self._queues):
+                users = self._queues[p]
+                if users and self._can_admit(p):
+                    break
+            else:
+                return
+            user, q = next(iter(users.items()))
+            fut = q.popleft()
+            self._waiting -= 1
+            # round-robin: this user goes to the back of its class
+            if q:
+                users.move_to_end(user)
+            else:
+                del users[user]
+            if fut.done():
+                continue
+            self._take(p)
+            fut.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, priority: int = INTERACTIVE, user=None):
+        override = priority_override.get()
+        if override is not None:
+            priority = override
+        if user is None:
+            user = current_user.get()
+        await self.acquire(priority, user)
+        try:
+            yield
+        finally:
+            self.release(priority)
+
+    def stats(self) -> dict:
+        return {
+            "active": self._active,
+            "active_background": self._active_background,
+            "max_concurrency": self.max_concurrency,
+            "interactive_reserve": self.interactive_reserve,
+            "queue_depth": self._waiting,
+            "max_queue": self.max_queue,
+            "queue_depth_by_class": {
+                PRIORITY_NAMES[p]: sum(len(q) for q in users.values())
+                for p, users in self._queues.items()
+            },
+            **self._stats,
+            "wait_bucket_bounds": list(WAIT_BUCKETS),
+        }
+
+scheduler = LLMScheduler()
+
+class ScheduledModel(Runnable):
+    """
+    Wraps a chat model so every async call first takes a scheduler slot.
+    Composes like the model itself (prompt | model, .bind(...)).
+    """
+
+    def __init__(self, model, priority: int = INTERACTIVE, purpose: str = None):
+        self.model = model
+        self.priority = priority
+        self.purpose = purpose or "default"
+
+    def invoke(self, input, config=None, **kwargs):
+        # sync calls are not used on the request path; pass straight through
+        return self.model.invoke(input, config, **kwargs)
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        async with scheduler.slot(self.priority):
+            start = time.perf_counter()
+            result = await self.model.ainvoke(input, config, **kwargs)
+            LLM_SECONDS.observe(time.perf_counter() - start, purpose=self.purpose, mode="invoke")
+            record_ollama_stats(self.purpose, getattr(result, "response_metadata", None))
+            return result
+
+    async def astream(self, input, config=None, **kwargs):
+        async with scheduler.slot(self.priority):
+            start = time.perf_counter()
+            first = True
+            metadata = None
+            async for chunk in self.model.astream(input, config, **kwargs):
+                if first:
+                    LLM_FIRST_TOKEN.observe(time.perf_counter() - start, purpose=self.purpose)
+                    first = False
+                # the final chunk carries Ollama's eval stats
+                meta = getattr(chunk, "response_metadata", None)
+                if meta and meta.get("eval_count") is not None:
+                    metadata = meta
+                yield chunk
+            LLM_SECONDS.observe(time.perf_counter() - start, purpose=self.purpose, mode="stream")
+            record_ollama_stats(self.purpose, metadata)
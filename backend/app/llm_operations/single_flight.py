@@ -0,0 +1,83 @@
+# Single-flight coalescing for expensive generations.
+#
+# Concurrent callers asking for the same key (e.g. a lesson id after a
+# double-clicked "Start") share one run of the work instead of each starting
+# their own. Within a worker the followers await the leader's future. Across
+# workers a Redis lease (SET NX PX) elects the leader; the others poll for
+# the result it publishes, or take over if the lease lapses without one.
+#
+# Results must be JSON-serialisable, since they are shared through Redis.
+
+import os, json, uuid, asyncio
+
+from api_helpers.session_helpers import r
+
+SINGLE_FLIGHT_LEASE = float(os.getenv("SINGLE_FLIGHT_LEASE", "300"))
+SINGLE_FLIGHT_RESULT_TTL = int(os.getenv("SINGLE_FLIGHT_RESULT_TTL", "30"))
+SINGLE_FLIGHT_POLL = float(os.getenv("SINGLE_FLIGHT_POLL", "0.25"))
+
+# compare-and-delete, so a leader never releases a lease that has already
+# lapsed and been taken by someone else
+_RELEASE_LUA = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+_inflight: dict[str, asyncio.Future] = {}
+
+def _lock_key(key: str) -> str:
+    return f"singleflight:lock:{key}"
+
+def _result_key(key: str) -> str:
+    return f"singleflight:result:{key}"
+
+def is_inflight(key: str) -> bool:
+    return key in _inflight
+
+async def _run_with_lease(key: str, fn, lease: float):
+    token = str(uuid.uuid4())
+    while True:
+        # a result published moments ago (e.g. by another worker) is reused
+        raw = await r.get(_result_key(key))
+        if raw is not None:
+            return json.loads(raw), False
+        if await r.set(_lock_key(key), token, nx=True, px=int(lease * 1000)):
+            try:
+                result = await fn()
+                await r.set(_result_key(key), json.dumps(result), ex=SINGLE_FLIGHT_RESULT_TTL)
+                return result, True
+            finally:
+                await r.eval(_RELEASE_LUA, 1, _lock_key(key), token)
+        await asyncio.sleep(SINGLE_FLIGHT_POLL)
+
+async def single_flight(key: str, fn, lease: float = SINGLE_FLIGHT_LEASE):
+    """
+    Run `await fn()` once for all concurrent callers of `key`.
+
+    Returns (result, leader): `leader` is True only for the caller whose
+    call actually ran `fn`, so followers can skip side effects (persisting,
+    appending messages) that the leader already performs.
+    """
+    fut = _inflight.get(key)
+    if fut is not None:
+        result, _ = await asyncio.shield(fut)
+        return result, False
+
+    fut = asyncio.get_running_loop().create_future()
+    # mark the exception as retrieved even when nobody else was waiting
+    fut.add_done_callback(lambda f: f.cancelled() or f.exception())
+    _inflight[key] = fut
+    try:
+        outcome = await _run_with_lease(key, fn, lease)
+        fut.set_result(outcome)
+        return outcome
+    except asyncio.CancelledError:
+        fut.cancel()
+        raise
+    except Exception as e:
+        fut.set_exception(e)
+        raise
+    finally:
+        _inflight.pop(key, None)
@@ -1,16 +1,26 @@
 from fastapi import FastAPI, Depends, Query, Request, Response, HTTPException
-from fastapi.responses import JSONResponse, PlainTextResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from psycopg import Connection
+from psycopg import AsyncConnection
 import uuid, bcrypt
-import os
+import os, time, hmac
 
 import api_helpers.session_helpers as session
 from api_helpers.helper_classes import ChatRoutes, ChatMsg, ApproveMsg, LogIn
-from api_helpers.helper_functions import coerce_model_json
+from api_helpers.helper_functions import coerce_model_json, repair_model_json, sse_event, spawn_background
+import api_helpers.metrics as metrics
+from api_helpers.metrics import span
 
 import courses.database as db
+import courses.revisions as revisions
+from api_helpers.response_cache import conditional_json
 import llm_operations.course_building.course_builder as course_builder
+from llm_operations.course_teaching.course_teacher import LessonSession, pregenerate_lesson
+from llm_operations.course_teaching.pregeneration import Pregenerator
+import llm_operations.course_teaching.pregeneration as pregeneration
+import llm_operations.exercise_design.exercise_designer as exercise_designer
+from llm_operations.llm_class import LLM
+from llm_operations.scheduler import scheduler, current_user, SchedulerFull
 
 SESSION_COOKIE = "sid"
 SESSION_TTL = 60 * 60 * 24
@@ -28,32 +38,138 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# ---- Metrics ----
+
+# /metrics and /api/stats describe the whole deployment, so they answer only
+# to "Authorization: Bearer <METRICS_TOKEN>"; without a token set they are off
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+async def require_metrics_token(request: Request):
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.strip().encode(), METRICS_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Not authenticated", headers={"WWW-Authenticate": "Bearer"})
+
+HTTP_SECONDS = metrics.Histogram(
+    "autodactyl_http_request_seconds",
+    "Time to produce a response (for SSE streams, until the stream starts).",
+    ("method", "route", "status"),
+)
+
+def _numeric(stats: dict) -> dict:
+    return {(k,): v for k, v in stats.items() if isinstance(v, (int, float))}
+
+metrics.Gauge("autodactyl_db_pool", "Postgres connection pool state.",
+              lambda: _numeric(db.pool_stats()), ("stat",))
+metrics.Gauge("autodactyl_llm_scheduler_active", "LLM calls holding a scheduler slot.",
+              lambda: scheduler.stats()["active"])
+metrics.Gauge("autodactyl_llm_scheduler_queued", "LLM calls waiting for a slot, by priority class.",
+              lambda: {(k,): v for k, v in scheduler.stats()["queue_depth_by_class"].items()}, ("priority",))
+metrics.Gauge("autodactyl_llm_backend_outstanding", "LLM calls in flight per Ollama host.",
+              lambda: {(b["url"],): b["outstanding"] for b in LLM.get_pool().stats()}, ("url",))
+metrics.Gauge("autodactyl_llm_backend_healthy", "1 if the Ollama host is in rotation.",
+              lambda: {(b["url"],): b["healthy"] for b in LLM.get_pool().stats()}, ("url",))
+metrics.Gauge("autodactyl_llm_cache", "Persistent LLM response cache.",
+              lambda: _numeric(LLM.get_cache().stats()), ("stat",))
+metrics.Gauge("autodactyl_lesson_cache", "In-process lesson cache and write-behind state.",
+              lambda: _numeric(LessonSession.stats()), ("stat",))
+metrics.Gauge("autodactyl_session_cache", "In-process session cache.",
+              lambda: _numeric(session.session_cache_stats()), ("stat",))
+metrics.Gauge("autodactyl_password_hasher_pending", "bcrypt jobs running or queued.",
+              lambda: session.hasher_stats()["pending"])
+
+@app.middleware("http")
+async def record_request_time(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # label by route template, not raw path, to keep label sets small
+        route = request.scope.get("route")
+        HTTP_SECONDS.observe(
+            time.perf_counter() - start,
+            method=request.method,
+            route=getattr(route, "path", "unmatched"),
+            status=status,
+        )
+
 @app.on_event("startup")
-def on_startup():
+async def on_startup():
     try:
-        db.init_db()
+        await db.open_pool()
+        await db.init_db()
+        LessonSession.start()
+        Pregenerator.start(pregenerate_lesson)
+        LLM.get_pool().start()
     except Exception as e:
         import traceback
         traceback.print_exc()
 
-def get_conn():
-    con = db.open_db()
-    try:
+@app.on_event("shutdown")
+async def on_shutdown():
+    await Pregenerator.stop()
+    await LLM.get_pool().stop()
+    await LessonSession.stop()
+    await db.close_pool()
+    session.shutdown_hasher()
+
+async def get_conn():
+    async with db.connection() as con:
         yield con
-    finally:
-        con.close()
+
+def busy_response(e: SchedulerFull):
+    return JSONResponse(
+        {"ok": False, "error": str(e)},
+        status_code=429,
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
+@app.exception_handler(SchedulerFull)
+async def scheduler_full_handler(request: Request, e: SchedulerFull):
+    return busy_response(e)
+
+@app.exception_handler(session.PasswordHasherBusy)
+async def hasher_busy_handler(request: Request, e: session.PasswordHasherBusy):
+    return JSONResponse(
+        {"ok": False, "error": str(e)},
+        status_code=503,
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
+@app.get("/metrics", dependencies=[Depends(require_metrics_token)])
+async def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 @app.get("/healthz")
-def healthz():
+async def healthz():
     return PlainTextResponse("ok")
 
+@app.get("/api/stats", dependencies=[Depends(require_metrics_token)])
+async def stats():
+    return {"ok": True, "result": {
+        "db_pool": db.pool_stats(),
+        "lesson_cache": LessonSession.stats(),
+        "llm_cache": LLM.get_cache().stats(),
+        "llm_scheduler": scheduler.stats(),
+        "llm_backends": LLM.get_pool().stats(),
+        "password_hasher": session.hasher_stats(),
+    }}
+
 # ---- Route ----
 
 @app.post("/api/login")
-async def login(data: LogIn, response: Response, con: Connection = Depends(get_conn)):
-    user = db.get_user_by_username(con, data.username)
-    if not user or not session.verify_password(data.password, user["password_hash"]):
+async def login(data: LogIn, response: Response, con: AsyncConnection = Depends(get_conn)):
+    user = await db.get_user_by_username(con, data.username)
+    if not user or not await session.verify_password(data.password, user["password_hash"]):
         raise HTTPException(status_code=401, detail="Invalid credentials")
+    if session.needs_rehash(user["password_hash"]):
+        # BCRYPT_ROUNDS changed since this hash was made; upgrade it while
+        # the plain password is at hand, without holding up the login
+        spawn_background(rehash_password(user["id"], data.password))
 
     sid = await session.create_session(user["id"])
     response.set_cookie(
@@ -67,6 +183,11 @@ async def login(data: LogIn, response: Response, con: Connection = Depends(get_c
     )
     return {"ok": True}
 
+async def rehash_password(user_id: int, password: str):
+    hashed = await session.hash_password(password)
+    async with db.connection() as con:
+        await db.update_password_hash(con, user_id, hashed)
+
 @app.post("/api/logout")
 async def logout(request: Request, response: Response):
     sid = request.cookies.get(SESSION_COOKIE)
@@ -76,32 +197,39 @@ async def logout(request: Request, response: Response):
     return {"ok": True}
 
 @app.get("/api/me")
-async def me(user_id: str = Depends(session.require_user_id), con: Connection = Depends(get_conn)):
-    user = db.get_user_by_id(con, user_id)
+async def me(user_id: str = Depends(session.require_user_id), con: AsyncConnection = Depends(get_conn)):
+    user = await db.get_user_by_id(con, user_id)
     return {"ok": True, "result": user}; 
 
 @app.post("/api/register")
-def register(data: LogIn, con: Connection = Depends(get_conn)):
-    exists = db.get_user_by_username(con, data.username)
+async def register(data: LogIn, con: AsyncConnection = Depends(get_conn)):
+    exists = await db.get_user_by_username(con, data.username)
     print(f"{exists}")
     if exists:
         raise HTTPException(status_code=400, detail="Username already registered")
     
-    hashed = session.hash_password(data.password)
-    db.create_user(con, data.username, hashed)
+    hashed = await session.hash_password(data.password)
+    await db.create_user(con, data.username, hashed)
     return {"ok": True}
 
 @app.post("/api/chat")
-def chat(payload: ChatMsg):
+async def chat(payload: ChatMsg, user_id: str | None = Depends(session.get_session_user_id)):
     print(f"{payload}")
     func = ChatRoutes.functions.get(payload.purpose)
+    # fair queuing in the LLM scheduler is per user (or per session)
+    current_user.set(user_id or payload.session_id)
     try:
-        raw = func(message=payload.message, session_id=payload.session_id)
         if not func:
             raise HTTPException(status_code=400, detail=f"Unknown purpose '{payload.purpose}'")
-       
-        obj = coerce_model_json(raw)
-        
+        with span(f"chat.{payload.purpose}"):
+            raw = await func(message=payload.message, session_id=payload.session_id)
+
+        with span("chat.coerce_json"):
+            try:
+                obj = coerce_model_json(raw)
+            except ValueError as e:
+                obj = await repair_model_json(raw, str(e))
+
         # If obj["draft"] exists and is itself a JSON string, parse that too
         if isinstance(obj, dict) and "draft" in obj:
             draft = obj.get("draft")
@@ -110,56 +238,224 @@ def chat(payload: ChatMsg):
                     obj["draft"] = coerce_model_json(draft)
                 except Exception:
                     pass  # leave as-is if not valid
-            course_builder.set_draft(obj["draft"])
+            await course_builder.set_draft(payload.session_id, obj["draft"])
         return JSONResponse({"ok": True, "result": obj})
+    except HTTPException:
+        raise
+    except SchedulerFull as e:
+        return busy_response(e)
     except Exception as e:
         return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
 
+@app.post("/api/chat/stream")
+async def chat_stream(payload: ChatMsg, user_id: str | None = Depends(session.get_session_user_id)):
+    print(f"{payload}")
+    func = ChatRoutes.streams.get(payload.purpose)
+    if not func:
+        raise HTTPException(status_code=400, detail=f"Purpose '{payload.purpose}' cannot be streamed")
+    # shed load before the stream starts; once it has, errors can only be
+    # reported as events
+    if scheduler.is_full():
+        return busy_response(SchedulerFull())
+    current_user.set(user_id or payload.session_id)
+
+    async def events():
+        try:
+            with span(f"chat_stream.{payload.purpose}"):
+                async for event, data in func(message=payload.message, session_id=payload.session_id):
+                    yield sse_event(event, data)
+        except Exception as e:
+            yield sse_event("error", {"ok": False, "error": str(e)})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 @app.post("/api/approve")
-def approve(payload: ApproveMsg, con: Connection = Depends(get_conn), user_id: int = Depends(session.get_session_user_id)):
+async def approve(payload: ApproveMsg, con: AsyncConnection = Depends(get_conn), user_id: int = Depends(session.get_session_user_id)):
     try:
-        result = course_builder.approve_course(con, session_id=payload.session_id, user_id=user_id)
+        result = await course_builder.approve_course(con, session_id=payload.session_id, user_id=user_id)
         return JSONResponse({"ok": True, "result": result})
     except Exception as e:
         return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
 
+@app.post("/api/cancel-pregeneration")
+async def cancel_pregeneration(course_id: int = Query(..., ge=1), user_id: str = Depends(session.require_user_id)):
+    try:
+        async with db.connection() as con:
+            owner = await db.course_owner_id(con, course_id)
+        # someone else's course is reported as missing, not as forbidden
+        if owner is None or str(owner) != str(user_id):
+            return JSONResponse({"ok": False, "error": "Course not found"}, status_code=404)
+        await pregeneration.cancel_course(course_id)
+        return {"ok": True}
+    except Exception as e:
+        return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
+
+# Read endpoints below answer through conditional_json: ETags and cached
+# bodies are versioned by revision counters bumped on every write (see
+# courses/revisions.py), and Postgres is only queried when the cached body
+# for the current revision is missing.
+
+async def section_course(section_id: int):
+    course_id = await revisions.parent_course("section", section_id)
+    if course_id is None:
+        async with db.connection() as con:
+            course_id = await db.section_course_id(con, section_id)
+    return course_id
+
+async def lesson_course(lesson_id: int):
+    course_id = await revisions.parent_course("lesson", lesson_id)
+    if course_id is None:
+        async with db.connection() as con:
+            course_id = await db.lesson_course_id(con, lesson_id)
+    return course_id
+
 # add user_id (wrapped in helper class)
 @app.get("/api/list-courses")
-def list_courses(con: Connection = Depends(get_conn), user_id: int = Depends(session.get_session_user_id)):
+async def list_courses(request: Request, user_id: int = Depends(session.get_session_user_id)):
+    async def build():
+        async with db.connection() as con:
+            return await db.get_all_courses(con, user_id)
     try:
-        courses = db.get_all_courses(con, user_id)
-        return {"ok": True, "result": courses}
+        if user_id is None:
+            return {"ok": True, "result": await build()}
+        return await conditional_json(request, revisions.user_key(user_id), f"courses:{user_id}", build)
     except Exception as e:
         return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
 
 @app.get("/api/list-sections")
-def list_sections(course_id: int = Query(..., ge=1), con: Connection = Depends(get_conn)):
+async def list_sections(request: Request, course_id: int = Query(..., ge=1)):
+    async def build():
+        async with db.connection() as con:
+            sections = await db.get_sections(con, course_id)
+        await revisions.remember_parents("section", course_id, [s["id"] for s in sections])
+        return sections
     try:
-        sections = db.get_sections(con, course_id)
-        return {"ok": True, "result": sections}
+        return await conditional_json(request, revisions.course_key(course_id), f"sections:{course_id}", build)
     except Exception as e:
         return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
 
 @app.get("/api/list-lessons")
-def list_lessons(section_id: int = Query(..., ge=1), con: Connection = Depends(get_conn)):
+async def list_lessons(request: Request, section_id: int = Query(..., ge=1)):
     try:
-        lessons = db.get_lessons(con, section_id)
-        return {"ok": True, "result": lessons}
+        course_id = await section_course(section_id)
+        if course_id is None:
+            return {"ok": True, "result": []}
+
+        async def build():
+            async with db.connection() as con:
+                lessons = await db.get_lessons(con, section_id)
+            await revisions.remember_parents("lesson", course_id, [l["id"] for l in lessons])
+            return lessons
+        return await conditional_json(request, revisions.course_key(course_id), f"lessons:{section_id}", build)
+    except Exception as e:
+        return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
+
+@app.get("/api/course-tree")
+async def course_tree(
+    request: Request,
+    course_id: int = Query(..., ge=1),
+    fields: str = Query("", description="comma-separated extras: " + ", ".join(sorted(db.TREE_FIELDS))),
+):
+    # the whole course in one round-trip; heavy text only if asked for
+    wanted = {f.strip() for f in fields.split(",") if f.strip()}
+    if wanted - db.TREE_FIELDS:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(wanted - db.TREE_FIELDS))}")
+
+    async def build():
+        async with db.connection() as con:
+            tree = await db.get_course_tree(con, course_id, wanted)
+        if tree is None:
+            raise LookupError("Course not found")
+        return tree
+    try:
+        name = f"tree:{course_id}:{','.join(sorted(wanted))}"
+        return await conditional_json(request, revisions.course_key(course_id), name, build)
+    except LookupError as e:
+        return JSONResponse({"ok": False, "error": str(e)}, status_code=404)
+    except Exception as e:
+        return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
+
+@app.get("/api/lesson")
+async def lesson_detail(lesson_id: int = Query(..., ge=1), tail: int | None = Query(None, ge=1)):
+    # one lesson's body and transcript, loaded when it is opened. The
+    # lesson fields come from LessonSession, which may hold changes that
+    # haven't been flushed to Postgres yet
+    try:
+        lesson = await LessonSession.get_lesson(lesson_id)
+        if lesson is None:
+            return JSONResponse({"ok": False, "error": "Lesson not found"}, status_code=404)
+        async with db.connection() as con:
+            messages = await db.get_lesson_messages(con, lesson_id, tail=tail)
+        return {"ok": True, "result": {
+            "id":          lesson["id"],
+            "title":       lesson["title"],
+            "description": lesson["description"],
+            "status":      lesson["status"],
+            "body_md":     lesson["body_md"],
+            "summary":     lesson["summary"],
+            "messages":    messages,
+        }}
+    except Exception as e:
+        return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
+
+@app.get("/api/list-quizzes")
+async def list_quizzes(request: Request, section_id: int = Query(..., ge=1)):
+    try:
+        course_id = await section_course(section_id)
+        if course_id is None:
+            return {"ok": True, "result": []}
+
+        async def build():
+            async with db.connection() as con:
+                return await db.get_quizzes(con, section_id)
+        return await conditional_json(request, revisions.course_key(course_id), f"quizzes:{section_id}", build)
     except Exception as e:
         return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
 
 @app.get("/api/list-exercises")
-def list_exercises(lesson_id: int = Query(..., ge=1), con: Connection = Depends(get_conn)):
+async def list_exercises(request: Request, lesson_id: int = Query(..., ge=1)):
+    try:
+        course_id = await lesson_course(lesson_id)
+        if course_id is None:
+            return {"ok": True, "result": []}
+
+        async def build():
+            async with db.connection() as con:
+                return await db.get_all_exercises(con, lesson_id)
+        return await conditional_json(request, revisions.course_key(course_id), f"exercises:{lesson_id}", build)
+    except Exception as e:
+        return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
+
+@app.post("/api/new-exercise")
+async def new_exercise(
+    l_id: int = Query(..., ge=1),
+    count: int = Query(1, ge=1, le=exercise_designer.EXERCISE_BATCH_MAX),
+    user_id: str = Depends(session.require_user_id),
+):
+    current_user.set(user_id)
     try:
-        exercises = db.get_all_exercises(con, lesson_id)
+        course_id = await lesson_course(l_id)
+        owner = None
+        if course_id is not None:
+            async with db.connection() as con:
+                owner = await db.course_owner_id(con, course_id)
+        if owner is None or str(owner) != str(user_id):
+            return JSONResponse({"ok": False, "error": "Lesson not found"}, status_code=404)
+        exercises = await exercise_designer.create_exercises(l_id, count)
         return {"ok": True, "result": exercises}
+    except SchedulerFull as e:
+        return busy_response(e)
     except Exception as e:
         return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
 
 @app.get("/api/get-exercise")
-def get_exercise(ex_id: int = Query(..., ge=1), con: Connection = Depends(get_conn)):
+async def get_exercise(ex_id: int = Query(..., ge=1), con: AsyncConnection = Depends(get_conn)):
     try:
-        exercise = db.get_exercise(con, ex_id)
+        exercise = await db.get_exercise(con, ex_id)
         return {"ok": True, "result": exercise}
     except Exception as e:
         return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
@@ -0,0 +1,93 @@
+# Approving a generated course draft: create_course_tree (one transaction,
+# batched inserts) against the row-by-row writes approve_course used before
+# (one INSERT and one commit per course, section and lesson).
+#
+#   cd backend && TEST_DATABASE_URL=... python tests/bench_approve_course.py [--lessons 200] [--per-section 10] [--runs 5]
+#
+# Needs TEST_DATABASE_URL (a database that may be written to) and Redis at
+# REDIS_URL, since both paths bump the course revisions as they would in a
+# request. Courses are created under a throwaway user, which is deleted
+# (with everything under it) at the end. Reports the median and worst time
+# to write one course.
+
+import os, sys, time, uuid, asyncio, argparse, statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+
+if not os.getenv("TEST_DATABASE_URL"):
+    sys.exit("TEST_DATABASE_URL is not set")
+os.environ["DATABASE_URL"] = os.environ["TEST_DATABASE_URL"]
+
+import courses.database as db
+
+def draft(lessons: int, per_section: int) -> list:
+    # the normalized shape _validate_draft produces
+    sections = []
+    for s in range(0, lessons, per_section):
+        sections.append({
+            "title": f"Section {len(sections) + 1}",
+            "position": len(sections) + 1,
+            "lessons": [
+                {"title": f"Lesson {n + 1}", "description": f"What lesson {n + 1} covers, in a sentence or two.", "position": n - s + 1}
+                for n in range(s, min(s + per_section, lessons))
+            ],
+        })
+    return sections
+
+async def row_by_row(con, user_id: int, title: str, sections: list) -> int:
+    course_id = await db.create_course(con, user_id=user_id, title=title, slug=await db.unique_slug(con, title), description="")
+    for sec in sections:
+        section_id = await db.create_section(con, course_id=course_id, title=sec["title"], position=sec["position"])
+        for l in sec["lessons"]:
+            await db.create_lesson(con, course_id=course_id, section_id=section_id, title=l["title"], description=l["description"], position=l["position"])
+    return course_id
+
+async def batched(con, user_id: int, title: str, sections: list) -> int:
+    return await db.create_course_tree(con, user_id, title, title, "", sections)
+
+async def measure(write, user_id: int, sections: list, runs: int) -> list:
+    times = []
+    for _ in range(runs):
+        title = f"bench-{uuid.uuid4().hex[:12]}"
+        async with db.connection() as con:
+            start = time.perf_counter()
+            await write(con, user_id, title, sections)
+            times.append(time.perf_counter() - start)
+    return times
+
+def report(name: str, times: list):
+    print(f"{name:>12}: median {statistics.median(times) * 1000:8.1f}ms   worst {max(times) * 1000:8.1f}ms")
+
+async def bench(args):
+    sections = draft(args.lessons, args.per_section)
+    await db.open_pool()
+    try:
+        await db.init_db()
+        async with db.connection() as con:
+            async with con.cursor() as cur:
+                await cur.execute(
+                    "INSERT INTO users(username, password_hash) VALUES (%s, 'x') RETURNING id",
+                    (f"bench-{uuid.uuid4().hex[:12]}",),
+                )
+                user_id = (await cur.fetchone())["id"]
+            await con.commit()
+        try:
+            print(f"{args.lessons} lessons in {len(sections)} sections, {args.runs} runs each")
+            report("row by row", await measure(row_by_row, user_id, sections, args.runs))
+            report("batched", await measure(batched, user_id, sections, args.runs))
+        finally:
+            async with db.connection() as con:
+                await con.execute("DELETE FROM users WHERE id = %s", (user_id,))
+                await con.commit()
+    finally:
+        await db.close_pool()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lessons", type=int, default=200)
+    parser.add_argument("--per-section", type=int, default=10)
+    parser.add_argument("--runs", type=int, default=5)
+    asyncio.run(bench(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
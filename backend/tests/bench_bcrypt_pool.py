@@ -0,0 +1,50 @@
+# Login throughput through the bcrypt pool, against bcrypt on the event loop.
+#
+#   cd backend && python tests/bench_bcrypt_pool.py [--logins 64] [--rounds 12]
+#
+# Each "login" is one verify_password. Reports logins per second and the
+# worst event-loop stall seen while they ran; on the loop, every login
+# stalls every other request for the full cost of a bcrypt call.
+
+import os, sys, time, asyncio, argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+
+import bcrypt
+
+import api_helpers.session_helpers as session
+from test_bcrypt_pool import _max_loop_lag
+
+async def on_loop(password: str, hashed: str, n: int):
+    # what login did before the pool: checkpw straight on the event loop
+    for _ in range(n):
+        bcrypt.checkpw(password.encode(), hashed.encode())
+        await asyncio.sleep(0)
+
+async def pooled(password: str, hashed: str, n: int):
+    # admitted in waves no larger than the pool accepts, as a burst of
+    # logins would be (the rest would get a 503)
+    wave = session.BCRYPT_WORKERS + session.BCRYPT_QUEUE_LIMIT
+    for i in range(0, n, wave):
+        await asyncio.gather(*[session.verify_password(password, hashed) for _ in range(min(wave, n - i))])
+
+def run(name: str, work, n: int):
+    start = time.perf_counter()
+    lag = asyncio.run(_max_loop_lag(work))
+    elapsed = time.perf_counter() - start
+    print(f"{name:>10}: {n / elapsed:7.1f} logins/s   worst loop stall {lag * 1000:7.1f}ms")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--logins", type=int, default=64)
+    parser.add_argument("--rounds", type=int, default=session.BCRYPT_ROUNDS)
+    args = parser.parse_args()
+
+    hashed = bcrypt.hashpw(b"secret", bcrypt.gensalt(rounds=args.rounds)).decode()
+    print(f"{args.logins} logins, cost {args.rounds}, {session.BCRYPT_WORKERS} bcrypt workers")
+    run("on loop", on_loop("secret", hashed, args.logins), args.logins)
+    run("pooled", pooled("secret", hashed, args.logins), args.logins)
+    session.shutdown_hasher()
+
+if __name__ == "__main__":
+    main()
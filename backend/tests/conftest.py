@@ -0,0 +1,17 @@
+# Run from backend/:  pip install -r requirements-dev.txt && python -m pytest
+#
+# The app's modules import each other from backend/app (its working
+# directory under uvicorn), so that directory goes on sys.path here.
+# Tests that need Postgres read TEST_DATABASE_URL and are skipped without
+# it; courses.database insists on DATABASE_URL at import, so everything
+# else gets a placeholder that is never connected to.
+
+import os, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+
+if os.getenv("TEST_DATABASE_URL"):
+    os.environ["DATABASE_URL"] = os.environ["TEST_DATABASE_URL"]
+os.environ.setdefault("DATABASE_URL", "postgresql://localhost/autodactyl_test")
+# deterministic embeddings, no model host needed
+os.environ.setdefault("EMBEDDING_MODEL", "stub")
@@ -0,0 +1,119 @@
+# Context budgeting for lesson Q&A (build_answer_context in
+# course_teacher.py and fold_context_summary in lesson_helpers.py). The
+# database and the model are replaced by in-memory fakes.
+
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+
+pytest.importorskip("langchain_ollama")
+
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import RunnableLambda
+
+import courses.database as db
+import llm_operations.course_teaching.lesson_helpers as hlpr
+import llm_operations.course_teaching.course_teacher as teacher
+from llm_operations.llm_class import LLM
+
+BUDGET = 100
+
+def _turn(seq: int, chars: int = 200) -> dict:
+    text = f"turn {seq} "
+    return {"id": 1, "seq": seq, "role": "user", "content": (text * chars)[:chars]}
+
+class FakeStore:
+    # stands in for lesson_messages and the summarizing model
+    def __init__(self, turns):
+        self.turns = turns
+        self.folded = []
+
+    @asynccontextmanager
+    async def connection(self):
+        yield None
+
+    async def get_lesson_messages_between(self, con, lid, after_seq, before_seq):
+        return [m for m in self.turns if after_seq < m["seq"] < before_seq]
+
+    async def fold_context_summary(self, summary, messages):
+        self.folded.append([m["seq"] for m in messages])
+        return f"{summary} folded {messages[0]['seq']}-{messages[-1]['seq']}".strip()
+
+@pytest.fixture
+def store(monkeypatch):
+    def install(turns):
+        fake = FakeStore(turns)
+        monkeypatch.setattr(hlpr, "CONTEXT_TOKEN_BUDGET", BUDGET)
+        monkeypatch.setattr(db, "connection", fake.connection)
+        monkeypatch.setattr(db, "get_lesson_messages_between", fake.get_lesson_messages_between)
+        monkeypatch.setattr(hlpr, "fold_context_summary", fake.fold_context_summary)
+        return fake
+    return install
+
+def test_short_conversation_goes_in_verbatim(store):
+    turns = [_turn(seq, chars=40) for seq in range(1, 4)]
+    fake = store(turns)
+    lesson = {"messages": list(turns), "context_summary": None, "context_upto": 0}
+
+    context = asyncio.run(teacher.build_answer_context(lesson, 1))
+
+    assert context == ".\n\n".join(m["content"] for m in turns)
+    assert fake.folded == []
+    assert lesson["context_upto"] == 0
+
+def test_overflow_folds_oldest_turns_into_summary(store):
+    # six turns of ~51 tokens against a budget of 100: the newest turns
+    # that fit half the budget stay verbatim, the rest are folded
+    turns = [_turn(seq) for seq in range(1, 7)]
+    fake = store(turns)
+    lesson = {"messages": list(turns), "context_summary": None, "context_upto": 0}
+
+    context = asyncio.run(teacher.build_answer_context(lesson, 1))
+
+    assert fake.folded == [[1, 2, 3, 4, 5]]
+    assert lesson["context_upto"] == 5
+    assert lesson["context_summary"] == "folded 1-5"
+    assert context == f"Notes on the conversation so far:\nfolded 1-5\n\nMost recent messages:\n{turns[5]['content']}"
+
+def test_folding_resumes_after_context_upto(store):
+    turns = [_turn(seq) for seq in range(1, 9)]
+    fake = store(turns)
+    lesson = {"messages": list(turns), "context_summary": "folded 1-5", "context_upto": 5}
+
+    asyncio.run(teacher.build_answer_context(lesson, 1))
+
+    # turns 1-5 are already in the summary and are never re-read
+    assert fake.folded == [[6, 7]]
+    assert lesson["context_upto"] == 7
+
+def test_turns_missing_from_the_tail_are_folded(store):
+    # only the last two turns are in memory (MESSAGE_TAIL), and nothing was
+    # folded yet: the older ones are folded even though the tail is small
+    turns = [_turn(seq, chars=40) for seq in range(1, 11)]
+    fake = store(turns)
+    lesson = {"messages": turns[-2:], "context_summary": None, "context_upto": 0}
+
+    context = asyncio.run(teacher.build_answer_context(lesson, 1))
+
+    assert fake.folded == [list(range(1, 9))]
+    assert lesson["context_upto"] == 8
+    assert context.endswith(".\n\n".join(m["content"] for m in turns[-2:]))
+
+def test_fold_splits_backlog_into_budget_sized_calls(monkeypatch):
+    calls = []
+
+    def fake_model(prompt):
+        calls.append(prompt.to_string())
+        return AIMessage(content=f"summary {len(calls)}")
+
+    monkeypatch.setattr(hlpr, "CONTEXT_TOKEN_BUDGET", BUDGET)
+    monkeypatch.setattr(LLM, "get_llm", staticmethod(lambda *a, **k: RunnableLambda(fake_model)))
+
+    # five turns of ~51 tokens: at most one fits each call's budget of 100
+    summary = asyncio.run(hlpr.fold_context_summary("", [_turn(seq) for seq in range(1, 6)]))
+
+    assert len(calls) == 5
+    assert summary == "summary 5"
+    # each call builds on the summary so far
+    assert "summary 4" in calls[-1]
@@ -0,0 +1,63 @@
+# Password hashing off the event loop (session_helpers.py). See
+# bench_bcrypt_pool.py for throughput numbers.
+
+import time, asyncio
+
+import pytest
+
+bcrypt = pytest.importorskip("bcrypt")
+pytest.importorskip("redis")
+
+import api_helpers.session_helpers as session
+
+# cheaper than BCRYPT_ROUNDS, so the tests stay quick
+ROUNDS = 10
+
+@pytest.fixture(scope="module")
+def hashed():
+    return bcrypt.hashpw(b"secret", bcrypt.gensalt(rounds=ROUNDS)).decode()
+
+async def _max_loop_lag(work, tick: float = 0.005) -> float:
+    # run `work` while a ticker measures how late the event loop wakes it
+    lag = 0.0
+    done = False
+
+    async def ticker():
+        nonlocal lag
+        while not done:
+            start = time.perf_counter()
+            await asyncio.sleep(tick)
+            lag = max(lag, time.perf_counter() - start - tick)
+
+    task = asyncio.create_task(ticker())
+    try:
+        await work
+    finally:
+        done = True
+        await task
+    return lag
+
+def test_verification_does_not_block_the_event_loop(hashed):
+    start = time.perf_counter()
+    bcrypt.checkpw(b"secret", hashed.encode())
+    one = time.perf_counter() - start
+
+    async def burst():
+        results = await asyncio.gather(*[session.verify_password("secret", hashed) for _ in range(8)])
+        assert all(results)
+
+    lag = asyncio.run(_max_loop_lag(burst()))
+    # on the loop, every verification would stall it for its full cost
+    assert lag < one / 2, f"event loop stalled {lag * 1000:.0f}ms (one bcrypt call takes {one * 1000:.0f}ms)"
+
+def test_wrong_password_is_rejected(hashed):
+    assert asyncio.run(session.verify_password("wrong", hashed)) is False
+
+def test_full_queue_fails_fast(monkeypatch, hashed):
+    monkeypatch.setattr(session, "_bcrypt_pending", session.BCRYPT_WORKERS + session.BCRYPT_QUEUE_LIMIT)
+    with pytest.raises(session.PasswordHasherBusy):
+        asyncio.run(session.verify_password("secret", hashed))
+
+def test_hashes_at_another_cost_need_rehash(hashed):
+    assert session.needs_rehash(hashed) == (ROUNDS != session.BCRYPT_ROUNDS)
+    assert session.needs_rehash("not a bcrypt hash")
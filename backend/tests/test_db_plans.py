@@ -0,0 +1,211 @@
+# Query plans and latency of the read paths, against a real Postgres.
+#
+# Needs TEST_DATABASE_URL pointing at a database that may be wiped: the
+# schema is created with init_db (so migrations run too) and every table is
+# truncated and filled with a few hundred courses' worth of rows. Each read
+# function in courses/database.py is then run on a connection that records
+# the SQL it sends, and every recorded statement is EXPLAINed: none may
+# sequentially scan one of the large tables, and the hot ones must use the
+# index they were written for. Latencies are checked against
+# TEST_READ_BUDGET_MS (median over a few runs), a loose bound meant to catch
+# a query that has stopped using its index, not to benchmark the host.
+
+import os, time, asyncio, statistics
+
+import pytest
+
+pytestmark = pytest.mark.skipif(not os.getenv("TEST_DATABASE_URL"), reason="TEST_DATABASE_URL is not set")
+
+READ_BUDGET_MS = float(os.getenv("TEST_READ_BUDGET_MS", "25"))
+RUNS = 15
+
+# rows per parent
+USERS = 100
+COURSES_PER_USER = 4
+SECTIONS_PER_COURSE = 4
+LESSONS_PER_SECTION = 6
+MESSAGES_PER_LESSON = 12
+CHUNKS_PER_LESSON = 4
+QUIZZES_PER_SECTION = 3
+
+# ids are assigned in order, so these are consistent with each other:
+# lesson 1000 is in section 167, which is in course 42 (of user 11)
+USER_ID = 11
+COURSE_ID = 42
+SECTION_ID = 167
+LESSON_ID = 1000
+
+# tables big enough that a sequential scan on a request path is a bug
+LARGE_TABLES = {"courses", "sections", "lessons", "lesson_messages", "lesson_chunks", "quizzes", "exercises"}
+
+SEED_SQL = f"""
+TRUNCATE users, courses, sections, lessons, lesson_messages, lesson_chunks,
+         exercises, quizzes, projects RESTART IDENTITY CASCADE;
+
+INSERT INTO users(id, username, password_hash)
+SELECT u, 'user' || u, 'x' FROM generate_series(1, {USERS}) AS u;
+
+INSERT INTO courses(id, user_id, slug, title, description, status)
+SELECT c, (c - 1) / {COURSES_PER_USER} + 1, 'course-' || c, 'Course ' || c, 'About course ' || c, 0
+FROM generate_series(1, {USERS * COURSES_PER_USER}) AS c;
+
+INSERT INTO sections(id, course_id, title, summary, position, status)
+SELECT s, (s - 1) / {SECTIONS_PER_COURSE} + 1, 'Section ' || s, 'Summary of section ' || s,
+       (s - 1) % {SECTIONS_PER_COURSE} + 1, 0
+FROM generate_series(1, {USERS * COURSES_PER_USER * SECTIONS_PER_COURSE}) AS s;
+
+INSERT INTO lessons(id, course_id, section_id, title, description, body_md, summary, position, status)
+SELECT l, ((l - 1) / {LESSONS_PER_SECTION}) / {SECTIONS_PER_COURSE} + 1, (l - 1) / {LESSONS_PER_SECTION} + 1,
+       'Lesson ' || l, 'About lesson ' || l, repeat('Some lesson text. ', 40), 'Summary of lesson ' || l,
+       (l - 1) % {LESSONS_PER_SECTION} + 1, 1
+FROM generate_series(1, {USERS * COURSES_PER_USER * SECTIONS_PER_COURSE * LESSONS_PER_SECTION}) AS l;
+
+INSERT INTO lesson_messages(lesson_id, seq, role, content)
+SELECT l.id, m, CASE WHEN m % 2 = 0 THEN 'user' ELSE 'application' END, 'Message ' || m || ' of lesson ' || l.id
+FROM lessons AS l, generate_series(1, {MESSAGES_PER_LESSON}) AS m;
+
+INSERT INTO lesson_chunks(lesson_id, chunk_no, content, embedding)
+SELECT l.id, n, 'Chunk ' || n, ARRAY[0.1, 0.2, 0.3, 0.4]::REAL[]
+FROM lessons AS l, generate_series(1, {CHUNKS_PER_LESSON}) AS n;
+
+INSERT INTO exercises(lesson_id, title, exercise, solution)
+SELECT l.id, 'Exercise for lesson ' || l.id, 'Do something', 'Done'
+FROM lessons AS l;
+
+INSERT INTO quizzes(course_id, section_id, quiz, options, answer, position, status)
+SELECT s.course_id, s.id, 'Question ' || q, '["a", "b", "c", "d"]', 0,
+       (s.position - 1) * {QUIZZES_PER_SECTION} + q, 0
+FROM sections AS s, generate_series(1, {QUIZZES_PER_SECTION}) AS q;
+
+SELECT setval(pg_get_serial_sequence('users', 'id'), (SELECT max(id) FROM users));
+SELECT setval(pg_get_serial_sequence('courses', 'id'), (SELECT max(id) FROM courses));
+SELECT setval(pg_get_serial_sequence('sections', 'id'), (SELECT max(id) FROM sections));
+SELECT setval(pg_get_serial_sequence('lessons', 'id'), (SELECT max(id) FROM lessons));
+"""
+
+def _run(coro):
+    return asyncio.run(coro)
+
+@pytest.fixture(scope="module")
+def seeded():
+    import psycopg
+    import courses.database as db
+
+    async def setup():
+        await db.open_pool()
+        try:
+            await db.init_db()
+        finally:
+            await db.close_pool()
+        async with await psycopg.AsyncConnection.connect(db.DATABASE_URL, autocommit=True) as con:
+            await con.execute(SEED_SQL)
+            await con.execute("ANALYZE")
+
+    _run(setup())
+
+def _cases(db) -> dict:
+    # every read path a request can take
+    return {
+        "get_all_courses":       lambda con: db.get_all_courses(con, USER_ID),
+        "get_sections":          lambda con: db.get_sections(con, COURSE_ID),
+        "get_lessons":           lambda con: db.get_lessons(con, SECTION_ID),
+        "get_course_tree":       lambda con: db.get_course_tree(con, COURSE_ID),
+        "get_course_tree_full":  lambda con: db.get_course_tree(con, COURSE_ID, db.TREE_FIELDS),
+        "get_single_lesson":     lambda con: db.get_single_lesson(con, LESSON_ID),
+        "get_lesson_messages":   lambda con: db.get_lesson_messages(con, LESSON_ID),
+        "get_lesson_tail":       lambda con: db.get_lesson_messages(con, LESSON_ID, tail=5),
+        "get_lesson_chunks":     lambda con: db.get_lesson_chunks(con, LESSON_ID),
+        "get_summaries":         lambda con: db.get_summaries(con, COURSE_ID, SECTION_ID, 3),
+        "get_next_lesson_ids":   lambda con: db.get_next_lesson_ids(con, LESSON_ID, 2),
+        "get_first_lesson_ids":  lambda con: db.get_first_lesson_ids(con, COURSE_ID, 2),
+        "get_course_lesson_ids": lambda con: db.get_course_lesson_ids(con, COURSE_ID),
+        "get_all_exercises":     lambda con: db.get_all_exercises(con, LESSON_ID),
+        "get_quizzes":           lambda con: db.get_quizzes(con, SECTION_ID),
+    }
+
+# kept in step with _cases; listed here so collection doesn't import the app
+CASE_NAMES = [
+    "get_all_courses", "get_sections", "get_lessons", "get_course_tree",
+    "get_course_tree_full", "get_single_lesson", "get_lesson_messages",
+    "get_lesson_tail", "get_lesson_chunks", "get_summaries",
+    "get_next_lesson_ids", "get_first_lesson_ids", "get_course_lesson_ids",
+    "get_all_exercises", "get_quizzes",
+]
+
+# indexes the hottest paths were written for
+EXPECTED_INDEX = {
+    "get_lesson_tail":   "lesson_messages_pkey",
+    "get_lesson_chunks": "lesson_chunks_pkey",
+    "get_quizzes":       "quizzes_section_position_idx",
+}
+
+def _plan_nodes(plan):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from _plan_nodes(child)
+
+async def _record_and_explain(call):
+    # run `call` on a connection that records its statements, then EXPLAIN
+    # each statement with the same parameters
+    import psycopg
+    from psycopg.rows import dict_row
+    import courses.database as db
+
+    statements = []
+
+    class RecordingCursor(psycopg.AsyncCursor):
+        async def execute(self, query, params=None, **kwargs):
+            statements.append((query, params))
+            return await super().execute(query, params, **kwargs)
+
+    async with await psycopg.AsyncConnection.connect(
+        db.DATABASE_URL, row_factory=dict_row, cursor_factory=RecordingCursor
+    ) as con:
+        await call(con)
+        plans = []
+        async with psycopg.AsyncCursor(con, row_factory=dict_row) as cur:
+            for query, params in statements:
+                await cur.execute("EXPLAIN (FORMAT JSON) " + query, params)
+                plans.append((query, (await cur.fetchone())["QUERY PLAN"][0]["Plan"]))
+    return plans
+
+@pytest.mark.parametrize("name", CASE_NAMES)
+def test_read_path_uses_indexes(seeded, name):
+    import courses.database as db
+    call = _cases(db)[name]
+    plans = _run(_record_and_explain(call))
+    assert plans, f"{name} sent no statements"
+
+    used = set()
+    for query, plan in plans:
+        for node in _plan_nodes(plan):
+            if node["Node Type"] == "Seq Scan":
+                assert node.get("Relation Name") not in LARGE_TABLES, (
+                    f"{name}: sequential scan on {node['Relation Name']} in\n{query}"
+                )
+            if node.get("Index Name"):
+                used.add(node["Index Name"])
+    if name in EXPECTED_INDEX:
+        assert EXPECTED_INDEX[name] in used, f"{name} used {sorted(used)}, not {EXPECTED_INDEX[name]}"
+
+@pytest.mark.parametrize("name", CASE_NAMES)
+def test_read_path_latency(seeded, name):
+    import psycopg
+    from psycopg.rows import dict_row
+    import courses.database as db
+    call = _cases(db)[name]
+
+    async def measure():
+        async with await psycopg.AsyncConnection.connect(db.DATABASE_URL, row_factory=dict_row) as con:
+            await call(con)  # warm the plan and buffer caches
+            times = []
+            for _ in range(RUNS):
+                start = time.perf_counter()
+                await call(con)
+                times.append((time.perf_counter() - start) * 1000)
+                await con.rollback()
+        return times
+
+    times = _run(measure())
+    median = statistics.median(times)
+    assert median < READ_BUDGET_MS, f"{name}: median {median:.1f}ms over {RUNS} runs (budget {READ_BUDGET_MS}ms)"
@@ -0,0 +1,71 @@
+# lesson_chunks writes (add_lesson_chunk, replace_lesson_chunks), against a
+# real Postgres.
+#
+# Needs TEST_DATABASE_URL, as test_db_plans.py. Each test creates its own
+# user, course and lesson, and deletes the user (and with it the rest)
+# afterwards.
+
+import os, uuid, asyncio
+
+import pytest
+
+pytestmark = pytest.mark.skipif(not os.getenv("TEST_DATABASE_URL"), reason="TEST_DATABASE_URL is not set")
+
+TURNS = 8
+
+async def _with_lesson(test):
+    import courses.database as db
+
+    await db.open_pool()
+    try:
+        await db.init_db()
+        name = f"chunks-{uuid.uuid4().hex[:12]}"
+        async with db.connection() as con:
+            async with con.cursor() as cur:
+                await cur.execute("INSERT INTO users(username, password_hash) VALUES (%s, 'x') RETURNING id", (name,))
+                user_id = (await cur.fetchone())["id"]
+                await cur.execute(
+                    "INSERT INTO courses(user_id, slug, title, description, status) VALUES (%s, %s, %s, '', 0) RETURNING id",
+                    (user_id, name, name),
+                )
+                course_id = (await cur.fetchone())["id"]
+                await cur.execute(
+                    "INSERT INTO lessons(course_id, title, description, position, status) VALUES (%s, 'L', '', 1, 1) RETURNING id",
+                    (course_id,),
+                )
+                lid = (await cur.fetchone())["id"]
+            await con.commit()
+        try:
+            await test(db, lid)
+        finally:
+            async with db.connection() as con:
+                await con.execute("DELETE FROM users WHERE id = %s", (user_id,))
+                await con.commit()
+    finally:
+        await db.close_pool()
+
+async def _add_turn(db, lid, n):
+    async with db.connection() as con:
+        return await db.add_lesson_chunk(con, lid, f"Question: {n}\nAnswer: {n}", [float(n), 1.0])
+
+def test_concurrent_turns_get_distinct_chunk_numbers():
+    async def test(db, lid):
+        numbers = await asyncio.gather(*[_add_turn(db, lid, n) for n in range(TURNS)])
+        assert sorted(numbers) == list(range(db.TURN_CHUNK_BASE + 1, db.TURN_CHUNK_BASE + TURNS + 1))
+
+    asyncio.run(_with_lesson(test))
+
+def test_rechunking_the_body_keeps_turns():
+    async def test(db, lid):
+        async with db.connection() as con:
+            await db.replace_lesson_chunks(con, lid, ["a", "b"], [[1.0], [2.0]])
+        await _add_turn(db, lid, 1)
+        await _add_turn(db, lid, 2)
+        async with db.connection() as con:
+            await db.replace_lesson_chunks(con, lid, ["x", "y", "z"], [[1.0], [2.0], [3.0]])
+            chunks = await db.get_lesson_chunks(con, lid)
+
+        assert [c["content"] for c in chunks] == ["x", "y", "z", "Question: 1\nAnswer: 1", "Question: 2\nAnswer: 2"]
+        assert [c["chunk_no"] for c in chunks] == [1, 2, 3, db.TURN_CHUNK_BASE + 1, db.TURN_CHUNK_BASE + 2]
+
+    asyncio.run(_with_lesson(test))
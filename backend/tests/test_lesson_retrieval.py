@@ -0,0 +1,94 @@
+# Retrieval scoring for lesson Q&A (lesson_retrieval.py). Chunks are put
+# straight into the in-process index with HashEmbeddings vectors, so no
+# database or model host is involved.
+
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+
+pytest.importorskip("langchain_ollama")
+
+from llm_operations.llm_class import LLM, HashEmbeddings
+from llm_operations.course_teaching.lesson_helpers import estimate_tokens
+import llm_operations.course_teaching.lesson_retrieval as retrieval
+
+PARAGRAPHS = [
+    "Photosynthesis turns light, water and carbon dioxide into glucose and oxygen inside chloroplasts.",
+    "Mitochondria break glucose down again during cellular respiration, releasing energy as ATP.",
+    "Osmosis moves water across a membrane from low to high solute concentration.",
+    "Enzymes speed up reactions by lowering their activation energy; temperature and pH change how well they work.",
+]
+
+LID = 1
+
+@asynccontextmanager
+async def _no_connection():
+    yield None
+
+@pytest.fixture(autouse=True)
+def hash_index():
+    embeddings = HashEmbeddings()
+    LLM.set_embeddings(embeddings)
+    vectors = embeddings.embed_documents(PARAGRAPHS)
+    retrieval._index.clear()
+    retrieval._index.set(LID, [
+        {"chunk_no": n, "content": c, "embedding": e}
+        for n, (c, e) in enumerate(zip(PARAGRAPHS, vectors), start=1)
+    ])
+    yield
+    retrieval._index.clear()
+
+def test_most_similar_chunk_ranks_first():
+    hits = asyncio.run(retrieval.retrieve(LID, "Why does osmosis move water across a membrane?", k=1))
+    assert hits == [PARAGRAPHS[2]]
+
+def test_hits_come_back_in_lesson_order():
+    # enzymes (chunk 4) and photosynthesis (chunk 1) are the two best
+    # matches, enzymes scoring slightly lower; they are presented as the
+    # lesson has them, not by score
+    query = "What do chloroplasts and enzymes have to do with activation energy and photosynthesis?"
+    hits = asyncio.run(retrieval.retrieve(LID, query, k=2))
+    assert hits == [PARAGRAPHS[0], PARAGRAPHS[3]]
+
+def test_k_bounds_the_reference():
+    hits = asyncio.run(retrieval.retrieve(LID, "glucose", k=3))
+    assert len(hits) == 3
+    assert len(asyncio.run(retrieval.retrieve(LID, "glucose", k=10))) == len(PARAGRAPHS)
+
+def test_unindexed_lesson_retrieves_nothing():
+    retrieval._index.set(2, [])
+    assert asyncio.run(retrieval.retrieve(2, "anything")) == []
+
+def test_cosine_of_zero_vector_is_zero():
+    assert retrieval._cosine([0.0, 0.0], [1.0, 0.0]) == 0.0
+    assert retrieval._cosine([1.0, 0.0], [2.0, 0.0]) == pytest.approx(1.0)
+
+def test_chunks_merge_short_paragraphs_up_to_budget(monkeypatch):
+    monkeypatch.setattr(retrieval, "CHUNK_TOKENS", 50)
+    paragraph = "x" * 80  # 21 tokens by estimate_tokens
+    body = "\n\n".join([paragraph] * 5)
+    chunks = retrieval.chunk_body(body)
+    assert chunks == ["\n\n".join([paragraph] * 2)] * 2 + [paragraph]
+    assert all(estimate_tokens(c) <= 50 for c in chunks)
+
+def test_chunks_skip_blank_paragraphs():
+    assert retrieval.chunk_body("one\n\n\n\n  \n\ntwo") == ["one\n\ntwo"]
+    assert retrieval.chunk_body("") == []
+
+def test_reindexing_the_body_keeps_turn_chunks(monkeypatch):
+    import courses.database as db
+
+    async def replace(con, lid, chunks, embeddings):
+        pass
+
+    monkeypatch.setattr(db, "replace_lesson_chunks", replace)
+    monkeypatch.setattr(db, "connection", _no_connection)
+    turn = {"chunk_no": db.TURN_CHUNK_BASE + 1, "content": "Question: why?\nAnswer: because", "embedding": [1.0]}
+    retrieval._index.get(LID).append(turn)
+
+    asyncio.run(retrieval.index_lesson_body(LID, "New first paragraph.\n\nNew second paragraph."))
+
+    chunks = retrieval._index.get(LID)
+    assert [c["chunk_no"] for c in chunks] == [1, db.TURN_CHUNK_BASE + 1]
+    assert chunks[-1] is turn
@@ -0,0 +1,134 @@
+# Write-behind of lessons in progress (LessonSession in course_teacher.py).
+# The lessons table is replaced by an in-memory fake that applies the same
+# version check as db.update_lesson_sql / db.update_lessons_sql, and whose
+# batch UPDATE can be held open to interleave other calls with a flush.
+
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+
+pytest.importorskip("langchain_ollama")
+
+import courses.database as db
+from llm_operations.course_teaching.course_teacher import LessonSession, StaleLesson
+
+LID = 1
+
+class FakeLessons:
+    def __init__(self):
+        self.rows = {LID: {"id": LID, "version": 1, "status": 1}}
+        self.hold = None      # set to an Event to pause the next batch UPDATE
+        self.writing = asyncio.Event()
+        self.loads = 0
+
+    @asynccontextmanager
+    async def connection(self):
+        yield None
+
+    def _write(self, lesson) -> bool:
+        row = self.rows[lesson["id"]]
+        if row["version"] != lesson["version"]:
+            return False
+        row.update(lesson, version=row["version"] + 1)
+        return True
+
+    async def update_lessons_sql(self, con, lessons):
+        self.writing.set()
+        if self.hold is not None:
+            await self.hold.wait()
+        stale = [l["id"] for l in lessons if not self._write(l)]
+        # like the real one, versions are only bumped once the batch commits
+        for l in lessons:
+            if l["id"] not in stale:
+                l["version"] = self.rows[l["id"]]["version"]
+        return stale
+
+    async def update_lesson_sql(self, con, lesson):
+        if not self._write(lesson):
+            return False
+        lesson["version"] = self.rows[lesson["id"]]["version"]
+        return True
+
+    async def get_single_lesson(self, con, lid):
+        self.loads += 1
+        return dict(self.rows[lid])
+
+@pytest.fixture
+def lessons(monkeypatch):
+    fake = FakeLessons()
+    monkeypatch.setattr(db, "connection", fake.connection)
+    monkeypatch.setattr(db, "update_lessons_sql", fake.update_lessons_sql)
+    monkeypatch.setattr(db, "update_lesson_sql", fake.update_lesson_sql)
+    monkeypatch.setattr(db, "get_single_lesson", fake.get_single_lesson)
+    LessonSession._cache.clear()
+    monkeypatch.setattr(LessonSession, "_dirty", {})
+    monkeypatch.setattr(LessonSession, "_inflight", {})
+    monkeypatch.setattr(LessonSession, "_write_lock", None)
+    yield fake
+    LessonSession._cache.clear()
+
+def _dirty_lesson(fake) -> dict:
+    lesson = dict(fake.rows[LID], status=1, progress="halfway")
+    LessonSession._cache.set(LID, lesson)
+    LessonSession._dirty[LID] = lesson
+    return lesson
+
+def test_write_through_waits_for_a_flush_of_the_same_lesson(lessons):
+    # "Finish" lands while the periodic flush is still writing the lesson:
+    # it must send the version the flush moves the row to, not the old one
+    async def scenario():
+        lesson = _dirty_lesson(lessons)
+        lessons.hold = asyncio.Event()
+        flush = asyncio.create_task(LessonSession.flush())
+        await lessons.writing.wait()
+
+        lesson["status"] = 2
+        finish = asyncio.create_task(LessonSession.push_to_sql(lesson))
+        await asyncio.sleep(0)
+        assert not finish.done()
+
+        lessons.hold.set()
+        await flush
+        await finish
+        return lesson
+
+    lesson = asyncio.run(scenario())
+    assert lessons.rows[LID]["status"] == 2
+    assert lessons.rows[LID]["version"] == lesson["version"] == 3
+    assert LessonSession._dirty == {} and LessonSession._inflight == {}
+
+def test_lesson_evicted_during_flush_is_not_reloaded(lessons):
+    async def scenario():
+        lesson = _dirty_lesson(lessons)
+        lessons.hold = asyncio.Event()
+        flush = asyncio.create_task(LessonSession.flush())
+        await lessons.writing.wait()
+
+        LessonSession._cache.clear()
+        seen = await LessonSession.get_lesson(LID)
+        lessons.hold.set()
+        await flush
+        return lesson, seen
+
+    lesson, seen = asyncio.run(scenario())
+    assert seen is lesson
+    assert lessons.loads == 0
+
+def test_failed_flush_keeps_the_batch_dirty(lessons, monkeypatch):
+    async def broken(con, batch):
+        raise ConnectionError("down")
+
+    monkeypatch.setattr(db, "update_lessons_sql", broken)
+    lesson = _dirty_lesson(lessons)
+    with pytest.raises(ConnectionError):
+        asyncio.run(LessonSession.flush())
+    assert LessonSession._dirty == {LID: lesson}
+    assert LessonSession._inflight == {}
+
+def test_stale_write_through_drops_the_copy(lessons):
+    lesson = _dirty_lesson(lessons)
+    lessons.rows[LID]["version"] = 5  # written by another worker
+    with pytest.raises(StaleLesson):
+        asyncio.run(LessonSession.push_to_sql(lesson))
+    assert LessonSession._cache.get(LID) is None
@@ -0,0 +1,19 @@
+# Size accounting of the on-disk LLM response cache (llm_cache.py).
+
+import pytest
+
+pytest.importorskip("langchain_core")
+
+from langchain_core.outputs import Generation
+
+from llm_operations.llm_cache import FileLLMCache
+
+def test_overwriting_an_entry_counts_only_its_new_size(tmp_path):
+    cache = FileLLMCache(str(tmp_path), max_bytes=1 << 20)
+    cache.update("prompt", "model", [Generation(text="first")])
+    cache.update("other", "model", [Generation(text="x")])
+    for text in ["a much longer answer than before", "short"]:
+        cache.update("prompt", "model", [Generation(text=text)])
+
+    assert cache._size == cache._scan_size()
+    assert cache.lookup("prompt", "model")[0].text == "short"
@@ -0,0 +1,107 @@
+# Load balancing across Ollama hosts (llm_pool.py), with stand-in models
+# in place of ChatOllama.
+
+import asyncio
+
+import pytest
+
+pytest.importorskip("langchain_core")
+pytest.importorskip("httpx")
+
+from llm_operations.llm_pool import BackendPool, BalancedModel
+
+URLS = ["http://a:11434", "http://b:11434", "http://c:11434"]
+
+class FakeModel:
+    cache = None
+
+    def __init__(self, url, fail=None, fail_after=None):
+        self.url = url
+        self.fail = fail              # raised by every call
+        self.fail_after = fail_after  # chunks a stream yields before failing
+        self.calls = 0
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        self.calls += 1
+        if self.fail:
+            raise self.fail
+        return f"{self.url}: {input}"
+
+    async def astream(self, input, config=None, **kwargs):
+        self.calls += 1
+        for i, chunk in enumerate(["one ", "two ", "three"]):
+            if self.fail and (self.fail_after or 0) <= i:
+                raise self.fail
+            yield chunk
+
+def _balanced(**fakes):
+    pool = BackendPool(URLS)
+    models = {url: fakes.get(url[7], FakeModel(url)) for url in URLS}
+    return pool, BalancedModel(pool, lambda url: models[url]), models
+
+async def _collect(stream):
+    return [chunk async for chunk in stream]
+
+def test_pick_prefers_fewest_outstanding_then_fewest_requests():
+    pool = BackendPool(URLS)
+    a, b, c = pool.backends
+    a.outstanding, b.outstanding, c.outstanding = 2, 1, 1
+    b.requests, c.requests = 5, 3
+    assert pool.pick() is c
+    assert pool.pick(exclude=[c]) is b
+
+def test_ejected_backend_is_skipped_until_it_recovers():
+    pool = BackendPool(URLS)
+    a, b, c = pool.backends
+    pool.eject(a)
+    pool.eject(b)
+    assert pool.pick() is c
+    assert a.failures == 1
+    # with every backend ejected, someone is still tried
+    pool.eject(c)
+    assert pool.pick() in pool.backends
+    a.ejected_until = 0.0
+    assert pool.pick() is a
+
+def test_invoke_retries_on_another_backend_and_ejects_the_failed_one():
+    pool, model, models = _balanced(a=FakeModel(URLS[0], fail=ConnectionError("refused")))
+    result = asyncio.run(model.ainvoke("hi"))
+
+    assert result.endswith(": hi") and not result.startswith(URLS[0])
+    a = pool.backends[0]
+    assert not a.healthy and a.failures == 1
+    assert all(b.outstanding == 0 for b in pool.backends)
+
+def test_invoke_does_not_retry_request_errors():
+    # a bad request would fail on every host, so it is not retried
+    pool, model, models = _balanced(**{k: FakeModel(u, fail=ValueError("bad")) for k, u in zip("abc", URLS)})
+    with pytest.raises(ValueError):
+        asyncio.run(model.ainvoke("hi"))
+    assert sum(m.calls for m in models.values()) == 1
+    assert all(b.healthy for b in pool.backends)
+
+def test_invoke_gives_up_after_every_backend_failed():
+    pool, model, models = _balanced(**{k: FakeModel(u, fail=ConnectionError("down")) for k, u in zip("abc", URLS)})
+    with pytest.raises(ConnectionError):
+        asyncio.run(model.ainvoke("hi"))
+    assert [m.calls for m in models.values()] == [1, 1, 1]
+
+def test_stream_is_retried_before_its_first_chunk():
+    pool, model, models = _balanced(a=FakeModel(URLS[0], fail=ConnectionError("refused"), fail_after=0))
+    assert asyncio.run(_collect(model.astream("hi"))) == ["one ", "two ", "three"]
+    assert not pool.backends[0].healthy
+
+def test_stream_is_not_retried_once_it_has_started():
+    # the caller has already forwarded the first chunks, so a retry would
+    # repeat them
+    pool, model, models = _balanced(a=FakeModel(URLS[0], fail=ConnectionError("reset"), fail_after=1))
+    received = []
+
+    async def consume():
+        async for chunk in model.astream("hi"):
+            received.append(chunk)
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(consume())
+    assert received == ["one "]
+    assert sum(m.calls for m in models.values()) == 1
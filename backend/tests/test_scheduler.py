@@ -0,0 +1,78 @@
+# Admission by priority class (scheduler.py), with a stand-in model whose
+# streams run until the test lets them finish.
+
+import asyncio
+
+import pytest
+
+pytest.importorskip("langchain_core")
+
+import llm_operations.scheduler as sched
+from llm_operations.scheduler import LLMScheduler, ScheduledModel, INTERACTIVE, GENERATION, BULK
+
+class FakeModel:
+    def __init__(self):
+        self.done = asyncio.Event()
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        return f"answer to {input}"
+
+    async def astream(self, input, config=None, **kwargs):
+        yield "first "
+        await self.done.wait()
+        yield "last"
+
+async def _consume(model, input):
+    return [chunk async for chunk in model.astream(input)]
+
+def test_interactive_is_admitted_while_bulk_streams_fill_the_pool(monkeypatch):
+    scheduler = LLMScheduler(max_concurrency=3, max_queue=8, interactive_reserve=1)
+    monkeypatch.setattr(sched, "scheduler", scheduler)
+
+    async def scenario():
+        fake = FakeModel()
+        bulk = ScheduledModel(fake, priority=BULK, purpose="quiz")
+        streams = [asyncio.create_task(_consume(bulk, n)) for n in range(4)]
+        await asyncio.sleep(0.01)
+        # two streams hold the slots open to bulk work, two wait for them
+        assert scheduler.stats()["active"] == 2
+        assert scheduler.stats()["queue_depth_by_class"]["bulk"] == 2
+
+        answer = await asyncio.wait_for(ScheduledModel(fake, priority=INTERACTIVE).ainvoke("q"), timeout=1)
+        assert answer == "answer to q"
+        assert not any(s.done() for s in streams)
+
+        fake.done.set()
+        return await asyncio.gather(*streams)
+
+    assert asyncio.run(scenario()) == [["first ", "last"]] * 4
+    assert scheduler.stats()["active"] == scheduler.stats()["active_background"] == 0
+
+def test_higher_class_is_served_first_when_a_slot_frees():
+    scheduler = LLMScheduler(max_concurrency=2, max_queue=8, interactive_reserve=1)
+    order = []
+
+    async def call(priority, name, hold):
+        async with scheduler.slot(priority, user=name):
+            order.append(name)
+            await hold.wait()
+
+    async def scenario():
+        first, rest = asyncio.Event(), asyncio.Event()
+        running = asyncio.create_task(call(GENERATION, "lesson", first))
+        await asyncio.sleep(0)
+        waiting = [asyncio.create_task(call(BULK, "quiz", rest)), asyncio.create_task(call(GENERATION, "exercise", rest))]
+        await asyncio.sleep(0)
+        assert order == ["lesson"]
+        first.set()
+        await running
+        await asyncio.sleep(0)
+        rest.set()
+        await asyncio.gather(*waiting)
+
+    asyncio.run(scenario())
+    assert order == ["lesson", "exercise", "quiz"]
+
+def test_reserve_leaves_a_slot_for_other_classes():
+    assert LLMScheduler(max_concurrency=1, interactive_reserve=1).interactive_reserve == 0
+    assert LLMScheduler(max_concurrency=4, interactive_reserve=9).interactive_reserve == 3
@@ -120,6 +120,7 @@ export function useApi(base = API_BASE) {
   const newExercise = useCallback(async (l_id) => {
       const id = Number(l_id);
       const res = await fetch(`${base}/api/new-exercise?l_id=${id}`, {
+         method: "POST",
          credentials: "include",
          headers: { Accept: "application/json" },
       });